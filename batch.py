@@ -0,0 +1,123 @@
+import csv
+import io
+import os
+import shutil
+import tempfile
+import zipfile
+from collections import namedtuple
+
+from costs import calculate_cost, DEFAULT_PRICE_PER_GRAM
+from gcode_parser import SequentialReader
+from workers import parse_print_file, with_motion
+
+SUPPORTED_EXTENSIONS = ('.gcode', '.gco', '.3mf')
+# Сколько строк таблицы показывать в сообщении (остальное - в CSV)
+MESSAGE_ROWS = 25
+
+QuoteRow = namedtuple('QuoteRow', ['name', 'weight', 'hours', 'cost', 'error'])
+
+
+def is_supported(name):
+    return name.lower().endswith(SUPPORTED_EXTENSIONS)
+
+
+# Файлы G-code/3MF внутри ZIP (без каталогов и служебных файлов macOS)
+def list_archive_members(path, max_files=None):
+    with zipfile.ZipFile(path) as archive:
+        names = [
+            info.filename for info in archive.infolist()
+            if not info.is_dir() and is_supported(info.filename)
+            and not info.filename.startswith('__MACOSX/')
+        ]
+    return names[:max_files] if max_files else names
+
+
+# Разбор одного члена архива в процессе пула: архив открывается по пути,
+# член читается потоково, в память целиком не загружается
+def parse_archive_member(archive_path, member_name):
+    with zipfile.ZipFile(archive_path) as archive:
+        if member_name.lower().endswith('.3mf'):
+            # Вложенному .3mf нужен seek - распаковываем во временный файл
+            with archive.open(member_name) as member, tempfile.TemporaryFile() as tmp:
+                shutil.copyfileobj(member, tmp)
+                tmp.seek(0)
+                return parse_print_file(member_name, tmp)
+        with archive.open(member_name) as member:
+            result = parse_print_file(member_name, SequentialReader(member))
+        # Без метаданных слайсера - второй проход по члену архива для симуляции
+        with archive.open(member_name) as member:
+            return with_motion(result, SequentialReader(member))
+
+
+# Расчет строк сметы по результатам разбора (ParseResult или исключение)
+def build_quote(names, results, settings, price_per_gram=DEFAULT_PRICE_PER_GRAM):
+    rows = []
+    for name, result in zip(names, results):
+        if isinstance(result, BaseException):
+            rows.append(QuoteRow(name, None, None, None, str(result) or type(result).__name__))
+        elif not (result.weight_grams and result.time_hours):
+            rows.append(QuoteRow(name, result.weight_grams, result.time_hours, None, 'нет данных'))
+        else:
+            cost = calculate_cost(result.weight_grams, result.time_hours, settings, price_per_gram)
+            rows.append(QuoteRow(name, result.weight_grams, result.time_hours, cost, None))
+    return rows
+
+
+def quote_totals(rows):
+    priced = [row for row in rows if row.cost]
+    return (
+        sum(row.weight for row in priced),
+        sum(row.hours for row in priced),
+        sum(row.cost.material_cost for row in priced),
+        sum(row.cost.electricity_cost for row in priced),
+        sum(row.cost.amortization for row in priced),
+        sum(row.cost.total_cost for row in priced),
+    )
+
+
+def _short(name, width=18):
+    name = os.path.basename(name)
+    return name if len(name) <= width else name[:width - 1] + '…'
+
+
+# Таблица сметы для сообщения (моноширинный блок Markdown)
+def format_quote_table(rows, price_per_gram=DEFAULT_PRICE_PER_GRAM):
+    weight, hours, material, electricity, amortization, total = quote_totals(rows)
+    lines = [f"{'Файл':<18} {'Вес,г':>7} {'Время,ч':>7} {'Итого,₽':>9}"]
+    for row in rows[:MESSAGE_ROWS]:
+        if row.cost:
+            lines.append(f"{_short(row.name):<18} {row.weight:>7.1f} {row.hours:>7.2f} {row.cost.total_cost:>9.2f}")
+        else:
+            lines.append(f"{_short(row.name):<18} {'— ' + row.error}")
+    if len(rows) > MESSAGE_ROWS:
+        lines.append(f"… и еще {len(rows) - MESSAGE_ROWS} (см. CSV)")
+
+    failed = sum(1 for row in rows if not row.cost)
+    text = (
+        f"📦 *Смета по {len(rows)} файлам*\n\n"
+        "```\n" + "\n".join(lines) + "\n```\n\n"
+        f"⚖️ Вес: {weight:.1f} г\n"
+        f"⏱️ Время: {hours:.2f} ч\n\n"
+        f"💰 *Итого:*\n"
+        f"├ Материал: ~{material:.2f} ₽ ({price_per_gram}₽/г)\n"
+        f"├ Электричество: {electricity:.2f} ₽\n"
+        f"├ Амортизация: {amortization:.2f} ₽\n"
+        f"└ *Себестоимость: ~{total:.2f} ₽*"
+    )
+    if failed:
+        text += f"\n\n⚠️ Не удалось рассчитать файлов: {failed}"
+    return text
+
+
+# Полная смета в CSV
+def quote_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['file', 'weight_g', 'hours', 'material_cost', 'electricity_cost', 'amortization', 'total_cost', 'error'])
+    for row in rows:
+        if row.cost:
+            writer.writerow([row.name, f'{row.weight:.2f}', f'{row.hours:.4f}', *(f'{value:.2f}' for value in row.cost), ''])
+        else:
+            writer.writerow([row.name, row.weight or '', row.hours or '', '', '', '', '', row.error])
+    writer.writerow(['TOTAL', *(f'{value:.2f}' for value in quote_totals(rows)), ''])
+    return buffer.getvalue().encode('utf-8')
@@ -0,0 +1,215 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks.corpus import DEFAULT_SIZES, DIALECTS, build_corpus, format_size
+
+# Бенчмарк разбора G-code: скорость (MB/s), пиковый RSS и задержка на файл
+# для парсера и для полного пути calculator_process_file с фейковым ботом.
+# Результаты дописываются в JSON Lines, чтобы сравнивать прогоны между собой
+#
+#   python -m benchmarks.bench_parser --sizes 100K,10M --repeat 5
+#   python -m benchmarks.bench_parser --compare bench_results.jsonl
+
+DEFAULT_CORPUS = os.path.join(ROOT, 'benchmarks', '.corpus')
+DEFAULT_OUTPUT = os.path.join(ROOT, 'bench_results.jsonl')
+
+
+def _max_rss_bytes(who=resource.RUSAGE_SELF):
+    # ru_maxrss: килобайты в Linux, байты в macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+# Выполняется в отдельном процессе, чтобы пиковый RSS относился к одному файлу
+def _parse_case(path, repeat):
+    from workers import parse_print_file
+
+    baseline = _max_rss_bytes()
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = parse_print_file(os.path.basename(path), path)
+        timings.append(time.perf_counter() - started)
+    return timings, _max_rss_bytes() - baseline, result.weight_grams, result.time_hours, result.dialect
+
+
+def _check(case, weight, hours):
+    return (
+        weight is not None and hours is not None
+        and abs(weight - case.weight_grams) < 0.01
+        and abs(hours - case.time_hours) < 1 / 60
+    )
+
+
+def bench_parser(corpus, repeat):
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for case in corpus:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            timings, rss, weight, hours, dialect = executor.submit(_parse_case, case.path, repeat).result()
+        file_size = os.path.getsize(case.path)
+        median = statistics.median(timings)
+        results.append({
+            'bench': 'parser',
+            'dialect': case.dialect,
+            'size': format_size(case.size),
+            'file_bytes': file_size,
+            'detected': dialect,
+            'ok': _check(case, weight, hours),
+            'latency_ms_median': round(median * 1000, 3),
+            'latency_ms_min': round(min(timings) * 1000, 3),
+            'mb_per_s': round(file_size / 1024 ** 2 / median, 1) if median else None,
+            'peak_rss_delta_mb': round(rss / 1024 ** 2, 2),
+        })
+        _print_row(results[-1])
+    return results
+
+
+# Полный путь калькулятора: скачивание через фейковую сессию, пул процессов, ответ
+async def _bench_calculator(corpus, repeat, workdir):
+    os.environ.setdefault('BOT_TOKEN', '42:BENCHMARK')
+    # Апдейты идут подряд быстрее живого пользователя - без ограничения частоты
+    os.environ.setdefault('THROTTLE_RATE', '1000000')
+    os.environ.setdefault('THROTTLE_FILES_PER_MINUTE', '1000000')
+    os.chdir(workdir)
+    import bot as bot_module
+    from benchmarks.fake_bot import FakeSession, callback_update, document_update
+
+    session = FakeSession()
+    bot_module.bot.session = session
+    await bot_module.database.open()
+    await bot_module.init_db()
+    bot_module.parse_pool.start()
+    # Прогрев пула, чтобы не мерить запуск процессов
+    await bot_module.parse_pool.run('warmup', os.getpid)
+
+    results = []
+    user_id = 1
+    try:
+        for case in corpus:
+            timings = []
+            ok = True
+            for _ in range(repeat):
+                # Новый документ на каждый повтор - без попаданий в кэш разбора
+                document = session.add_file(os.path.basename(case.path), case.path, os.path.getsize(case.path))
+                await bot_module.dp.feed_update(bot_module.bot, callback_update(user_id, 'calculator'))
+                started = time.perf_counter()
+                await bot_module.dp.feed_update(bot_module.bot, document_update(user_id, document))
+                timings.append(time.perf_counter() - started)
+                ok = ok and 'Анализ файла' in (session.sent_texts()[-1] or '')
+            file_size = os.path.getsize(case.path)
+            median = statistics.median(timings)
+            results.append({
+                'bench': 'calculator',
+                'dialect': case.dialect,
+                'size': format_size(case.size),
+                'file_bytes': file_size,
+                'ok': ok,
+                'latency_ms_median': round(median * 1000, 3),
+                'latency_ms_min': round(min(timings) * 1000, 3),
+                'mb_per_s': round(file_size / 1024 ** 2 / median, 1) if median else None,
+                'peak_rss_mb': round(_max_rss_bytes() / 1024 ** 2, 2),
+                'peak_rss_workers_mb': round(_max_rss_bytes(resource.RUSAGE_CHILDREN) / 1024 ** 2, 2),
+            })
+            _print_row(results[-1])
+    finally:
+        bot_module.parse_pool.shutdown()
+        await bot_module.database.close()
+    return results
+
+
+def _print_row(row):
+    status = 'ok' if row['ok'] else 'MISMATCH'
+    rss = row.get('peak_rss_delta_mb', row.get('peak_rss_mb'))
+    print(f"{row['bench']:<10} {row['dialect']:<10} {row['size']:>5} "
+          f"{row['latency_ms_median']:>10.2f} ms {row['mb_per_s'] or 0:>9.1f} MB/s "
+          f"rss {rss:>8.2f} MB  {status}", flush=True)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Сравнение двух последних прогонов из файла результатов
+def compare(path):
+    with open(path, encoding='utf-8') as f:
+        runs = [json.loads(line) for line in f if line.strip()]
+    if len(runs) < 2:
+        print("Нужно минимум два прогона для сравнения")
+        return
+    previous, current = runs[-2], runs[-1]
+    before = {(r['bench'], r['dialect'], r['size']): r for r in previous['results']}
+    print(f"{previous.get('commit')} ({previous['started_at']}) -> {current.get('commit')} ({current['started_at']})")
+    for row in current['results']:
+        old = before.get((row['bench'], row['dialect'], row['size']))
+        if not old:
+            continue
+        change = (row['latency_ms_median'] - old['latency_ms_median']) / old['latency_ms_median'] * 100
+        print(f"{row['bench']:<10} {row['dialect']:<10} {row['size']:>5} "
+              f"{old['latency_ms_median']:>10.2f} -> {row['latency_ms_median']:>10.2f} ms ({change:+.1f}%)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк разбора G-code")
+    parser.add_argument('--sizes', default=','.join(DEFAULT_SIZES), help="размеры файлов, например 100K,10M,500M")
+    parser.add_argument('--dialects', default=','.join(DIALECTS), help="слайсеры через запятую")
+    parser.add_argument('--repeat', type=int, default=3, help="повторов на файл")
+    parser.add_argument('--corpus-dir', default=DEFAULT_CORPUS, help="каталог для сгенерированных файлов")
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help="файл результатов (JSON Lines)")
+    parser.add_argument('--skip-calculator', action='store_true', help="только парсер, без пути через бота")
+    parser.add_argument('--compare', metavar='RESULTS', help="сравнить два последних прогона и выйти")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(args.compare)
+        return
+
+    corpus = build_corpus(args.corpus_dir, args.dialects.split(','), args.sizes.split(','))
+    started_at = datetime.now(timezone.utc).isoformat()
+
+    results = bench_parser(corpus, args.repeat)
+    if not args.skip_calculator:
+        with tempfile.TemporaryDirectory() as workdir:
+            cwd = os.getcwd()
+            try:
+                results += asyncio.run(_bench_calculator(corpus, args.repeat, workdir))
+            finally:
+                os.chdir(cwd)
+
+    run = {
+        'started_at': started_at,
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'repeat': args.repeat,
+        'results': results,
+    }
+    with open(args.output, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(run, ensure_ascii=False) + '\n')
+    print(f"Результаты записаны в {args.output}")
+
+
+if __name__ == '__main__':
+    main()
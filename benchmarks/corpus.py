@@ -0,0 +1,170 @@
+import os
+import random
+import zipfile
+from collections import namedtuple
+
+from gcode_parser import GRAMS_PER_METER
+
+# Детерминированный синтетический корпус G-code для бенчмарков. Для каждого
+# слайсера генерируются заголовок/подвал в его формате и тело из слоев
+# с движениями G1, так что ожидаемые вес и время известны заранее
+
+DIALECTS = ('bambu', 'orca', 'prusa', 'cura', 'simplify3d', '3mf')
+DEFAULT_SIZES = ('100K', '1M', '10M', '100M')
+_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+CorpusFile = namedtuple('CorpusFile', ['dialect', 'size', 'path', 'weight_grams', 'time_hours'])
+
+
+def parse_size(value):
+    value = value.strip().upper()
+    if value[-1] in _UNITS:
+        return int(float(value[:-1]) * _UNITS[value[-1]])
+    return int(value)
+
+
+def format_size(size):
+    for unit in ('G', 'M', 'K'):
+        if size >= _UNITS[unit] and size % _UNITS[unit] == 0:
+            return f"{size // _UNITS[unit]}{unit}"
+    return str(size)
+
+
+def _duration(seconds):
+    hours, rest = divmod(int(seconds), 3600)
+    return f"{hours}h {rest // 60}m {rest % 60}s"
+
+
+def _header(dialect, weight, seconds):
+    length = weight / 2.98 * 1000
+    if dialect == 'bambu':
+        return (
+            "; HEADER_BLOCK_START\n"
+            "; BambuStudio 01.08.04.51\n"
+            f"; model printing time: {_duration(seconds * 0.95)}; total estimated time: {_duration(seconds)}\n"
+            "; total layer number: 250\n"
+            f"; total filament length [mm] : {length:.2f}\n"
+            f"; total filament weight [g] : {weight:.2f}\n"
+            "; HEADER_BLOCK_END\n\n"
+            "; THUMBNAIL_BLOCK_START\n" + "; " + "A" * 76 + "\n" + "; THUMBNAIL_BLOCK_END\n"
+        )
+    if dialect == 'orca':
+        return "; HEADER_BLOCK_START\n; generated by OrcaSlicer 2.1.1 on 2024-05-01 at 12:00:00\n; total layer number: 250\n; HEADER_BLOCK_END\n"
+    if dialect == 'prusa':
+        return "; generated by PrusaSlicer 2.7.1+win64 on 2024-05-01 at 12:00:00 UTC\n\n"
+    if dialect == 'cura':
+        return (
+            ";FLAVOR:Marlin\n"
+            f";TIME:{int(seconds)}\n"
+            # Cura пишет только длину - парсер переводит ее в граммы по GRAMS_PER_METER
+            f";Filament used: {weight / GRAMS_PER_METER:.5f}m\n"
+            ";Layer height: 0.2\n"
+            ";Generated with Cura_SteamEngine 5.6.0\n"
+        )
+    if dialect == 'simplify3d':
+        return "; G-Code generated by Simplify3D(R) Version 4.1.2\n; Jul 1, 2024 at 12:00:00 PM\n"
+    raise ValueError(dialect)
+
+
+def _footer(dialect, weight, seconds):
+    length = weight / 2.98 * 1000
+    if dialect in ('bambu', 'orca', 'prusa'):
+        return (
+            f"; filament used [mm] = {length:.2f}\n"
+            f"; filament used [cm3] = {weight / 1.24:.2f}\n"
+            f"; filament used [g] = {weight:.2f}\n"
+            f"; total filament used [g] = {weight:.2f}\n"
+            f"; estimated printing time (normal mode) = {_duration(seconds)}\n"
+            f"; estimated printing time (silent mode) = {_duration(seconds * 1.3)}\n"
+        )
+    if dialect == 'simplify3d':
+        hours, rest = divmod(int(seconds), 3600)
+        return (
+            ";   Build Summary\n"
+            f";   Build time: {hours} hours {rest // 60} minutes\n"
+            f";   Filament length: {length:.1f} mm ({length / 1000:.2f} m)\n"
+            f";   Plastic weight: {weight:.2f} g ({weight / 453.6:.2f} lb)\n"
+        )
+    return ""
+
+
+def _layer_blocks(dialect, rng, count=64, moves=400):
+    # Набор блоков-слоев, из которых собирается тело файла
+    blocks = []
+    for layer in range(count):
+        z = 0.2 * (layer + 1)
+        if dialect == 'cura':
+            lines = [f";LAYER:{layer}\n", ";TYPE:WALL-OUTER\n"]
+        elif dialect == 'simplify3d':
+            lines = [f"; layer {layer + 1}, Z = {z:.3f}\n", "; feature outer perimeter\n"]
+        else:
+            lines = [";LAYER_CHANGE\n", f";Z:{z:.2f}\n", ";TYPE:External perimeter\n"]
+        lines.append(f"G1 Z{z:.3f} F600\n")
+        x, y = 100.0, 100.0
+        for _ in range(moves):
+            x += rng.uniform(-5, 5)
+            y += rng.uniform(-5, 5)
+            lines.append(f"G1 X{x:.3f} Y{y:.3f} E{rng.uniform(0.01, 0.2):.5f}\n")
+        blocks.append(''.join(lines).encode())
+    return blocks
+
+
+def write_gcode(f, dialect, size, weight, seconds, seed=0):
+    rng = random.Random(f"{seed}:{dialect}")
+    header = _header(dialect, weight, seconds).encode()
+    footer = _footer(dialect, weight, seconds).encode()
+    f.write(header)
+    written = len(header) + len(footer)
+    blocks = _layer_blocks(dialect, rng)
+    index = 0
+    while written < size:
+        block = blocks[index % len(blocks)]
+        block = block[:size - written] if written + len(block) > size else block
+        # Не обрываем строку на границе
+        cut = block.rfind(b'\n') + 1 or len(block)
+        f.write(block[:cut])
+        written += cut
+        index += 1
+    f.write(footer)
+
+
+def _expected(dialect, size):
+    # Вес и время растут с размером файла, но не зависят от платформы
+    megabytes = max(size / _UNITS['M'], 0.1)
+    return round(10 + 3.7 * megabytes, 2), int(1800 + 600 * megabytes)
+
+
+def _slice_info(weight, seconds):
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n<config>\n  <header/>\n  <plate>\n'
+        '    <metadata key="index" value="1"/>\n'
+        f'    <metadata key="prediction" value="{seconds}"/>\n'
+        f'    <metadata key="weight" value="{weight:.2f}"/>\n'
+        f'    <filament id="1" type="PLA" used_m="{weight / 2.98:.2f}" used_g="{weight:.2f}"/>\n'
+        '  </plate>\n</config>\n'
+    )
+
+
+# Генерация (или повторное использование) файла корпуса
+def ensure_file(directory, dialect, size, seed=0):
+    os.makedirs(directory, exist_ok=True)
+    weight, seconds = _expected(dialect, size)
+    extension = '3mf' if dialect == '3mf' else 'gcode'
+    path = os.path.join(directory, f"{dialect}-{format_size(size)}-{seed}.{extension}")
+    if not os.path.exists(path):
+        tmp_path = path + '.tmp'
+        if dialect == '3mf':
+            with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr('Metadata/slice_info.config', _slice_info(weight, seconds))
+                with archive.open('Metadata/plate_1.gcode', 'w', force_zip64=True) as member:
+                    write_gcode(member, 'bambu', size, weight, seconds, seed)
+        else:
+            with open(tmp_path, 'wb') as f:
+                write_gcode(f, dialect, size, weight, seconds, seed)
+        os.replace(tmp_path, path)
+    return CorpusFile(dialect, size, path, weight, seconds / 3600)
+
+
+def build_corpus(directory, dialects=DIALECTS, sizes=DEFAULT_SIZES, seed=0):
+    return [ensure_file(directory, dialect, parse_size(size), seed)
+            for size in sizes for dialect in dialects]
@@ -0,0 +1,94 @@
+import itertools
+from datetime import datetime
+
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import EditMessageText, GetFile, SendDocument, SendMessage
+from aiogram.types import CallbackQuery, Chat, Document, File, Message, Update, User
+
+# Фейковая сессия Bot API без сети: отвечает на методы бота правдоподобными
+# объектами и отдает "скачиваемые" файлы с диска или из памяти
+
+
+class FakeSession(BaseSession):
+    def __init__(self, chunk_size=64 * 1024):
+        super().__init__()
+        self.chunk_size = chunk_size
+        self.files = {}
+        self.calls = []
+        self._message_ids = itertools.count(1)
+
+    # Регистрация файла: путь на диске или bytes. Возвращает Document для апдейта
+    def add_file(self, file_name, source, size=None):
+        file_id = f"file{len(self.files)}"
+        self.files[file_id] = source
+        if size is None:
+            size = len(source) if isinstance(source, (bytes, bytearray)) else None
+        return Document(file_id=file_id, file_unique_id=f"unique-{file_id}", file_name=file_name, file_size=size)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls.append(method)
+        if isinstance(method, GetFile):
+            return File(file_id=method.file_id, file_unique_id=f"unique-{method.file_id}", file_path=method.file_id)
+        if isinstance(method, (SendMessage, EditMessageText, SendDocument)):
+            chat_id = getattr(method, 'chat_id', None) or 0
+            return Message(
+                message_id=next(self._message_ids),
+                date=datetime.now(),
+                chat=Chat(id=int(chat_id), type='private'),
+                text=getattr(method, 'text', None)
+            ).as_(bot)
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        source = self.files[url.rsplit('/', 1)[-1]]
+        if isinstance(source, (bytes, bytearray)):
+            for start in range(0, len(source), self.chunk_size):
+                yield source[start:start + self.chunk_size]
+            return
+        with open(source, 'rb') as f:
+            while chunk := f.read(self.chunk_size):
+                yield chunk
+
+    async def close(self):
+        pass
+
+    def sent_texts(self):
+        return [m.text for m in self.calls if isinstance(m, (SendMessage, EditMessageText))]
+
+
+_update_ids = itertools.count(1)
+
+
+def _user(user_id):
+    return User(id=user_id, is_bot=False, first_name=f"user{user_id}")
+
+
+def _message(user_id, **fields):
+    return Message(
+        message_id=next(_update_ids),
+        date=datetime.now(),
+        chat=Chat(id=user_id, type='private'),
+        from_user=_user(user_id),
+        **fields
+    )
+
+
+# Апдейты Telegram для Dispatcher.feed_update
+def text_update(user_id, text):
+    return Update(update_id=next(_update_ids), message=_message(user_id, text=text))
+
+
+def document_update(user_id, document, media_group_id=None):
+    return Update(update_id=next(_update_ids),
+                  message=_message(user_id, document=document, media_group_id=media_group_id))
+
+
+def callback_update(user_id, data):
+    update_id = next(_update_ids)
+    return Update(update_id=update_id, callback_query=CallbackQuery(
+        id=str(update_id),
+        from_user=_user(user_id),
+        chat_instance=str(user_id),
+        message=_message(user_id, text="menu"),
+        data=data
+    ))
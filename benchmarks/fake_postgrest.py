@@ -0,0 +1,165 @@
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+from collections import defaultdict
+
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# Заменитель PostgREST (Supabase) для проверки синхронизации без сети: таблицы
+# в памяти, upsert по on_conflict, delete и выборка по фильтрам eq/gt/in.
+# fail_next - сколько следующих запросов ответить 503 (проверка повторов)
+#
+#   python -m benchmarks.fake_postgrest --prints 5000 --fail 3
+
+
+def _parse_value(text):
+    if len(text) >= 2 and text[0] == text[-1] == '"':
+        return text[1:-1]
+    return text
+
+
+def _matches(row, column, expression):
+    operator, _, value = expression.partition('.')
+    current = row.get(column)
+    if operator == 'in':
+        return str(current) in {_parse_value(item) for item in value.strip('()').split(',')}
+    if operator == 'eq':
+        return str(current) == value
+    if operator == 'gt':
+        return current is not None and float(current) > float(value)
+    raise web.HTTPBadRequest(text=f"unsupported operator {operator}")
+
+
+class FakePostgrest:
+    def __init__(self):
+        # таблица -> {значение ключа конфликта: строка}
+        self.tables = defaultdict(dict)
+        self.requests = []
+        self.idempotency_keys = []
+        self.fail_next = 0
+
+    def _filters(self, request):
+        return [(column, value) for column, value in request.query.items()
+                if column not in ('on_conflict', 'select', 'order')]
+
+    async def handle(self, request):
+        table = request.match_info['table']
+        self.requests.append((request.method, table))
+        if self.fail_next:
+            self.fail_next -= 1
+            return web.Response(status=503, text="unavailable")
+        if 'Idempotency-Key' in request.headers:
+            self.idempotency_keys.append(request.headers['Idempotency-Key'])
+
+        rows = self.tables[table]
+        if request.method == 'POST':
+            key = request.query.get('on_conflict', 'id')
+            body = await request.json()
+            for row in body if isinstance(body, list) else [body]:
+                if row[key] in rows and 'merge-duplicates' not in request.headers.get('Prefer', ''):
+                    return web.json_response({'message': 'duplicate key'}, status=409)
+                rows[row[key]] = {**rows.get(row[key], {}), **row}
+            return web.Response(status=201)
+
+        filters = self._filters(request)
+        selected = [key for key, row in rows.items() if all(_matches(row, c, e) for c, e in filters)]
+        if request.method == 'DELETE':
+            for key in selected:
+                del rows[key]
+            return web.Response(status=204)
+        result = [rows[key] for key in selected]
+        if request.query.get('order', '').startswith('sync_version'):
+            result.sort(key=lambda row: row.get('sync_version', 0))
+        return web.json_response(result)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_route('*', '/rest/v1/{table}', self.handle)
+        return app
+
+
+# Сервер на свободном локальном порту; возвращает (runner, адрес)
+async def start(fake):
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner, f"http://127.0.0.1:{port}"
+
+
+# Проверка: база с печатями -> синхронизация со сбоями -> изменения и удаления ->
+# повторная синхронизация; в конце содержимое заменителя сверяется с базой
+async def check(prints, failures, workdir):
+    from database import Database
+    from migrations import apply_migrations
+    from supabase_sync import SYNC_TABLES, SupabaseSync, remote_key
+
+    database = Database(os.path.join(workdir, 'sync.db'))
+    await database.open()
+    await apply_migrations(database)
+    fake = FakePostgrest()
+    runner, url = await start(fake)
+    sync = SupabaseSync(database, url, 'test-key', retries=failures + 1)
+    try:
+        async with database.transaction() as db:
+            await db.execute("INSERT INTO printer_settings (user_id) VALUES ('1')")
+            await db.execute("INSERT INTO spools (user_id, name, cost, weight, price_per_gram) VALUES ('1', 'PLA', 1500, 1000, 1.5)")
+            await db.executemany('''
+                INSERT INTO prints (user_id, date, name, spool_name, weight, hours, sale_price, material_cost,
+                    electricity_cost_calc, amortization, total_cost, profit)
+                VALUES ('1', '2024-01-01', ?, 'PLA', 10, 1, 100, 15, 2, 3, 20, 80)
+            ''', [(f"print {i}",) for i in range(prints)])
+
+        fake.fail_next = failures
+        print(f"Первая синхронизация: {await sync.push()} изменений, запросов {len(fake.requests)}")
+
+        async with database.transaction() as db:
+            await db.execute("UPDATE prints SET sale_price = 150 WHERE id % 10 = 0")
+            await db.execute("DELETE FROM prints WHERE id % 7 = 0")
+            await db.execute("UPDATE printer_settings SET printer_cost = 60000")
+        fake.requests.clear()
+        print(f"Повторная синхронизация: {await sync.push()} изменений, запросов {len(fake.requests)}")
+        print(f"Без изменений: {await sync.push()} изменений")
+
+        mismatched = 0
+        for table in SYNC_TABLES:
+            rows = await database.fetchall(f"SELECT {', '.join(table.columns)} FROM {table.name}")
+            local = {remote_key(table, row[0]): dict(zip(table.columns, row)) for row in rows}
+            remote = fake.tables[table.name]
+            if local.keys() != remote.keys():
+                mismatched += 1
+                continue
+            for key, row in local.items():
+                if any(remote[key][column] != value for column, value in row.items() if column != table.key):
+                    mismatched += 1
+                    break
+            print(f"{table.name}: локально {len(local)}, в заменителе {len(remote)}")
+        print("Совпадает" if not mismatched else f"Расхождения в {mismatched} таблицах")
+        return not mismatched
+    finally:
+        await sync.close()
+        await runner.cleanup()
+        await database.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Проверка синхронизации с заменителем PostgREST")
+    parser.add_argument('--prints', type=int, default=2000, help="печатей в тестовой базе")
+    parser.add_argument('--fail', type=int, default=2, help="сколько первых запросов ответить 503")
+    args = parser.parse_args(argv)
+    with tempfile.TemporaryDirectory() as workdir:
+        ok = asyncio.run(check(args.prints, args.fail, workdir))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
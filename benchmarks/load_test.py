@@ -0,0 +1,316 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks.corpus import ensure_file, format_size, parse_size
+
+# Нагрузочный тест: настоящий dp из bot.py с фейковой сессией Bot API (без
+# сети) и виртуальные пользователи, которые проходят сценарии - меню, формы
+# катушки и печати, загрузку G-code заданного размера. Пользователь шлет
+# апдейты по одному (как Telegram в одном чате), одновременно активны
+# --concurrency пользователей. Отчет: пропускная способность, p50/p95/p99
+# времени обработки апдейта и ожидание соединений с базой. Прогоны
+# дописываются в JSON Lines и сравниваются между собой
+#
+#   python -m benchmarks.load_test --users 200 --concurrency 32
+#   python -m benchmarks.load_test --mix menu=1,upload=1 --file-size 10M
+#   python -m benchmarks.load_test --compare load_results.jsonl
+
+DEFAULT_OUTPUT = os.path.join(ROOT, 'load_results.jsonl')
+DEFAULT_CORPUS = os.path.join(ROOT, 'benchmarks', '.corpus')
+DEFAULT_MIX = 'menu=5,print=3,spool=1,upload=1'
+PERCENTILES = (50, 95, 99)
+
+
+# Сценарии: апдейты одного прохода пользователя user_id
+def menu_updates(user_id, files):
+    from benchmarks.fake_bot import callback_update, text_update
+
+    return [
+        text_update(user_id, '/start'),
+        callback_update(user_id, 'dashboard'),
+        callback_update(user_id, 'spools'),
+        callback_update(user_id, 'settings'),
+        callback_update(user_id, 'back'),
+    ]
+
+
+def spool_updates(user_id, files):
+    from benchmarks.fake_bot import callback_update, text_update
+
+    return [
+        callback_update(user_id, 'add_spool'),
+        text_update(user_id, 'PLA Белый'),
+        text_update(user_id, '1500'),
+        text_update(user_id, '1000'),
+    ]
+
+
+def print_updates(user_id, files):
+    from benchmarks.fake_bot import callback_update, text_update
+
+    return [
+        callback_update(user_id, 'add_print'),
+        text_update(user_id, 'Деталь'),
+        callback_update(user_id, 'manual_input'),
+        text_update(user_id, '1'),
+        text_update(user_id, '50'),
+        text_update(user_id, '5.5'),
+        text_update(user_id, '500'),
+    ]
+
+
+# Новый документ на каждую загрузку - без попаданий в кэш разбора
+def upload_updates(user_id, files):
+    from benchmarks.fake_bot import callback_update, document_update
+
+    return [
+        callback_update(user_id, 'calculator'),
+        document_update(user_id, files()),
+    ]
+
+
+SCENARIOS = {'menu': menu_updates, 'spool': spool_updates, 'print': print_updates, 'upload': upload_updates}
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise ValueError(f"Неизвестный сценарий: {name}")
+        mix[name] = float(weight or 1)
+    if not any(mix.values()):
+        raise ValueError("Нужен хотя бы один сценарий с ненулевым весом")
+    return mix
+
+
+# Сценарии каждого пользователя: сначала катушка (без нее печать не добавить),
+# затем iterations случайных по весам mix
+def user_plans(users, iterations, mix, seed):
+    rng = random.Random(seed)
+    names, weights = list(mix), list(mix.values())
+    return {
+        user_id: ['spool'] + rng.choices(names, weights, k=iterations)
+        for user_id in range(1, users + 1)
+    }
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))]
+
+
+def _latency_summary(latencies):
+    ordered = sorted(latencies)
+    summary = {'updates': len(ordered)}
+    for q in PERCENTILES:
+        value = percentile(ordered, q)
+        summary[f'p{q}_ms'] = round(value * 1000, 3) if value is not None else None
+    summary['max_ms'] = round(ordered[-1] * 1000, 3) if ordered else None
+    return summary
+
+
+async def run_load(plans, concurrency, file_size, corpus_dir, workdir):
+    os.environ.setdefault('BOT_TOKEN', '42:LOADTEST')
+    # Виртуальные пользователи шлют апдейты быстрее живых - без ограничения частоты
+    os.environ.setdefault('THROTTLE_RATE', '1000000')
+    os.environ.setdefault('THROTTLE_FILES_PER_MINUTE', '1000000')
+    os.chdir(workdir)
+    import bot as bot_module
+    from benchmarks.fake_bot import FakeSession
+
+    session = FakeSession()
+    bot_module.bot.session = session
+    database = bot_module.database
+    await database.open()
+    await bot_module.init_db()
+    bot_module.parse_pool.start()
+    # Прогрев пула, чтобы не мерить запуск процессов
+    await bot_module.parse_pool.run('warmup', os.getpid)
+
+    corpus_file = ensure_file(corpus_dir, 'prusa', file_size)
+
+    def new_document():
+        return session.add_file(os.path.basename(corpus_file.path), corpus_file.path, os.path.getsize(corpus_file.path))
+
+    latencies = defaultdict(list)
+    errors = Counter()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_user(user_id, scenarios):
+        async with semaphore:
+            for scenario in scenarios:
+                for update in SCENARIOS[scenario](user_id, new_document):
+                    started = time.perf_counter()
+                    try:
+                        await bot_module.dp.feed_update(bot_module.bot, update)
+                    except Exception:
+                        errors[scenario] += 1
+                    latencies[scenario].append(time.perf_counter() - started)
+
+    waits_before = (Counter(database.waits), Counter(database.wait_seconds))
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(run_user(user_id, scenarios) for user_id, scenarios in plans.items()))
+        elapsed = time.perf_counter() - started
+
+        # Проверка, что формы дошли до конца: по катушке и печати на каждый проход
+        expected = Counter(scenario for scenarios in plans.values() for scenario in scenarios)
+        spools = (await database.fetchone('SELECT COUNT(*) FROM spools'))[0]
+        prints = (await database.fetchone('SELECT COUNT(*) FROM prints'))[0]
+    finally:
+        bot_module.parse_pool.shutdown()
+        await database.close()
+
+    total = [value for values in latencies.values() for value in values]
+    db_wait = {}
+    for connection in ('writer', 'reader'):
+        waits = database.waits[connection] - waits_before[0][connection]
+        seconds = database.wait_seconds[connection] - waits_before[1][connection]
+        db_wait[connection] = {
+            'waits': waits,
+            'total_s': round(seconds, 3),
+            'mean_ms': round(seconds / waits * 1000, 3) if waits else 0.0,
+            'max_ms': round(database.wait_max[connection] * 1000, 3),
+        }
+    return {
+        'users': len(plans),
+        'concurrency': concurrency,
+        'file_size': format_size(file_size),
+        'seconds': round(elapsed, 3),
+        'updates_per_s': round(len(total) / elapsed, 1) if elapsed else None,
+        'latency': _latency_summary(total),
+        'scenarios': {name: _latency_summary(values) for name, values in sorted(latencies.items())},
+        'db_wait': db_wait,
+        'errors': sum(errors.values()),
+        'lost': {
+            'spool': expected['spool'] - spools,
+            'print': expected['print'] - prints,
+        },
+        'bot_api_calls': len(session.calls),
+    }
+
+
+def _ms(value):
+    return f"{value:>9.2f}" if value is not None else f"{'-':>9}"
+
+
+def report(result):
+    print(f"Пользователей: {result['users']}, одновременно: {result['concurrency']}, "
+          f"файл: {result['file_size']}")
+    print(f"Апдейтов: {result['latency']['updates']} за {result['seconds']:.2f} с "
+          f"({result['updates_per_s']} апдейтов/с), вызовов Bot API: {result['bot_api_calls']}")
+    print(f"{'':<8} {'апдейтов':>9} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} {'max, мс':>9}")
+    for name, summary in [('все', result['latency']), *result['scenarios'].items()]:
+        print(f"{name:<8} {summary['updates']:>9} {_ms(summary['p50_ms'])} {_ms(summary['p95_ms'])} "
+              f"{_ms(summary['p99_ms'])} {_ms(summary['max_ms'])}")
+    for connection, wait in result['db_wait'].items():
+        print(f"Ожидание базы ({connection}): {wait['waits']} раз, всего {wait['total_s']:.3f} с, "
+              f"среднее {wait['mean_ms']:.3f} мс, максимум {wait['max_ms']:.3f} мс")
+    lost = {name: count for name, count in result['lost'].items() if count}
+    if result['errors'] or lost:
+        print(f"⚠️ Ошибок в обработчиках: {result['errors']}, недописанных форм: {lost or 0}")
+
+
+def _git_commit():
+    import subprocess
+
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Сравнение двух последних прогонов из файла результатов
+def compare(path):
+    with open(path, encoding='utf-8') as f:
+        runs = [json.loads(line) for line in f if line.strip()]
+    if len(runs) < 2:
+        print("Нужно минимум два прогона для сравнения")
+        return
+    previous, current = runs[-2], runs[-1]
+    print(f"{previous.get('commit')} ({previous['started_at']}) -> {current.get('commit')} ({current['started_at']})")
+    if previous['config'] != current['config']:
+        print(f"⚠️ Разные параметры прогонов: {previous['config']} -> {current['config']}")
+
+    def line(label, old, new):
+        change = f" ({(new - old) / old * 100:+.1f}%)" if old else ""
+        print(f"{label:<20} {old:>10.2f} -> {new:>10.2f}{change}")
+
+    line('апдейтов/с', previous['result']['updates_per_s'], current['result']['updates_per_s'])
+    for q in PERCENTILES:
+        line(f'p{q}, мс', previous['result']['latency'][f'p{q}_ms'], current['result']['latency'][f'p{q}_ms'])
+    line('ожидание записи, с', previous['result']['db_wait']['writer']['total_s'],
+         current['result']['db_wait']['writer']['total_s'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на фейковой сессии Bot API")
+    parser.add_argument('--users', type=int, default=100, help="виртуальных пользователей")
+    parser.add_argument('--concurrency', type=int, default=16, help="одновременно активных пользователей")
+    parser.add_argument('--iterations', type=int, default=5, help="сценариев на пользователя (после катушки)")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f"веса сценариев {', '.join(SCENARIOS)} ({DEFAULT_MIX})")
+    parser.add_argument('--file-size', default='100K', help="размер загружаемого G-code, например 100K, 10M")
+    parser.add_argument('--seed', type=int, default=0, help="зерно выбора сценариев")
+    parser.add_argument('--corpus-dir', default=DEFAULT_CORPUS, help="каталог для сгенерированных файлов")
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help="файл результатов (JSON Lines)")
+    parser.add_argument('--compare', metavar='RESULTS', help="сравнить два последних прогона и выйти")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(args.compare)
+        return
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    plans = user_plans(args.users, args.iterations, mix, args.seed)
+    started_at = datetime.now(timezone.utc).isoformat()
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        try:
+            result = asyncio.run(run_load(
+                plans, args.concurrency, parse_size(args.file_size), os.path.abspath(args.corpus_dir), workdir
+            ))
+        finally:
+            os.chdir(cwd)
+    report(result)
+
+    run = {
+        'started_at': started_at,
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': {
+            'users': args.users, 'concurrency': args.concurrency, 'iterations': args.iterations,
+            'mix': args.mix, 'file_size': args.file_size, 'seed': args.seed,
+            'parse_workers': int(os.getenv('PARSE_WORKERS', 2)),
+        },
+        'result': result,
+    }
+    with open(args.output, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(run, ensure_ascii=False) + '\n')
+    print(f"Результаты записаны в {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# Проверка режима webhook без Telegram: записанные апдейты (JSON Lines, по
+# одному объекту Update на строку, как их присылает Telegram) отправляются
+# POST-запросами на сервер. Без --url сервер поднимается в этом же процессе
+# с фейковой сессией Bot API, ответы бота никуда не уходят
+#
+#   python -m benchmarks.webhook_replay updates.jsonl --concurrency 16
+#   python -m benchmarks.webhook_replay --demo 200
+#   python -m benchmarks.webhook_replay updates.jsonl --url http://127.0.0.1:8080/webhook --secret S
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def load_updates(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# Демо-сценарий: пользователи открывают меню, сводку и катушки
+def demo_updates(users):
+    from benchmarks.fake_bot import callback_update, text_update
+
+    updates = []
+    for user_id in range(1, users + 1):
+        updates.append(text_update(user_id, '/start'))
+        updates.append(callback_update(user_id, 'dashboard'))
+        updates.append(callback_update(user_id, 'spools'))
+    return [json.loads(update.model_dump_json(exclude_none=True, by_alias=True)) for update in updates]
+
+
+async def post_updates(url, updates, concurrency, secret=None):
+    headers = {SECRET_HEADER: secret} if secret else {}
+    statuses = Counter()
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with aiohttp.ClientSession(headers=headers) as session:
+        async def post(update):
+            async with semaphore:
+                started = time.perf_counter()
+                async with session.post(url, json=update) as response:
+                    await response.read()
+                    statuses[response.status] += 1
+                latencies.append(time.perf_counter() - started)
+
+        await asyncio.gather(*(post(update) for update in updates))
+    return statuses, latencies
+
+
+# Ожидание, пока сервер доработает все принятые апдейты
+async def wait_idle(health_url, timeout=60):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            async with session.get(health_url) as response:
+                if (await response.json())['in_flight'] == 0:
+                    return True
+            await asyncio.sleep(0.05)
+    return False
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _report(updates, statuses, latencies, elapsed):
+    ordered = sorted(latencies)
+    print(f"Апдейтов: {len(updates)}, статусы: {dict(statuses)}")
+    print(f"Ответ webhook: медиана {statistics.median(ordered) * 1000:.2f} мс, "
+          f"p95 {ordered[int(len(ordered) * 0.95) - 1] * 1000:.2f} мс")
+    print(f"Обработано за {elapsed:.2f} с ({len(updates) / elapsed:.0f} апдейтов/с)")
+
+
+async def replay_local(updates, concurrency, workdir):
+    os.environ.setdefault('BOT_TOKEN', '42:WEBHOOK')
+    # Апдейты идут подряд быстрее живого пользователя - без ограничения частоты
+    os.environ.setdefault('THROTTLE_RATE', '1000000')
+    os.environ.setdefault('THROTTLE_FILES_PER_MINUTE', '1000000')
+    os.chdir(workdir)
+    import bot as bot_module
+    import webhook
+    from aiohttp import web
+    from benchmarks.fake_bot import FakeSession
+
+    session = FakeSession()
+    bot_module.bot.session = session
+    await bot_module.database.open()
+    await bot_module.init_db()
+    bot_module.parse_pool.start()
+
+    app = webhook.create_app(bot_module.bot, bot_module.dp)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    port = _free_port()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    base = f"http://127.0.0.1:{port}"
+    try:
+        started = time.perf_counter()
+        statuses, latencies = await post_updates(base + webhook.WEBHOOK_PATH, updates, concurrency, webhook.WEBHOOK_SECRET)
+        idle = await wait_idle(base + webhook.HEALTH_PATH)
+        elapsed = time.perf_counter() - started
+        _report(updates, statuses, latencies, elapsed)
+        print(f"Вызовов Bot API: {len(session.calls)}" + ("" if idle else " (сервер не успел доработать)"))
+    finally:
+        await runner.cleanup()
+        bot_module.parse_pool.shutdown()
+        await bot_module.database.close()
+
+
+async def replay_remote(url, updates, concurrency, secret):
+    started = time.perf_counter()
+    statuses, latencies = await post_updates(url, updates, concurrency, secret)
+    _report(updates, statuses, latencies, time.perf_counter() - started)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Отправка записанных апдейтов на webhook")
+    parser.add_argument('updates', nargs='?', help="файл JSON Lines с апдейтами Telegram")
+    parser.add_argument('--demo', type=int, metavar='USERS', help="сгенерировать демо-апдейты для USERS пользователей")
+    parser.add_argument('--url', help="адрес запущенного сервера (по умолчанию - локальный с фейковой сессией)")
+    parser.add_argument('--secret', help="секрет webhook для заголовка запроса")
+    parser.add_argument('--concurrency', type=int, default=8, help="одновременных запросов")
+    args = parser.parse_args(argv)
+
+    if args.updates:
+        updates = load_updates(args.updates)
+    elif args.demo:
+        updates = demo_updates(args.demo)
+    else:
+        parser.error("укажите файл апдейтов или --demo")
+
+    if args.url:
+        asyncio.run(replay_remote(args.url, updates, args.concurrency, args.secret))
+        return
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        try:
+            asyncio.run(replay_local(updates, args.concurrency, workdir))
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,42 @@
 import os
 import logging
-import re
-import aiosqlite
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import Command, CommandObject
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile, FSInputFile
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from datetime import datetime
 import asyncio
+from contextlib import ExitStack
 from dotenv import load_dotenv
+from workers import ParsePool, ParseCancelled, parse_print_file
+from parse_cache import ParseCache, content_keys
+from database import Database
+from migrations import apply_migrations
+from stats import get_user_stats, get_month_stats, get_spool_usage, rebuild_user_stats
+from printer_settings import SettingsStore
+from costs import calculate_cost, quote_matrix, DEFAULT_MARGINS, DEFAULT_PRICE_PER_GRAM
+from downloads import FileTooLarge, download, format_megabytes
+from webhook import run_webhook
+from fsm_storage import count_states, create_storage
+from supabase_sync import SUPABASE_KEY, SUPABASE_URL, SYNC_ENABLED, SupabaseSync
+from metrics import METRICS_PORT, PARSE_SECONDS, HandlerMetricsMiddleware, registry, start_metrics_server
+from throttling import ThrottlingMiddleware
+from work_queue import PRIORITY_BATCH, PRIORITY_INTERACTIVE, QueueFull, WorkQueue
+import numpy as np
+from motion import FILAMENT_DIAMETER, filament_grams, guess_density
+from export import export_file_name, parse_export_args, write_export
+from farm import (
+    add_printer, delete_printer, farm_jobs, farm_machines, format_schedule, get_printer, list_printers,
+    plan_farm, set_busy, set_material
+)
+from scheduler import OBJECTIVES
+from layers import analyze_layers, escape_markdown, format_breakdown, load_breakdown, save_breakdown
+from batch import (
+    MESSAGE_ROWS, build_quote, format_quote_table, is_supported, list_archive_members,
+    parse_archive_member, quote_csv
+)
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -21,10 +47,78 @@ logger = logging.getLogger(__name__)
 
 # Инициализация бота
 BOT_TOKEN = os.getenv('BOT_TOKEN')
+# Прием апдейтов: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
 DB_PATH = 'printer_bot.db'
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', 2))
+PARSE_TIMEOUT = float(os.getenv('PARSE_TIMEOUT', 120))
+PARSE_CACHE_BYTES = int(os.getenv('PARSE_CACHE_BYTES', 8 * 1024 * 1024))
+DB_READERS = int(os.getenv('DB_READERS', 2))
+BATCH_MAX_FILES = int(os.getenv('BATCH_MAX_FILES', 500))
+# Сколько ждать остальные файлы альбома (сек)
+MEDIA_GROUP_DELAY = 1.0
+# Сколько катушек показывать в сводке
+DASHBOARD_SPOOLS = 5
+# Сравнение катушек: строк в таблице и дополнительные тарифы на электричество
+# (₽/кВт·ч через запятую, например ночной) помимо тарифа из настроек
+QUOTE_ROWS = 10
+QUOTE_TARIFFS = [float(value) for value in os.getenv('QUOTE_TARIFFS', '').split(',') if value.strip()]
+# Очередь тяжелых задач: одновременно выполняемых и на одного пользователя
+WORK_QUEUE_SLOTS = int(os.getenv('WORK_QUEUE_SLOTS', PARSE_WORKERS * 2))
+WORK_QUEUE_USER_LIMIT = int(os.getenv('WORK_QUEUE_USER_LIMIT', 3))
+# Не чаще раза в столько секунд обновлять место в очереди в сообщении
+QUEUE_EDIT_INTERVAL = 2.0
+# Ограничение частоты: апдейтов в секунду с запасом и файлов в минуту с запасом
+THROTTLE_RATE = float(os.getenv('THROTTLE_RATE', 3))
+THROTTLE_BURST = int(os.getenv('THROTTLE_BURST', 10))
+THROTTLE_FILES_PER_MINUTE = float(os.getenv('THROTTLE_FILES_PER_MINUTE', 20))
+THROTTLE_FILES_BURST = int(os.getenv('THROTTLE_FILES_BURST', 10))
 
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+database = Database(DB_PATH, readers=DB_READERS)
+dp = Dispatcher(storage=create_storage(database))
+parse_pool = ParsePool(
+    workers=PARSE_WORKERS, timeout=PARSE_TIMEOUT,
+    on_parsed=lambda seconds, result: PARSE_SECONDS.observe(seconds, result.dialect or 'unknown')
+)
+parse_cache = ParseCache(database, max_bytes=PARSE_CACHE_BYTES)
+settings_store = SettingsStore(database)
+work_queue = WorkQueue(slots=WORK_QUEUE_SLOTS, user_limit=WORK_QUEUE_USER_LIMIT)
+throttling = ThrottlingMiddleware(THROTTLE_RATE, THROTTLE_BURST, THROTTLE_FILES_PER_MINUTE, THROTTLE_FILES_BURST)
+# Выгрузка изменений в Supabase веб-приложения (SYNC_ENABLED=1)
+supabase_sync = SupabaseSync(database, SUPABASE_URL, SUPABASE_KEY) if SYNC_ENABLED and SUPABASE_URL else None
+dp.update.outer_middleware(throttling)
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+
+# Метрики, которые считаются в момент опроса /metrics
+@registry.collector('bot_cache_hits_total', 'Попадания в кэш', 'counter', ['cache'])
+def cache_hits():
+    return {'parse': parse_cache.hits, 'settings': settings_store.hits}
+
+@registry.collector('bot_cache_misses_total', 'Промахи кэша', 'counter', ['cache'])
+def cache_misses():
+    return {'parse': parse_cache.misses, 'settings': settings_store.misses}
+
+@registry.collector('bot_fsm_states', 'Незавершенные формы по состояниям', 'gauge', ['state'])
+async def fsm_states():
+    return await count_states(dp.storage)
+
+@registry.collector('bot_work_queue_jobs', 'Задачи очереди тяжелых операций', 'gauge', ['status', 'priority'])
+def work_queue_jobs():
+    snapshot = work_queue.snapshot()
+    jobs = {('running', 'all'): snapshot['running']}
+    for priority, waiting in snapshot['waiting'].items():
+        jobs['waiting', priority] = waiting
+    return jobs
+
+@registry.collector('bot_sync_pending_changes', 'Изменения, еще не отправленные в Supabase', 'gauge', ['table'])
+async def sync_pending():
+    return await supabase_sync.pending() if supabase_sync else None
+
+@registry.collector('bot_throttled_total', 'Апдейты, отброшенные ограничением частоты', 'counter')
+def throttled_updates():
+    return throttling.throttled
 
 # States
 class PrintForm(StatesGroup):
@@ -34,6 +128,7 @@ class PrintForm(StatesGroup):
     weight = State()
     hours = State()
     sale_price = State()
+    printer = State()
 
 class SpoolForm(StatesGroup):
     name = State()
@@ -43,111 +138,83 @@ class SpoolForm(StatesGroup):
 class CalculatorState(StatesGroup):
     waiting_file = State()
 
+class SettingsForm(StatesGroup):
+    value = State()
+
+class PrinterForm(StatesGroup):
+    name = State()
+    cost = State()
+    power = State()
+    busy_hours = State()
+    material = State()
+
 # Инициализация базы данных
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Таблица настроек принтера
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS printer_settings (
-                user_id TEXT PRIMARY KEY,
-                printer_cost REAL DEFAULT 50000,
-                amortization_months INTEGER DEFAULT 24,
-                electricity_cost REAL DEFAULT 6,
-                printer_power REAL DEFAULT 0.3,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        # Таблица катушек
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS spools (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                name TEXT NOT NULL,
-                cost REAL NOT NULL,
-                weight REAL NOT NULL,
-                price_per_gram REAL NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        # Таблица печатей
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS prints (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                date DATE NOT NULL,
-                name TEXT NOT NULL,
-                spool_name TEXT NOT NULL,
-                weight REAL NOT NULL,
-                hours REAL NOT NULL,
-                sale_price REAL NOT NULL,
-                material_cost REAL NOT NULL,
-                electricity_cost_calc REAL NOT NULL,
-                amortization REAL NOT NULL,
-                total_cost REAL NOT NULL,
-                profit REAL NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        await db.commit()
-    logger.info("Database initialized successfully")
-
-# Функция парсинга G-code
-def parse_gcode(content: str):
-    weight_grams = None
-    time_hours = None
-    lines = content.split('\n')[:300]  # Увеличил до 300 строк для Bambu Lab
-
-    for line in lines:
-        line = line.strip()
-
-        # Bambu Lab Studio - прямой вес в граммах
-        if 'filament used [g]' in line.lower() or 'total filament used [g]' in line.lower():
-            match = re.search(r'=\s*(\d+\.?\d*)', line)
-            if match:
-                weight_grams = float(match.group(1))
-
-        # Bambu Lab - filament_weight
-        elif 'filament_weight' in line.lower():
-            match = re.search(r'(\d+\.?\d*)', line)
-            if match and not weight_grams:
-                weight_grams = float(match.group(1))
-
-        # PrusaSlicer - вес
-        elif 'filament used [g]' in line.lower():
-            match = re.search(r'(\d+\.?\d*)', line)
-            if match:
-                weight_grams = float(match.group(1))
-
-        # Длина в мм -> вес (для файлов где нет прямого веса)
-        elif ('filament used [mm]' in line.lower() or 'filament used:' in line.lower()) and not weight_grams:
-            match = re.search(r'(\d+\.?\d*)', line)
-            if match:
-                length_mm = float(match.group(1))
-                weight_grams = (length_mm / 1000) * 2.4  # ~2.4г на метр для PLA 1.75мм
-
-        # Время печати - Bambu Lab: estimated printing time (normal mode) = 2h 30m 15s
-        if 'estimated printing time' in line.lower() or 'print time' in line.lower() or 'total time' in line.lower():
-            hours_match = re.search(r'(\d+)h', line)
-            mins_match = re.search(r'(\d+)m', line)
-            secs_match = re.search(r'(\d+)s', line)
-
-            hours = int(hours_match.group(1)) if hours_match else 0
-            minutes = int(mins_match.group(1)) if mins_match else 0
-            seconds = int(secs_match.group(1)) if secs_match else 0
-
-            time_hours = hours + (minutes / 60) + (seconds / 3600)
-
-        # Cura: ;TIME:7200
-        elif line.startswith(';TIME:'):
-            match = re.search(r';TIME:(\d+)', line)
-            if match:
-                time_seconds = int(match.group(1))
-                time_hours = time_seconds / 3600
-
-    return weight_grams, time_hours
+    version = await apply_migrations(database)
+    logger.info(f"Database initialized successfully (schema version {version})")
+
+# Потоковое скачивание файла Telegram: в памяти или во временном файле
+# (закрывает вызывающий, через with)
+async def download_document(file_id, file_name, file_size=None):
+    return await download(bot, file_id, file_name, file_size)
+
+# Скачивание документа и разбор в пуле процессов.
+# Повторно отправленный файл берется из кэша без скачивания
+# Скачивание и разбор ждут слота в очереди тяжелых задач
+async def download_and_parse(user_id, document, on_position=None):
+    result = await parse_cache.get(document.file_unique_id)
+    if result is not None:
+        return result
+
+    async with work_queue.slot(user_id, PRIORITY_INTERACTIVE, on_position):
+        with await download_document(document.file_id, document.file_name, document.file_size) as file:
+            result = await parse_pool.parse(user_id, document.file_name, file.source())
+
+    if result.weight_grams or result.time_hours:
+        await parse_cache.put(document.file_unique_id, result)
+    return result
+
+# Место в очереди в сообщении "⏳ ...". Сообщение правится не чаще
+# раза в QUEUE_EDIT_INTERVAL секунд, ошибки правки не важны
+def show_queue_position(processing_msg, text):
+    edited_at = None
+
+    async def on_position(position):
+        nonlocal edited_at
+        now = asyncio.get_running_loop().time()
+        if edited_at is not None and now - edited_at < QUEUE_EDIT_INTERVAL:
+            return
+        edited_at = now
+        try:
+            await processing_msg.edit_text(f"{text}\n🕒 Место в очереди: {position}")
+        except TelegramBadRequest:
+            pass
+    return on_position
+
+def queue_full_text(error):
+    return f"⏳ Слишком много файлов в обработке (не больше {error.limit}). Дождитесь результата и отправьте снова."
+
+# Состояния, в которых пользователь ждет разбора отправленного файла
+UPLOAD_STATES = {CalculatorState.waiting_file.state, PrintForm.gcode_or_manual.state}
+
+# Отмена разбора файла, только если пользователь ушел из ожидания файла:
+# кнопкой "Назад" или в другое состояние. Прочие кнопки и сообщения
+# (выгрузка, меню) разбор не прерывают. Документы не отменяют ничего:
+# следующий файл альбома или пакета не должен снимать предыдущий
+@dp.callback_query.outer_middleware()
+@dp.message.outer_middleware()
+async def cancel_parse_on_leave(handler, event, data):
+    state = data.get('state')
+    if state is None or getattr(event, 'document', None) or not event.from_user:
+        return await handler(event, data)
+    before = await state.get_state()
+    result = await handler(event, data)
+    if before in UPLOAD_STATES:
+        back = isinstance(event, types.CallbackQuery) and event.data == "back"
+        if back or await state.get_state() != before:
+            parse_pool.cancel(str(event.from_user.id))
+            work_queue.cancel(str(event.from_user.id))
+    return result
 
 # Главное меню
 def main_menu():
@@ -160,23 +227,34 @@ def main_menu():
     ])
     return keyboard
 
+# Слоты филамента с ненулевым весом: [(номер слота, граммы), ...]
+def used_slots(filaments):
+    return [(slot, grams) for slot, grams in enumerate(filaments, 1) if grams]
+
+# Список катушек для выбора по номеру
+def spools_text(spools, title="🧵 Выберите катушку (отправьте номер):"):
+    text = f"{title}\n\n"
+    for idx, spool in enumerate(spools, 1):
+        text += f"{idx}. {spool[2]} ({spool[5]:.2f} ₽/г)\n"
+    return text
+
+# Катушки пользователя по id в том же порядке (None - удаленная катушка).
+# В состоянии FSM хранятся только id, строки читаются из базы
+async def load_spools(user_id, spool_ids):
+    placeholders = ','.join('?' * len(spool_ids))
+    rows = await database.fetchall(
+        f'SELECT * FROM spools WHERE user_id = ? AND id IN ({placeholders})', (user_id, *spool_ids)
+    )
+    by_id = {row[0]: row for row in rows}
+    return [by_id.get(spool_id) for spool_id in spool_ids]
+
 # /start
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
     user_id = str(message.from_user.id)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Проверяем есть ли настройки пользователя
-        async with db.execute('SELECT * FROM printer_settings WHERE user_id = ?', (user_id,)) as cursor:
-            settings = await cursor.fetchone()
-
-        if not settings:
-            # Создаем настройки по умолчанию
-            await db.execute('''
-                INSERT INTO printer_settings (user_id, printer_cost, amortization_months, electricity_cost, printer_power)
-                VALUES (?, 50000, 24, 6, 0.3)
-            ''', (user_id,))
-            await db.commit()
+    # Загружаем настройки пользователя (создаются по умолчанию при первом запуске)
+    await settings_store.get(user_id)
 
     await message.answer(
         "🖨️ *Калькулятор заработка 3D принтера*\n\n"
@@ -201,39 +279,53 @@ async def calculator_start(callback: types.CallbackQuery, state: FSMContext):
         "• 💰 Примерную стоимость\n\n"
         "📄 Поддерживаемые форматы:\n"
         "• Bambu Lab Studio (.gcode, .3mf)\n"
-        "• Cura, PrusaSlicer, Simplify3D (.gcode)\n\n"
+        "• Cura, PrusaSlicer, Simplify3D (.gcode)\n"
+        "• Любой G-code без метаданных - расчет по движениям\n"
+        "• 📦 Несколько файлов альбомом или ZIP-архивом - смета по всем\n\n"
         "Отправьте файл:",
         parse_mode="Markdown"
     )
     await state.set_state(CalculatorState.waiting_file)
     await callback.answer()
 
+# Файлы альбомов, ожидающие остальных частей: media_group_id -> документы
+media_groups = {}
+
 # Обработчик файлов для калькулятора
 @dp.message(F.document, CalculatorState.waiting_file)
 async def calculator_process_file(message: types.Message, state: FSMContext):
     document = message.document
 
-    if not (document.file_name.endswith('.gcode') or document.file_name.endswith('.gco') or document.file_name.endswith('.3mf')):
-        await message.answer("❌ Пожалуйста, отправьте файл .gcode, .gco или .3mf")
+    # Альбом приходит отдельными сообщениями - собираем его и считаем пакетом
+    if message.media_group_id:
+        group = media_groups.setdefault(message.media_group_id, [])
+        group.append(document)
+        if len(group) == 1:
+            await asyncio.sleep(MEDIA_GROUP_DELAY)
+            await calculator_process_batch(message, state, media_groups.pop(message.media_group_id))
+        return
+
+    if document.file_name.lower().endswith('.zip'):
+        await calculator_process_batch(message, state, [document])
+        return
+
+    if not is_supported(document.file_name):
+        await message.answer("❌ Пожалуйста, отправьте файл .gcode, .gco, .3mf или архив .zip")
         return
 
     try:
         # Показываем что обрабатываем
         processing_msg = await message.answer("⏳ Анализирую файл...")
 
-        # Скачиваем файл
-        file = await bot.get_file(document.file_id)
-        file_content = await bot.download_file(file.file_path)
-        content = file_content.read().decode('utf-8', errors='ignore')
-
-        # Парсим G-code
-        weight_grams, time_hours = parse_gcode(content)
+        # Скачиваем и парсим G-code (только заголовок и подвал файла) или архив .3mf
+        user_id = str(message.from_user.id)
+        result = await download_and_parse(
+            user_id, document, show_queue_position(processing_msg, "⏳ Анализирую файл...")
+        )
+        weight_grams, time_hours, plates = result.weight_grams, result.time_hours, result.plates
 
         # Получаем настройки пользователя для расчетов
-        user_id = str(message.from_user.id)
-        async with aiosqlite.connect(DB_PATH) as db:
-            async with db.execute('SELECT * FROM printer_settings WHERE user_id = ?', (user_id,)) as cursor:
-                settings = await cursor.fetchone()
+        settings = await settings_store.get(user_id)
 
         if weight_grams or time_hours:
             text = f"✅ *Анализ файла: {document.file_name}*\n\n"
@@ -252,25 +344,39 @@ async def calculator_process_file(message: types.Message, state: FSMContext):
             else:
                 text += "⏱️ *Время печати:* не найдено\n\n"
 
+            # Пластины проекта .3mf
+            if len(plates) > 1:
+                text += f"🗂 *Пластины ({len(plates)}):*\n"
+                for plate in plates:
+                    plate_weight = f"{plate.weight_grams:.1f} г" if plate.weight_grams else "—"
+                    plate_time = f"{plate.time_hours:.2f} ч" if plate.time_hours else "—"
+                    text += f"• Пластина {plate.index}: {plate_weight}, {plate_time}\n"
+                text += "\n"
+
+            # Вес по слотам филамента (многоцветная печать)
+            slots = used_slots(result.filaments)
+            if len(slots) > 1:
+                text += "🎨 *Филаменты:*\n"
+                for slot, grams in slots:
+                    text += f"• Слот {slot}: {grams:.1f} г\n"
+                text += "\n"
+
+            if result.filament_mm is not None:
+                text += (
+                    f"📐 _Метаданных слайсера нет - вес и время рассчитаны по движениям "
+                    f"(нить {result.filament_mm / 1000:.2f} м, PLA {FILAMENT_DIAMETER} мм)_\n\n"
+                )
+
             # Примерная стоимость
             if weight_grams and time_hours and settings:
                 text += "💰 *Примерная стоимость:*\n"
 
-                # Материал (из расчета 1.5₽/г для PLA)
-                material_cost = weight_grams * 1.5
-                text += f"├ Материал: ~{material_cost:.2f} ₽ (1.5₽/г)\n"
-
-                # Электричество
-                electricity_cost = time_hours * settings[4] * settings[3]  # printer_power * electricity_cost
-                text += f"├ Электричество: {electricity_cost:.2f} ₽\n"
-
-                # Амортизация
-                amortization = time_hours * (settings[1] / settings[2]) / (30 * 24)
-                text += f"├ Амортизация: {amortization:.2f} ₽\n"
-
-                # Итого
-                total_cost = material_cost + electricity_cost + amortization
-                text += f"└ *Итого: ~{total_cost:.2f} ₽*\n\n"
+                # Материал из расчета 1.5₽/г для PLA
+                cost = calculate_cost(weight_grams, time_hours, settings)
+                text += f"├ Материал: ~{cost.material_cost:.2f} ₽ ({DEFAULT_PRICE_PER_GRAM}₽/г)\n"
+                text += f"├ Электричество: {cost.electricity_cost:.2f} ₽\n"
+                text += f"├ Амортизация: {cost.amortization:.2f} ₽\n"
+                text += f"└ *Итого: ~{cost.total_cost:.2f} ₽*\n\n"
 
                 text += "_💡 Для точного расчета добавьте печать с вашей катушкой_"
 
@@ -278,12 +384,17 @@ async def calculator_process_file(message: types.Message, state: FSMContext):
             await processing_msg.delete()
 
             # Отправляем результат
+            buttons = [[InlineKeyboardButton(text="📊 Разбор по слоям", callback_data="layers")]]
+            if weight_grams and time_hours:
+                buttons.append([InlineKeyboardButton(text="🧵 Сравнить катушки", callback_data="quote")])
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                *buttons,
                 [InlineKeyboardButton(text="🔍 Ещё файл", callback_data="calculator")],
                 [InlineKeyboardButton(text="◀️ Главное меню", callback_data="back")]
             ])
             await message.answer(text, reply_markup=keyboard, parse_mode="Markdown")
             await state.clear()
+            await remember_file(state, document)
         else:
             await processing_msg.delete()
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -302,6 +413,39 @@ async def calculator_process_file(message: types.Message, state: FSMContext):
             )
             await state.clear()
 
+    except ParseCancelled:
+        # Пользователь ушел из калькулятора - результат больше не нужен
+        await processing_msg.delete()
+    except QueueFull as e:
+        await processing_msg.edit_text(queue_full_text(e), reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="◀️ Главное меню", callback_data="back")]
+        ]))
+    except FileTooLarge as e:
+        await processing_msg.delete()
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔍 Попробовать другой файл", callback_data="calculator")],
+            [InlineKeyboardButton(text="◀️ Главное меню", callback_data="back")]
+        ])
+        await message.answer(
+            f"❌ *Слишком большой файл*\n\n"
+            f"Максимальный размер - {format_megabytes(e.limit)}.",
+            reply_markup=keyboard,
+            parse_mode="Markdown"
+        )
+        await state.clear()
+    except asyncio.TimeoutError:
+        await processing_msg.delete()
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔍 Попробовать другой файл", callback_data="calculator")],
+            [InlineKeyboardButton(text="◀️ Главное меню", callback_data="back")]
+        ])
+        await message.answer(
+            "⌛ *Файл обрабатывается слишком долго*\n\n"
+            "Попробуйте файл поменьше или экспортируйте G-code заново из слайсера.",
+            reply_markup=keyboard,
+            parse_mode="Markdown"
+        )
+        await state.clear()
     except Exception as e:
         logger.error(f"Error in calculator: {e}")
         await processing_msg.delete()
@@ -316,79 +460,212 @@ async def calculator_process_file(message: types.Message, state: FSMContext):
         )
         await state.clear()
 
+# Пакетная смета: ZIP-архивы и альбомы файлов
+async def calculator_process_batch(message: types.Message, state: FSMContext, documents):
+    user_id = str(message.from_user.id)
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔍 Ещё файл", callback_data="calculator")],
+        [InlineKeyboardButton(text="◀️ Главное меню", callback_data="back")]
+    ])
+    processing_msg = await message.answer("⏳ Анализирую файлы...")
+
+    try:
+        # Пакет - одна задача очереди с низким приоритетом
+        on_position = show_queue_position(processing_msg, "⏳ Анализирую файлы...")
+        async with work_queue.slot(user_id, PRIORITY_BATCH, on_position):
+            with ExitStack() as downloads:
+                names, results, calls, pending = [], [], [], []
+                for document in documents:
+                    if len(names) >= BATCH_MAX_FILES:
+                        break
+                    is_zip = document.file_name.lower().endswith('.zip')
+                    if not is_zip and not is_supported(document.file_name):
+                        continue
+
+                    # Отдельные файлы могут быть в кэше - тогда не скачиваем
+                    cached = None if is_zip else await parse_cache.get(document.file_unique_id)
+                    if cached is not None:
+                        names.append(document.file_name)
+                        results.append(cached)
+                        continue
+
+                    # Пакет скачивается на диск: в памяти держать сотни файлов нельзя
+                    try:
+                        downloaded = await download(
+                            bot, document.file_id, document.file_name, document.file_size, memory_bytes=0
+                        )
+                    except FileTooLarge as e:
+                        names.append(document.file_name)
+                        results.append(e)
+                        continue
+                    downloads.enter_context(downloaded)
+                    downloaded.rollover()
+                    path = downloaded.source()
+
+                    if is_zip:
+                        # Члены архива кэшируются по содержимому: тот же файл в новом
+                        # архиве не разбирается заново. Хэш - в потоке, архив может быть большим
+                        members = list_archive_members(path, BATCH_MAX_FILES - len(names))
+                        keys = await asyncio.to_thread(content_keys, [(path, member) for member in members])
+                        for member, key in zip(members, keys):
+                            names.append(member)
+                            results.append(await parse_cache.get(key))
+                            if results[-1] is None:
+                                calls.append((parse_archive_member, path, member))
+                                pending.append((len(results) - 1, key))
+                    else:
+                        names.append(document.file_name)
+                        results.append(None)
+                        calls.append((parse_print_file, document.file_name, path))
+                        pending.append((len(results) - 1, document.file_unique_id))
+
+                if not names:
+                    await processing_msg.delete()
+                    await message.answer("⚠️ Не найдено файлов .gcode, .gco или .3mf", reply_markup=keyboard)
+                    await state.clear()
+                    return
+
+                # Файлы разбираются параллельно в пуле процессов, прямо из архива
+                for (position, cache_key), result in zip(pending, await parse_pool.map(user_id, calls)):
+                    results[position] = result
+                    if cache_key and not isinstance(result, Exception) and (result.weight_grams or result.time_hours):
+                        await parse_cache.put(cache_key, result)
+
+        settings = await settings_store.get(user_id)
+        rows = build_quote(names, results, settings)
+
+        # Посчитанные файлы можно распределить по принтерам фермы; пластик из
+        # файла нужен, чтобы учесть смены пластика
+        jobs = [
+            [row.name, row.hours, row.weight, result.material]
+            for row, result in zip(rows, results) if row.cost
+        ]
+        if not (jobs and await list_printers(database, user_id)):
+            jobs = None
+        reply_markup = keyboard
+        if jobs:
+            reply_markup = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🏭 Распределить по принтерам", callback_data="farm:makespan")],
+                *keyboard.inline_keyboard
+            ])
+
+        await processing_msg.delete()
+        await message.answer(format_quote_table(rows), reply_markup=reply_markup, parse_mode="Markdown")
+        if len(rows) > MESSAGE_ROWS:
+            await message.answer_document(BufferedInputFile(quote_csv(rows), filename="quote.csv"))
+        await state.clear()
+        if jobs:
+            await state.update_data(farm_jobs=jobs)
+
+    except ParseCancelled:
+        await processing_msg.delete()
+    except QueueFull as e:
+        await processing_msg.edit_text(queue_full_text(e), reply_markup=keyboard)
+    except Exception as e:
+        logger.error(f"Error in batch calculator: {e}")
+        await processing_msg.delete()
+        await message.answer(
+            "❌ *Ошибка при обработке файлов*\n\n"
+            "Проверьте, что архив не поврежден, и попробуйте снова.",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="◀️ Главное меню", callback_data="back")]
+            ]),
+            parse_mode="Markdown"
+        )
+        await state.clear()
+
 # Сводка
 @dp.callback_query(F.data == "dashboard")
 async def show_dashboard(callback: types.CallbackQuery):
     user_id = str(callback.from_user.id)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute('SELECT * FROM prints WHERE user_id = ?', (user_id,)) as cursor:
-            prints = await cursor.fetchall()
+    # Сводка поддерживается триггерами на prints - одно чтение вместо всей истории
+    stats = await get_user_stats(database, user_id)
 
-        if not prints:
-            await callback.message.edit_text(
-                "📊 *Сводка*\n\n"
-                "У вас пока нет печатей. Добавьте первую печать!",
-                reply_markup=main_menu(),
-                parse_mode="Markdown"
-            )
-            return
+    if not stats or not stats.prints_count:
+        await callback.message.edit_text(
+            "📊 *Сводка*\n\n"
+            "У вас пока нет печатей. Добавьте первую печать!",
+            reply_markup=main_menu(),
+            parse_mode="Markdown"
+        )
+        return
 
-        total_profit = sum(p[12] for p in prints)  # profit
-        total_revenue = sum(p[7] for p in prints)  # sale_price
-        total_cost = sum(p[11] for p in prints)  # total_cost
-        total_plastic = sum(p[5] for p in prints)  # weight
+    text = (
+        f"📊 *Сводка*\n\n"
+        f"💰 Чистая прибыль: {stats.total_profit:.2f} ₽\n"
+        f"📈 Общая выручка: {stats.total_revenue:.2f} ₽\n"
+        f"💸 Себестоимость: {stats.total_cost:.2f} ₽\n"
+        f"🧵 Израсходовано: {stats.total_plastic:.0f} г\n"
+        f"📝 Всего печатей: {stats.prints_count}"
+    )
 
-        text = (
-            f"📊 *Сводка*\n\n"
-            f"💰 Чистая прибыль: {total_profit:.2f} ₽\n"
-            f"📈 Общая выручка: {total_revenue:.2f} ₽\n"
-            f"💸 Себестоимость: {total_cost:.2f} ₽\n"
-            f"🧵 Израсходовано: {total_plastic:.0f} г\n"
-            f"📝 Всего печатей: {len(prints)}"
+    month = await get_month_stats(database, user_id, datetime.now().strftime('%Y-%m'))
+    if month and month.prints_count:
+        text += (
+            f"\n\n📅 *За этот месяц:*\n"
+            f"💰 Прибыль: {month.total_profit:.2f} ₽\n"
+            f"📝 Печатей: {month.prints_count}"
         )
 
-        await callback.message.edit_text(text, reply_markup=main_menu(), parse_mode="Markdown")
+    usage = await get_spool_usage(database, user_id)
+    if usage:
+        text += "\n\n🧵 *По катушкам:*\n"
+        for spool in usage[:DASHBOARD_SPOOLS]:
+            text += (
+                f"• {spool.name or 'Удаленная катушка'}: {spool.weight:.0f} г, "
+                f"{spool.material_cost:.2f} ₽ ({spool.prints_count} печ.)\n"
+            )
+
+    await callback.message.edit_text(text, reply_markup=dashboard_menu(), parse_mode="Markdown")
     await callback.answer()
 
+# Сводка: главное меню и выгрузка истории
+def dashboard_menu():
+    keyboard = main_menu()
+    keyboard.inline_keyboard.insert(0, [
+        InlineKeyboardButton(text="📤 Выгрузка CSV", callback_data="export:csv"),
+        InlineKeyboardButton(text="📤 Выгрузка XLSX", callback_data="export:xlsx"),
+    ])
+    return keyboard
+
 # Катушки
 @dp.callback_query(F.data == "spools")
 async def show_spools(callback: types.CallbackQuery):
     user_id = str(callback.from_user.id)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute('SELECT * FROM spools WHERE user_id = ? ORDER BY created_at DESC', (user_id,)) as cursor:
-            spools = await cursor.fetchall()
-
-        if not spools:
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="➕ Добавить катушку", callback_data="add_spool")],
-                [InlineKeyboardButton(text="◀️ Назад", callback_data="back")]
-            ])
-            await callback.message.edit_text(
-                "🧵 *Катушки пластика*\n\n"
-                "У вас пока нет катушек. Добавьте первую!",
-                reply_markup=keyboard,
-                parse_mode="Markdown"
-            )
-            await callback.answer()
-            return
-
-        text = "🧵 *Ваши катушки:*\n\n"
-        for spool in spools:
-            text += (
-                f"• *{spool[2]}*\n"  # name
-                f"  Стоимость: {spool[3]:.2f} ₽\n"  # cost
-                f"  Вес: {spool[4]:.0f} г\n"  # weight
-                f"  Цена за грамм: {spool[5]:.2f} ₽/г\n\n"  # price_per_gram
-            )
+    spools = await database.fetchall('SELECT * FROM spools WHERE user_id = ? ORDER BY created_at DESC', (user_id,))
 
+    if not spools:
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="➕ Добавить катушку", callback_data="add_spool")],
             [InlineKeyboardButton(text="◀️ Назад", callback_data="back")]
         ])
+        await callback.message.edit_text(
+            "🧵 *Катушки пластика*\n\n"
+            "У вас пока нет катушек. Добавьте первую!",
+            reply_markup=keyboard,
+            parse_mode="Markdown"
+        )
+        await callback.answer()
+        return
+
+    text = "🧵 *Ваши катушки:*\n\n"
+    for spool in spools:
+        text += (
+            f"• *{spool[2]}*\n"  # name
+            f"  Стоимость: {spool[3]:.2f} ₽\n"  # cost
+            f"  Вес: {spool[4]:.0f} г\n"  # weight
+            f"  Цена за грамм: {spool[5]:.2f} ₽/г\n"  # price_per_gram
+            f"  Нить: {spool[7]} мм, {spool[8]} г/см³\n\n"  # diameter, density
+        )
+
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="➕ Добавить катушку", callback_data="add_spool")],
+        [InlineKeyboardButton(text="◀️ Назад", callback_data="back")]
+    ])
 
-        await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="Markdown")
+    await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="Markdown")
     await callback.answer()
 
 # Добавление катушки
@@ -421,12 +698,13 @@ async def add_spool_weight(message: types.Message, state: FSMContext):
         data = await state.get_data()
         user_id = str(message.from_user.id)
 
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute('''
-                INSERT INTO spools (user_id, name, cost, weight, price_per_gram)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, data['name'], data['cost'], weight, data['cost'] / weight))
-            await db.commit()
+        await database.execute('''
+            INSERT INTO spools (user_id, name, cost, weight, price_per_gram, diameter, density)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            user_id, data['name'], data['cost'], weight, data['cost'] / weight,
+            FILAMENT_DIAMETER, guess_density(data['name'])
+        ))
 
         await message.answer(
             f"✅ Катушка *{data['name']}* добавлена!\n"
@@ -447,9 +725,7 @@ async def add_spool_weight(message: types.Message, state: FSMContext):
 async def add_print_start(callback: types.CallbackQuery, state: FSMContext):
     user_id = str(callback.from_user.id)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute('SELECT * FROM spools WHERE user_id = ?', (user_id,)) as cursor:
-            spools = await cursor.fetchall()
+    spools = await database.fetchall('SELECT * FROM spools WHERE user_id = ?', (user_id,))
 
     if not spools:
         await callback.message.edit_text(
@@ -490,7 +766,8 @@ async def handle_upload_gcode(callback: types.CallbackQuery, state: FSMContext):
         "• Bambu Lab Studio\n"
         "• Cura\n"
         "• PrusaSlicer\n"
-        "• Simplify3D"
+        "• Simplify3D\n"
+        "• Любой G-code без метаданных (расчет по движениям)"
     )
     await callback.answer()
 
@@ -499,37 +776,45 @@ async def handle_upload_gcode(callback: types.CallbackQuery, state: FSMContext):
 async def handle_gcode_file(message: types.Message, state: FSMContext):
     document = message.document
 
-    if not (document.file_name.endswith('.gcode') or document.file_name.endswith('.gco') or document.file_name.endswith('.3mf')):
+    if not is_supported(document.file_name):
         await message.answer("❌ Пожалуйста, отправьте файл .gcode, .gco или .3mf")
         return
 
     try:
-        file = await bot.get_file(document.file_id)
-        file_content = await bot.download_file(file.file_path)
-        content = file_content.read().decode('utf-8', errors='ignore')
-
-        weight_grams, time_hours = parse_gcode(content)
+        result = await download_and_parse(str(message.from_user.id), document)
+        weight_grams, time_hours = result.weight_grams, result.time_hours
 
         if weight_grams and time_hours:
-            await state.update_data(weight=weight_grams, hours=time_hours)
-            await message.answer(
+            # Вес из симуляции пересчитывается по нити выбранной катушки.
+            # Для многоцветной печати катушка выбирается на каждый слот
+            slots = used_slots(result.filaments)
+            if len(slots) < 2:
+                slots = None
+            await state.update_data(
+                weight=weight_grams, hours=time_hours, filament_mm=result.filament_mm,
+                file_key=document.file_unique_id, slots=slots, slot_spools=[]
+            )
+            await remember_file(state, document)
+            text = (
                 f"✅ Данные успешно извлечены!\n\n"
                 f"⚖️ Вес: {weight_grams:.1f} г\n"
                 f"⏱️ Время: {time_hours:.2f} ч\n\n"
-                f"Теперь выберите катушку..."
             )
+            if slots:
+                text += f"🎨 Филаментов: {len(slots)} - выберите катушку для каждого"
+            else:
+                text += "Теперь выберите катушку..."
+            await message.answer(text)
 
             user_id = str(message.from_user.id)
-            async with aiosqlite.connect(DB_PATH) as db:
-                async with db.execute('SELECT * FROM spools WHERE user_id = ?', (user_id,)) as cursor:
-                    spools = await cursor.fetchall()
-
-            text = "🧵 Выберите катушку (отправьте номер):\n\n"
-            for idx, spool in enumerate(spools, 1):
-                text += f"{idx}. {spool[2]} ({spool[5]:.2f} ₽/г)\n"
+            spools = await database.fetchall('SELECT * FROM spools WHERE user_id = ?', (user_id,))
 
-            await state.update_data(spools=spools)
-            await message.answer(text)
+            # В состоянии только id катушек в порядке списка
+            await state.update_data(spools=[spool[0] for spool in spools])
+            if slots:
+                await message.answer(spools_text(spools, f"🧵 Слот {slots[0][0]} ({slots[0][1]:.1f} г) - номер катушки:"))
+            else:
+                await message.answer(spools_text(spools))
             await state.set_state(PrintForm.spool_id)
         else:
             error_msg = "⚠️ Не удалось извлечь данные из файла.\n\n"
@@ -544,6 +829,17 @@ async def handle_gcode_file(message: types.Message, state: FSMContext):
             ])
             await message.answer(error_msg, reply_markup=keyboard)
 
+    except ParseCancelled:
+        pass
+    except QueueFull as e:
+        await message.answer(queue_full_text(e))
+    except FileTooLarge as e:
+        await message.answer(
+            f"❌ Слишком большой файл: {e}. Введите данные вручную.",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="✍️ Ввести вручную", callback_data="manual_input")]
+            ])
+        )
     except Exception as e:
         logger.error(f"Error parsing file: {e}")
         await message.answer(
@@ -558,16 +854,10 @@ async def handle_gcode_file(message: types.Message, state: FSMContext):
 async def handle_manual_input(callback: types.CallbackQuery, state: FSMContext):
     user_id = str(callback.from_user.id)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute('SELECT * FROM spools WHERE user_id = ?', (user_id,)) as cursor:
-            spools = await cursor.fetchall()
+    spools = await database.fetchall('SELECT * FROM spools WHERE user_id = ?', (user_id,))
 
-    text = "🧵 Выберите катушку (отправьте номер):\n\n"
-    for idx, spool in enumerate(spools, 1):
-        text += f"{idx}. {spool[2]} ({spool[5]:.2f} ₽/г)\n"
-
-    await state.update_data(spools=spools)
-    await callback.message.edit_text(text)
+    await state.update_data(spools=[spool[0] for spool in spools])
+    await callback.message.edit_text(spools_text(spools))
     await state.set_state(PrintForm.spool_id)
     await callback.answer()
 
@@ -576,13 +866,30 @@ async def add_print_spool(message: types.Message, state: FSMContext):
     try:
         idx = int(message.text) - 1
         data = await state.get_data()
-        spools = data['spools']
+        spool_ids = data['spools']
 
-        if idx < 0 or idx >= len(spools):
+        if idx < 0 or idx >= len(spool_ids):
             await message.answer("❌ Неверный номер. Попробуйте снова:")
             return
 
-        await state.update_data(selected_spool=spools[idx])
+        spool, = await load_spools(str(message.from_user.id), [spool_ids[idx]])
+        if spool is None:
+            await message.answer("❌ Эта катушка удалена. Выберите другую:")
+            return
+        await state.update_data(selected_spool=spool[0])
+
+        # Многоцветная печать: катушки по слотам, пока не выбраны все
+        slots = data.get('slots')
+        if slots:
+            slot_spools = data['slot_spools'] + [spool[0]]
+            await state.update_data(slot_spools=slot_spools, selected_spool=slot_spools[0])
+            if len(slot_spools) < len(slots):
+                slot, grams = slots[len(slot_spools)]
+                await message.answer(f"🧵 Слот {slot} ({grams:.1f} г) - номер катушки:")
+                return
+
+        if data.get('filament_mm') is not None:
+            await state.update_data(weight=filament_grams(data['filament_mm'], spool[7], spool[8]))
 
         if 'weight' in data and 'hours' in data:
             await message.answer("💵 Введите цену продажи в рублях:")
@@ -617,51 +924,105 @@ async def add_print_hours(message: types.Message, state: FSMContext):
 async def add_print_price(message: types.Message, state: FSMContext):
     try:
         sale_price = float(message.text)
+    except (ValueError, TypeError):
+        await message.answer("❌ Неверный формат. Введите число:")
+        return
+
+    # С фермой электричество и амортизация считаются по выбранному принтеру
+    user_id = str(message.from_user.id)
+    printers = await list_printers(database, user_id)
+    if printers:
+        await state.update_data(sale_price=sale_price)
+        await message.answer("🖨 На каком принтере печаталась деталь?", reply_markup=printer_choice_menu(printers))
+        await state.set_state(PrintForm.printer)
+        return
+    await save_print(message, state, user_id, sale_price)
+
+def printer_choice_menu(printers):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"🖨 {printer.name}", callback_data=f"print_printer:{printer.id}")]
+        for printer in printers
+    ] + [[InlineKeyboardButton(text="⚙️ По настройкам принтера", callback_data="print_printer:0")]])
+
+@dp.callback_query(F.data.startswith("print_printer:"), PrintForm.printer)
+async def add_print_printer(callback: types.CallbackQuery, state: FSMContext):
+    user_id = str(callback.from_user.id)
+    printer_id = int(callback.data.split(":", 1)[1])
+    printer = await get_printer(database, user_id, printer_id) if printer_id else None
+    data = await state.get_data()
+    await callback.answer()
+    await save_print(callback.message, state, user_id, data['sale_price'], printer)
+
+# Расчет и сохранение печати; printer - принтер фермы или None (настройки)
+async def save_print(message: types.Message, state: FSMContext, user_id, sale_price, printer=None):
+    try:
         data = await state.get_data()
-        user_id = str(message.from_user.id)
 
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Получаем настройки
-            async with db.execute('SELECT * FROM printer_settings WHERE user_id = ?', (user_id,)) as cursor:
-                settings = await cursor.fetchone()
-
-            printer_cost = settings[1]
-            amortization_months = settings[2]
-            electricity_cost = settings[3]
-            printer_power = settings[4]
-
-            # Расчеты
-            spool = data['selected_spool']
-            weight = data['weight']
-            hours = data['hours']
-
-            material_cost = weight * spool[5]  # price_per_gram
-            electricity_cost_calc = hours * printer_power * electricity_cost
-            amortization = hours * (printer_cost / amortization_months) / (30 * 24)
-            total_cost = material_cost + electricity_cost_calc + amortization
-            profit = sale_price - total_cost
-
-            # Сохраняем печать
-            await db.execute('''
+        # Получаем настройки
+        settings = await settings_store.get(user_id)
+        if printer is not None:
+            settings = printer.settings(settings)
+
+        # Расчеты: вес и катушка по каждому слоту филамента
+        hours = data['hours']
+        if data.get('slots'):
+            slot_spools = await load_spools(user_id, data['slot_spools'])
+            filaments = [(slot, grams, slot_spool) for (slot, grams), slot_spool in zip(data['slots'], slot_spools)]
+        else:
+            spool, = await load_spools(user_id, [data['selected_spool']])
+            filaments = [(1, data['weight'], spool)]
+        if any(slot_spool is None for _, _, slot_spool in filaments):
+            await message.answer("❌ Катушка была удалена - добавьте печать заново", reply_markup=main_menu())
+            await state.clear()
+            return
+        spool = filaments[0][2]
+        weights = [grams for _, grams, _ in filaments]
+        weight = sum(weights)
+        spool_name = ' + '.join(dict.fromkeys(slot_spool[2] for _, _, slot_spool in filaments))
+
+        material_cost, electricity_cost_calc, amortization, total_cost = calculate_cost(
+            weights, hours, settings, [slot_spool[5] for _, _, slot_spool in filaments]  # price_per_gram
+        )
+        profit = sale_price - total_cost
+
+        # Сохраняем печать и ее филаменты одной транзакцией
+        async with database.transaction() as db:
+            cursor = await db.execute('''
                 INSERT INTO prints (
-                    user_id, date, name, spool_name, weight, hours,
+                    user_id, date, name, spool_id, spool_name, weight, hours,
                     sale_price, material_cost, electricity_cost_calc,
-                    amortization, total_cost, profit
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    amortization, total_cost, profit, file_key, printer_id
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (
                 user_id, datetime.now().date().isoformat(), data['name'],
-                spool[2], weight, hours, sale_price, material_cost,
-                electricity_cost_calc, amortization, total_cost, profit
+                spool[0], spool_name, weight, hours, sale_price, material_cost,
+                electricity_cost_calc, amortization, total_cost, profit, data.get('file_key'),
+                printer.id if printer else None
             ))
-            await db.commit()
+            await db.executemany('''
+                INSERT INTO print_filaments (print_id, slot, user_id, spool_id, weight, material_cost)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [
+                (cursor.lastrowid, slot, user_id, slot_spool[0], grams, grams * slot_spool[5])
+                for slot, grams, slot_spool in filaments
+            ])
 
         profit_emoji = "💚" if profit >= 0 else "❤️"
         text = (
             f"✅ *Печать добавлена!*\n\n"
             f"📝 Деталь: {data['name']}\n"
-            f"🧵 Катушка: {spool[2]}\n"
+            f"🧵 Катушка: {spool_name}\n"
             f"⚖️ Вес: {weight:.0f} г\n"
-            f"⏱️ Время: {hours:.1f} ч\n\n"
+            f"⏱️ Время: {hours:.1f} ч\n"
+        )
+        if printer is not None:
+            text += f"🖨 Принтер: {escape_markdown(printer.name)}\n"
+        text += "\n"
+        if len(filaments) > 1:
+            for slot, grams, slot_spool in filaments:
+                text += f"🎨 Слот {slot}: {grams:.1f} г - {slot_spool[2]} ({grams * slot_spool[5]:.2f} ₽)\n"
+            text += "\n"
+        text += (
             f"💰 *Финансы:*\n"
             f"├ Материал: {material_cost:.2f} ₽\n"
             f"├ Электричество: {electricity_cost_calc:.2f} ₽\n"
@@ -671,34 +1032,475 @@ async def add_print_price(message: types.Message, state: FSMContext):
             f"└ {profit_emoji} *Прибыль: {profit:.2f} ₽*"
         )
 
-        await message.answer(text, reply_markup=main_menu(), parse_mode="Markdown")
+        keyboard = main_menu()
+        if data.get('last_file'):
+            keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="📊 Разбор по слоям", callback_data="layers")],
+                *keyboard.inline_keyboard
+            ])
+        await message.answer(text, reply_markup=keyboard, parse_mode="Markdown")
         await state.clear()
+        if data.get('last_file'):
+            await state.update_data(last_file=data['last_file'])
     except Exception as e:
         logger.error(f"Error adding print: {e}")
         await message.answer("❌ Ошибка при добавлении печати", reply_markup=main_menu())
         await state.clear()
 
 # Настройки
+SETTINGS_LABELS = {
+    'printer_cost': ("💰 Стоимость принтера", "Введите стоимость принтера в рублях:"),
+    'amortization_months': ("📅 Срок амортизации", "Введите срок амортизации в месяцах:"),
+    'electricity_cost': ("⚡ Стоимость электричества", "Введите стоимость электричества в ₽/кВт·ч:"),
+    'printer_power': ("🔌 Мощность принтера", "Введите мощность принтера в кВт (например, 0.3):"),
+}
+
+def settings_text(settings):
+    return (
+        f"⚙️ *Настройки принтера*\n\n"
+        f"💰 Стоимость принтера: {settings.printer_cost:.0f} ₽\n"
+        f"📅 Срок амортизации: {settings.amortization_months} мес\n"
+        f"⚡ Стоимость электричества: {settings.electricity_cost:.2f} ₽/кВт·ч\n"
+        f"🔌 Мощность принтера: {settings.printer_power:.2f} кВт\n\n"
+        f"_Выберите параметр, чтобы изменить его_"
+    )
+
+def settings_menu():
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=label, callback_data=f"edit_setting:{field}")]
+        for field, (label, _) in SETTINGS_LABELS.items()
+    ] + [
+        [InlineKeyboardButton(text="🏭 Принтеры фермы", callback_data="printers")],
+        [InlineKeyboardButton(text="◀️ Назад", callback_data="back")]
+    ])
+    return keyboard
+
 @dp.callback_query(F.data == "settings")
 async def show_settings(callback: types.CallbackQuery):
     user_id = str(callback.from_user.id)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute('SELECT * FROM printer_settings WHERE user_id = ?', (user_id,)) as cursor:
-            settings = await cursor.fetchone()
+    settings = await settings_store.get(user_id)
 
-        text = (
-            f"⚙️ *Настройки принтера*\n\n"
-            f"💰 Стоимость принтера: {settings[1]:.0f} ₽\n"
-            f"📅 Срок амортизации: {settings[2]} мес\n"
-            f"⚡ Стоимость электричества: {settings[3]:.2f} ₽/кВт·ч\n"
-            f"🔌 Мощность принтера: {settings[4]:.2f} кВт\n\n"
-            f"_Настройки можно изменить в базе данных_"
+    await callback.message.edit_text(settings_text(settings), reply_markup=settings_menu(), parse_mode="Markdown")
+    await callback.answer()
+
+# Изменение параметра принтера
+@dp.callback_query(F.data.startswith("edit_setting:"))
+async def edit_setting_start(callback: types.CallbackQuery, state: FSMContext):
+    field = callback.data.split(":", 1)[1]
+    if field not in SETTINGS_LABELS:
+        await callback.answer()
+        return
+
+    await state.update_data(setting_field=field)
+    await callback.message.edit_text(SETTINGS_LABELS[field][1])
+    await state.set_state(SettingsForm.value)
+    await callback.answer()
+
+@dp.message(SettingsForm.value)
+async def edit_setting_value(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    field = data['setting_field']
+
+    try:
+        value = float(message.text.replace(',', '.'))
+        if field == 'amortization_months':
+            value = int(value)
+        if value <= 0:
+            raise ValueError
+    except (ValueError, AttributeError):
+        await message.answer("❌ Неверный формат. Введите положительное число:")
+        return
+
+    settings = await settings_store.update(str(message.from_user.id), **{field: value})
+    await state.clear()
+    await message.answer(settings_text(settings), reply_markup=settings_menu(), parse_mode="Markdown")
+
+# Принтеры фермы: у каждого своя стоимость и мощность, срок амортизации и
+# тариф - из настроек. Пакетную смету можно распределить по принтерам
+def printers_text(printers, settings):
+    if not printers:
+        return (
+            "🏭 *Принтеры фермы*\n\n"
+            "Добавьте принтеры, чтобы распределять пакеты файлов между ними "
+            "и считать печати по конкретному принтеру."
+        )
+    text = "🏭 *Принтеры фермы:*\n\n"
+    for printer in printers:
+        busy = printer.available_in()
+        text += (
+            f"• *{escape_markdown(printer.name)}*\n"
+            f"  {printer.printer_cost:.0f} ₽, {printer.printer_power:.2f} кВт, "
+            f"{printer.hourly_cost(settings.electricity_cost):.2f} ₽/ч\n"
+            f"  Пластик: {escape_markdown(printer.material or 'не указан')}\n"
+            f"  {f'Занят еще {busy:.1f} ч' if busy else 'Свободен'}\n\n"
+        )
+    return text
+
+def printers_menu(printers):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text=f"⏱ {printer.name}", callback_data=f"printer_busy:{printer.id}"),
+            InlineKeyboardButton(text="🧵", callback_data=f"printer_material:{printer.id}"),
+            InlineKeyboardButton(text="🗑", callback_data=f"delete_printer:{printer.id}"),
+        ]
+        for printer in printers
+    ] + [
+        [InlineKeyboardButton(text="➕ Добавить принтер", callback_data="add_printer")],
+        [InlineKeyboardButton(text="◀️ Назад", callback_data="settings")]
+    ])
+
+async def printers_view(user_id):
+    printers = await list_printers(database, user_id)
+    settings = await settings_store.get(user_id)
+    return printers_text(printers, settings), printers_menu(printers)
+
+@dp.callback_query(F.data == "printers")
+async def show_printers(callback: types.CallbackQuery):
+    text, keyboard = await printers_view(str(callback.from_user.id))
+    await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="Markdown")
+    await callback.answer()
+
+@dp.callback_query(F.data.startswith("delete_printer:"))
+async def delete_printer_button(callback: types.CallbackQuery):
+    user_id = str(callback.from_user.id)
+    await delete_printer(database, user_id, int(callback.data.split(":", 1)[1]))
+    text, keyboard = await printers_view(user_id)
+    await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="Markdown")
+    await callback.answer("🗑 Принтер удален")
+
+@dp.callback_query(F.data == "add_printer")
+async def add_printer_start(callback: types.CallbackQuery, state: FSMContext):
+    await callback.message.edit_text("🖨 Введите название принтера (например, 'Ender 3 #2'):")
+    await state.set_state(PrinterForm.name)
+    await callback.answer()
+
+@dp.message(PrinterForm.name)
+async def add_printer_name(message: types.Message, state: FSMContext):
+    await state.update_data(name=message.text)
+    await message.answer("💰 Введите стоимость принтера в рублях:")
+    await state.set_state(PrinterForm.cost)
+
+# Положительное число из сообщения или None
+def positive_number(text):
+    try:
+        value = float(text.replace(',', '.'))
+    except (ValueError, AttributeError):
+        return None
+    return value if value > 0 else None
+
+@dp.message(PrinterForm.cost)
+async def add_printer_cost(message: types.Message, state: FSMContext):
+    cost = positive_number(message.text)
+    if cost is None:
+        await message.answer("❌ Неверный формат. Введите положительное число:")
+        return
+    await state.update_data(cost=cost)
+    await message.answer("🔌 Введите мощность принтера в кВт (например, 0.3):")
+    await state.set_state(PrinterForm.power)
+
+@dp.message(PrinterForm.power)
+async def add_printer_power(message: types.Message, state: FSMContext):
+    power = positive_number(message.text)
+    if power is None:
+        await message.answer("❌ Неверный формат. Введите положительное число:")
+        return
+    data = await state.get_data()
+    user_id = str(message.from_user.id)
+    settings = await settings_store.get(user_id)
+    await add_printer(database, user_id, data['name'], data['cost'], settings.amortization_months, power)
+    await state.clear()
+    text, keyboard = await printers_view(user_id)
+    await message.answer(text, reply_markup=keyboard, parse_mode="Markdown")
+
+@dp.callback_query(F.data.startswith("printer_busy:"))
+async def printer_busy_start(callback: types.CallbackQuery, state: FSMContext):
+    await state.update_data(printer_id=int(callback.data.split(":", 1)[1]))
+    await callback.message.edit_text("⏱ Сколько часов принтер еще будет занят? (0 - свободен)")
+    await state.set_state(PrinterForm.busy_hours)
+    await callback.answer()
+
+@dp.message(PrinterForm.busy_hours)
+async def printer_busy_hours(message: types.Message, state: FSMContext):
+    hours = 0.0 if (message.text or '').strip() == '0' else positive_number(message.text)
+    if hours is None:
+        await message.answer("❌ Неверный формат. Введите число часов:")
+        return
+    data = await state.get_data()
+    user_id = str(message.from_user.id)
+    await set_busy(database, user_id, data['printer_id'], hours)
+    await state.clear()
+    text, keyboard = await printers_view(user_id)
+    await message.answer(text, reply_markup=keyboard, parse_mode="Markdown")
+
+@dp.callback_query(F.data.startswith("printer_material:"))
+async def printer_material_start(callback: types.CallbackQuery, state: FSMContext):
+    await state.update_data(printer_id=int(callback.data.split(":", 1)[1]))
+    await callback.message.edit_text("🧵 Какой пластик заправлен в принтер? (например, PLA; - если неизвестно)")
+    await state.set_state(PrinterForm.material)
+    await callback.answer()
+
+@dp.message(PrinterForm.material)
+async def printer_material(message: types.Message, state: FSMContext):
+    material = (message.text or '').strip()
+    data = await state.get_data()
+    user_id = str(message.from_user.id)
+    await set_material(database, user_id, data['printer_id'], None if material == '-' else material[:32])
+    await state.clear()
+    text, keyboard = await printers_view(user_id)
+    await message.answer(text, reply_markup=keyboard, parse_mode="Markdown")
+
+# План печати пакета на ферме: farm:<цель> - новым сообщением под сметой,
+# farm:<цель>:edit - переключение цели в уже показанном плане
+@dp.callback_query(F.data.startswith("farm:"))
+async def show_farm_plan(callback: types.CallbackQuery, state: FSMContext):
+    _, objective, *mode = callback.data.split(":")
+    edit = mode == ['edit']
+    if objective not in OBJECTIVES:
+        await callback.answer()
+        return
+    user_id = str(callback.from_user.id)
+    rows = (await state.get_data()).get('farm_jobs')
+    if not rows:
+        await callback.answer("Смета устарела - отправьте файлы заново", show_alert=True)
+        return
+    printers = await list_printers(database, user_id)
+    if not printers:
+        await callback.answer("Сначала добавьте принтеры фермы в настройках", show_alert=True)
+        return
+
+    await callback.answer()
+    settings = await settings_store.get(user_id)
+    # Локальный поиск занимает до долей секунды - в потоке, чтобы не держать цикл событий
+    plan = await asyncio.to_thread(
+        plan_farm, farm_jobs(rows), farm_machines(printers, settings.electricity_cost), objective
+    )
+    other = 'cost' if objective == 'makespan' else 'makespan'
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(
+            text="💰 Дешевле" if other == 'cost' else "⏱ Быстрее", callback_data=f"farm:{other}:edit"
+        )],
+        [InlineKeyboardButton(text="◀️ Главное меню", callback_data="back")]
+    ])
+    if edit:
+        await callback.message.edit_text(format_schedule(plan), reply_markup=keyboard, parse_mode="Markdown")
+    else:
+        await callback.message.answer(format_schedule(plan), reply_markup=keyboard, parse_mode="Markdown")
+
+# Разбор по слоям последнего файла. Считается один раз за полный проход
+# по файлу, дальше показывается из layer_breakdowns без повторного разбора
+async def remember_file(state, document):
+    await state.update_data(last_file={
+        'file_id': document.file_id,
+        'file_unique_id': document.file_unique_id,
+        'file_name': document.file_name,
+    })
+
+# Таблица лучших вариантов сравнения: катушка (и тариф), себестоимость и
+# цена продажи для каждой целевой маржи. Строки - по возрастанию себестоимости
+def quotes_text(file_name, spools, weight, hours, matrix, rows=QUOTE_ROWS):
+    tariffs = len(matrix.tariffs) > 1
+    total = matrix.total_cost.ravel()
+    order = np.argsort(total, kind='stable')[:rows]
+
+    header = f"{'Катушка':<14}" + (f"{'₽/кВт':>6}" if tariffs else '') + f"{'Себест.':>9}"
+    header += ''.join(f"{f'{margin:.0%}':>8}" for margin in matrix.margins)
+    lines = [header]
+    for index in order:
+        spool_index, tariff_index = divmod(int(index), len(matrix.tariffs))
+        name = spools[spool_index][2]
+        line = f"{name[:13] + ('…' if len(name) > 13 else ''):<14}"
+        if tariffs:
+            line += f"{matrix.tariffs[tariff_index]:>6g}"
+        line += f"{total[index]:>9.2f}"
+        line += ''.join(f"{price:>8.0f}" for price in matrix.sale_price[spool_index, tariff_index])
+        lines.append(line)
+
+    # Вес по длине нити - свой для каждой катушки
+    weight_text = f"{np.min(weight):.1f} г"
+    if np.ndim(weight) and np.ptp(weight) >= 0.05:
+        weight_text = f"{np.min(weight):.1f}–{np.max(weight):.1f} г"
+    text = (
+        f"🧵 *Сравнение катушек: {file_name}*\n\n"
+        f"⚖️ {weight_text}, ⏱️ {hours:.2f} ч\n\n"
+        "```\n" + "\n".join(lines) + "\n```\n"
+        "_Цена продажи при марже (доля прибыли в цене)_"
+    )
+    if len(total) > rows:
+        text += f"\n_Показаны {rows} самых дешевых из {len(total)} вариантов_"
+    return text
+
+# Сравнение всех катушек пользователя для последнего файла калькулятора
+@dp.callback_query(F.data == "quote")
+async def show_quotes(callback: types.CallbackQuery, state: FSMContext):
+    user_id = str(callback.from_user.id)
+    file = (await state.get_data()).get('last_file')
+    result = await parse_cache.get(file['file_unique_id']) if file else None
+    if result is None or not (result.weight_grams and result.time_hours):
+        await callback.answer("Файл уже недоступен - отправьте его в калькулятор заново", show_alert=True)
+        return
+    await callback.answer()
+
+    spools = await database.fetchall('SELECT * FROM spools WHERE user_id = ? ORDER BY created_at DESC', (user_id,))
+    if not spools:
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="➕ Добавить катушку", callback_data="add_spool")],
+            [InlineKeyboardButton(text="◀️ Главное меню", callback_data="back")]
+        ])
+        await callback.message.answer("🧵 Добавьте катушки, чтобы сравнить стоимость печати", reply_markup=keyboard)
+        return
+
+    settings = await settings_store.get(user_id)
+    # Вес, посчитанный по длине нити, зависит от диаметра и плотности катушки
+    weight = result.weight_grams
+    if result.filament_mm is not None:
+        weight = filament_grams(
+            result.filament_mm,
+            np.array([spool[7] for spool in spools]), np.array([spool[8] for spool in spools])
         )
+    tariffs = list(dict.fromkeys([settings.electricity_cost, *QUOTE_TARIFFS]))
+    matrix = quote_matrix(weight, result.time_hours, settings, [spool[5] for spool in spools],
+                          DEFAULT_MARGINS, tariffs)
+    await callback.message.answer(
+        quotes_text(file['file_name'], spools, weight, result.time_hours, matrix),
+        reply_markup=layers_keyboard(),
+        parse_mode="Markdown"
+    )
 
-        await callback.message.edit_text(text, reply_markup=main_menu(), parse_mode="Markdown")
+def layers_keyboard():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔍 Калькулятор", callback_data="calculator")],
+        [InlineKeyboardButton(text="◀️ Главное меню", callback_data="back")]
+    ])
+
+@dp.callback_query(F.data == "layers")
+async def show_layers(callback: types.CallbackQuery, state: FSMContext):
+    user_id = str(callback.from_user.id)
+    file = (await state.get_data()).get('last_file')
+    if not file:
+        await callback.answer("Файл уже недоступен - отправьте его в калькулятор заново", show_alert=True)
+        return
     await callback.answer()
 
+    breakdown = await load_breakdown(database, file['file_unique_id'])
+    if breakdown is None:
+        processing_msg = await callback.message.answer("⏳ Строю разбор по слоям...")
+        try:
+            on_position = show_queue_position(processing_msg, "⏳ Строю разбор по слоям...")
+            async with work_queue.slot(user_id, PRIORITY_INTERACTIVE, on_position):
+                with await download_document(file['file_id'], file['file_name']) as downloaded:
+                    breakdown = await parse_pool.run(user_id, analyze_layers, file['file_name'], downloaded.source())
+        except ParseCancelled:
+            await processing_msg.delete()
+            return
+        except QueueFull as e:
+            await processing_msg.edit_text(queue_full_text(e), reply_markup=layers_keyboard())
+            return
+        except FileTooLarge as e:
+            await processing_msg.edit_text(f"❌ Слишком большой файл: {e}", reply_markup=layers_keyboard())
+            return
+        except asyncio.TimeoutError:
+            await processing_msg.edit_text("⌛ Файл обрабатывается слишком долго", reply_markup=layers_keyboard())
+            return
+        except Exception as e:
+            logger.error(f"Error in layer breakdown: {e}")
+            await processing_msg.edit_text("❌ Не удалось построить разбор по слоям", reply_markup=layers_keyboard())
+            return
+        await processing_msg.delete()
+        if breakdown is None or not len(breakdown.z):
+            await callback.message.answer("⚠️ В файле нет движений для разбора по слоям", reply_markup=layers_keyboard())
+            return
+        await save_breakdown(database, file['file_unique_id'], breakdown)
+
+    await callback.message.answer(
+        format_breakdown(breakdown, file['file_name']),
+        reply_markup=layers_keyboard(),
+        parse_mode="Markdown"
+    )
+
+# Разбор по слоям последней печати, добавленной из файла
+@dp.message(Command("layers"))
+async def cmd_layers(message: types.Message):
+    row = await database.fetchone('''
+        SELECT p.name, p.file_key FROM prints p
+        JOIN layer_breakdowns b ON b.cache_key = p.file_key
+        WHERE p.user_id = ? ORDER BY p.id DESC LIMIT 1
+    ''', (str(message.from_user.id),))
+    breakdown = await load_breakdown(database, row[1]) if row else None
+    if breakdown is None:
+        await message.answer(
+            "📊 Нет печатей с разбором по слоям.\n"
+            "Добавьте печать из файла и нажмите «Разбор по слоям».",
+            reply_markup=main_menu()
+        )
+        return
+    await message.answer(format_breakdown(breakdown, row[0]), reply_markup=main_menu(), parse_mode="Markdown")
+
+# Пересчет сводки из истории печатей (проверка согласованности)
+@dp.message(Command("rebuild_stats"))
+async def cmd_rebuild_stats(message: types.Message):
+    user_id = str(message.from_user.id)
+
+    async with database.transaction() as db:
+        mismatched = await rebuild_user_stats(db, user_id)
+
+    if mismatched:
+        logger.warning(f"User stats mismatch fixed for {user_id}")
+        text = "⚠️ Сводка расходилась с историей печатей и была пересчитана."
+    else:
+        text = "✅ Сводка совпадает с историей печатей."
+    await message.answer(text, reply_markup=main_menu())
+
+# Выгрузка истории печатей файлом. Файл готовится задачей очереди с низким
+# приоритетом и не держит цикл событий (см. export.py)
+async def send_export(message: types.Message, user_id, fmt, date_from=None, date_to=None):
+    processing_msg = await message.answer("⏳ Готовлю выгрузку...")
+    path = None
+    try:
+        async with work_queue.slot(user_id, PRIORITY_BATCH, show_queue_position(processing_msg, "⏳ Готовлю выгрузку...")):
+            path, count = await write_export(database, user_id, fmt, date_from, date_to)
+        if not count:
+            await processing_msg.edit_text("📤 Нет печатей за выбранный период.", reply_markup=main_menu())
+            return
+        await message.answer_document(
+            FSInputFile(path, filename=export_file_name(fmt, date_from, date_to)),
+            caption=f"📤 Печатей в выгрузке: {count}"
+        )
+        await processing_msg.delete()
+    except ParseCancelled:
+        # Пользователь ушел в другое меню, пока выгрузка ждала очереди
+        await processing_msg.delete()
+    except QueueFull as e:
+        await processing_msg.edit_text(queue_full_text(e), reply_markup=main_menu())
+    except ImportError:
+        await processing_msg.edit_text("❌ Выгрузка в XLSX недоступна на сервере, выберите CSV.", reply_markup=main_menu())
+    except Exception as e:
+        logger.error(f"Error in export: {e}")
+        await processing_msg.edit_text("❌ Ошибка при подготовке выгрузки", reply_markup=main_menu())
+    finally:
+        if path is not None:
+            os.remove(path)
+
+# /export [csv|xlsx] [с] [по] - выгрузка за период (даты включительно)
+@dp.message(Command("export"))
+async def cmd_export(message: types.Message, command: CommandObject):
+    try:
+        fmt, date_from, date_to = parse_export_args(command.args)
+    except ValueError as e:
+        await message.answer(
+            f"❌ {e}\n\n"
+            "Формат: /export [csv|xlsx] [с] [по]\n"
+            "Например: /export xlsx 2024-01-01 2024-03-31",
+            reply_markup=main_menu()
+        )
+        return
+    await send_export(message, str(message.from_user.id), fmt, date_from, date_to)
+
+@dp.callback_query(F.data.startswith("export:"))
+async def export_from_dashboard(callback: types.CallbackQuery):
+    await callback.answer()
+    await send_export(callback.message, str(callback.from_user.id), callback.data.split(':', 1)[1])
+
 # Назад
 @dp.callback_query(F.data == "back")
 async def back_to_menu(callback: types.CallbackQuery):
@@ -710,9 +1512,27 @@ async def back_to_menu(callback: types.CallbackQuery):
 
 # Запуск
 async def main():
+    await database.open()
     await init_db()
-    logger.info("Starting bot...")
-    await dp.start_polling(bot)
+    parse_pool.start()
+    metrics_runner = await start_metrics_server() if METRICS_PORT else None
+    sync_task = asyncio.create_task(supabase_sync.run()) if supabase_sync else None
+    logger.info(f"Starting bot in {BOT_MODE} mode...")
+    try:
+        if BOT_MODE == 'webhook':
+            await run_webhook(bot, dp, status=lambda: {'queue': work_queue.snapshot(), 'throttled': throttling.throttled})
+        else:
+            # После режима webhook getUpdates не работает, пока webhook не снят
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        if sync_task is not None:
+            sync_task.cancel()
+            await asyncio.gather(sync_task, return_exceptions=True)
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        parse_pool.shutdown()
+        await database.close()
 
 if __name__ == '__main__':
     asyncio.run(main())
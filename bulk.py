@@ -0,0 +1,350 @@
+import argparse
+import asyncio
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+import zipfile
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+from batch import is_supported, list_archive_members, parse_archive_member
+from costs import DEFAULT_PRICE_PER_GRAM, calculate_cost, sale_price
+from motion import filament_grams
+from parse_cache import ParseCache, content_keys
+from workers import parse_print_file
+
+# Расчет себестоимости каталогов и архивов G-code/3MF без Telegram: файлы
+# разбираются в пуле процессов на всех ядрах, строки пишутся в CSV/JSON Lines
+# по мере готовности и (с --insert) добавляются в prints пачками транзакций.
+# Если база бота есть, результаты разбора берутся из ее кэша по SHA-256
+# содержимого и сохраняются в него: повторный прогон не разбирает файлы заново.
+# Повторный запуск не дублирует печати: у печати из bulk.py file_key - ключ
+# содержимого, и файлы, уже добавленные пользователю, пропускаются даже после
+# переименования или переноса в другой каталог
+#
+#   python bulk.py ~/prints archive.zip --format jsonl --output quote.jsonl
+#   python bulk.py ~/prints --insert --user 123456789 --spool 3 --margin 0.3
+DB_PATH = 'printer_bot.db'
+# Файлов в одной задаче пула: меньше пересылок между процессами на мелких файлах
+BULK_CHUNK_FILES = 16
+# Печатей в одной транзакции при --insert
+BULK_BATCH_ROWS = 500
+OUTPUT_FORMATS = ('csv', 'jsonl')
+OUTPUT_COLUMNS = (
+    'file', 'date', 'weight_g', 'hours', 'dialect', 'material_cost', 'electricity_cost',
+    'amortization', 'total_cost', 'error',
+)
+
+# Файл для разбора: member - имя внутри ZIP (path - архив) или None,
+# key - content_key содержимого (None, пока не посчитан)
+FileTask = namedtuple('FileTask', ['name', 'path', 'member', 'date', 'key'], defaults=[None])
+BulkRow = namedtuple('BulkRow', ['name', 'date', 'weight', 'hours', 'dialect', 'cost', 'error', 'key'])
+
+
+def _archive_tasks(path, name):
+    with zipfile.ZipFile(path) as archive:
+        dates = {info.filename: date(*info.date_time[:3]) for info in archive.infolist()}
+    for member in list_archive_members(path):
+        yield FileTask(f'{name}/{member}', path, member, dates[member])
+
+
+def _file_task(path, name):
+    if path.lower().endswith('.zip'):
+        return _archive_tasks(path, name)
+    if is_supported(path):
+        return [FileTask(name, path, None, date.fromtimestamp(os.path.getmtime(path)))]
+    return []
+
+
+# Обход путей: каталоги рекурсивно (по алфавиту), ZIP-архивы - по членам.
+# Имя строки - путь относительно переданного каталога
+def iter_tasks(paths):
+    for root in paths:
+        if not os.path.isdir(root):
+            yield from _file_task(root, os.path.basename(root))
+            continue
+        for directory, subdirs, files in os.walk(root):
+            subdirs.sort()
+            for file_name in sorted(files):
+                path = os.path.join(directory, file_name)
+                yield from _file_task(path, os.path.relpath(path, root))
+
+
+# Выполняется в процессе пула. Исключение заменяется строкой: не всякое
+# исключение парсера переживает pickle при возврате из процесса
+def _parse_chunk(tasks):
+    results = []
+    for task in tasks:
+        try:
+            if task.member is None:
+                results.append(parse_print_file(task.name, task.path))
+            else:
+                results.append(parse_archive_member(task.path, task.member))
+        except Exception as e:
+            results.append(str(e) or type(e).__name__)
+    return results
+
+
+def _chunks(tasks, size):
+    chunk = []
+    for task in tasks:
+        chunk.append(task)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Пачки задач; с hashed - с ключами содержимого. SHA-256 считается в потоке:
+# большой файл не останавливает цикл событий
+async def task_chunks(tasks, chunk_size=BULK_CHUNK_FILES, hashed=False):
+    for chunk in _chunks(tasks, chunk_size):
+        if hashed:
+            keys = await asyncio.to_thread(content_keys, [(task.path, task.member) for task in chunk])
+            chunk = [task._replace(key=key) for task, key in zip(chunk, keys)]
+        yield chunk
+
+
+# Результаты пачки в порядке задач: из кэша или из пула. Новые результаты с
+# данными сохраняются в кэш
+async def _chunk_results(chunk, cached, future, cache):
+    parsed = iter(await future if future is not None else ())
+    items = []
+    for task, result in zip(chunk, cached):
+        if result is None:
+            result = next(parsed)
+            if (cache is not None and task.key and not isinstance(result, str)
+                    and (result.weight_grams or result.time_hours)):
+                await cache.put(task.key, result)
+        items.append((task, result))
+    return items
+
+
+# (FileTask, ParseResult или текст ошибки) в порядке обхода. chunks - пачки из
+# task_chunks; с cache в пул уходят только файлы, которых нет в кэше. В пуле
+# не больше двух пачек на процесс: обход огромного архива не копит результаты в памяти
+async def parse_files(chunks, workers=None, cache=None):
+    workers = workers or os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    pending = deque()
+    try:
+        async for chunk in chunks:
+            cached = [
+                await cache.get(task.key) if cache is not None and task.key else None for task in chunk
+            ]
+            misses = [task for task, result in zip(chunk, cached) if result is None]
+            future = asyncio.wrap_future(executor.submit(_parse_chunk, misses)) if misses else None
+            pending.append((chunk, cached, future))
+            if len(pending) >= workers * 2:
+                for item in await _chunk_results(*pending.popleft(), cache):
+                    yield item
+        while pending:
+            for item in await _chunk_results(*pending.popleft(), cache):
+                yield item
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+# Строка расчета по результату разбора - те же формулы, что у печатей бота.
+# spool - строка spools: цена за грамм и пересчет длины нити в граммы
+def bulk_row(task, result, settings, spool=None):
+    if isinstance(result, str):
+        return BulkRow(task.name, task.date, None, None, None, None, result, task.key)
+    weight = result.weight_grams
+    if spool is not None and result.filament_mm is not None:
+        weight = filament_grams(result.filament_mm, spool[7], spool[8])  # diameter, density
+    if not (weight and result.time_hours):
+        return BulkRow(task.name, task.date, weight, result.time_hours, result.dialect, None, 'нет данных', task.key)
+    price_per_gram = spool[5] if spool is not None else DEFAULT_PRICE_PER_GRAM
+    cost = calculate_cost(weight, result.time_hours, settings, price_per_gram)
+    return BulkRow(task.name, task.date, weight, result.time_hours, result.dialect, cost, None, task.key)
+
+
+def _round(value, digits):
+    return None if value is None else round(float(value), digits)
+
+
+def _row_values(row):
+    values = [row.name, row.date.isoformat(), _round(row.weight, 2), _round(row.hours, 4), row.dialect]
+    values.extend(_round(value, 2) for value in row.cost or (None,) * 4)
+    values.append(row.error)
+    return values
+
+
+class _CsvOutput:
+    def __init__(self, stream):
+        self._writer = csv.writer(stream)
+        self._writer.writerow(OUTPUT_COLUMNS)
+
+    def write(self, row):
+        self._writer.writerow(['' if value is None else value for value in _row_values(row)])
+
+
+class _JsonlOutput:
+    def __init__(self, stream):
+        self._stream = stream
+
+    def write(self, row):
+        self._stream.write(json.dumps(dict(zip(OUTPUT_COLUMNS, _row_values(row))), ensure_ascii=False) + '\n')
+
+
+OUTPUTS = {'csv': _CsvOutput, 'jsonl': _JsonlOutput}
+
+
+# Пачка печатей одной транзакцией. Филаменты ссылаются на id каждой
+# печати (lastrowid), как в save_print бота. Файл, уже добавленный
+# пользователю, пропускает уникальный индекс по ключу содержимого (миграция 12),
+# как бы ни запускали bulk.py. Возвращает число добавленных печатей
+async def insert_prints(database, user_id, spool, printer_id, margin, rows):
+    inserted = 0
+    async with database.transaction() as db:
+        for row in rows:
+            price = sale_price(row.cost.total_cost, margin)
+            cursor = await db.execute('''
+                INSERT OR IGNORE INTO prints (
+                    user_id, date, name, spool_id, spool_name, weight, hours,
+                    sale_price, material_cost, electricity_cost_calc,
+                    amortization, total_cost, profit, file_key, printer_id
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                user_id, row.date.isoformat(), row.name, spool[0], spool[2], row.weight, row.hours,
+                price, *row.cost, price - row.cost.total_cost, row.key, printer_id
+            ))
+            # Пропущенная строка не меняет lastrowid - филаменты только у новой печати
+            if not cursor.rowcount:
+                continue
+            inserted += 1
+            await db.execute('''
+                INSERT INTO print_filaments (print_id, slot, user_id, spool_id, weight, material_cost)
+                VALUES (?, 1, ?, ?, ?, ?)
+            ''', (cursor.lastrowid, user_id, spool[0], row.weight, row.cost.material_cost))
+    return inserted
+
+
+async def run(args, output):
+    from database import Database
+    from farm import get_printer
+    from migrations import apply_migrations
+    from printer_settings import PrinterSettings, SettingsStore
+
+    database = cache = None
+    settings, spool, printer, existing = PrinterSettings(), None, None, set()
+    # База нужна для --user и для кэша разбора, если бот ее уже создал
+    if args.user or os.path.exists(args.db):
+        database = Database(args.db, readers=1)
+        await database.open()
+        await apply_migrations(database)
+    try:
+        if database is not None:
+            cache = ParseCache(database)
+        if args.user:
+            settings = await SettingsStore(database).get(args.user)
+            if args.spool:
+                spool = await database.fetchone(
+                    'SELECT * FROM spools WHERE user_id = ? AND id = ?', (args.user, args.spool)
+                )
+                if spool is None:
+                    raise SystemExit(f"Катушка {args.spool} пользователя {args.user} не найдена")
+            if args.printer:
+                printer = await get_printer(database, args.user, args.printer)
+                if printer is None:
+                    raise SystemExit(f"Принтер {args.printer} пользователя {args.user} не найден")
+                settings = printer.settings(settings)
+            if args.insert:
+                existing = {row[0] for row in await database.fetchall(
+                    'SELECT file_key FROM prints WHERE user_id = ? AND file_key IS NOT NULL', (args.user,)
+                )}
+
+        printer_id = printer.id if printer else None
+        writer = OUTPUTS[args.format](output)
+        started = time.perf_counter()
+        total = priced = inserted = skipped = 0
+        batch = []
+
+        # Уже добавленные файлы отсеиваются по ключу содержимого до разбора.
+        # С --insert ключ принятого файла сразу попадает в existing: копия того
+        # же содержимого дальше в этом же запуске тоже пропускается
+        async def new_chunks():
+            nonlocal skipped
+            async for chunk in task_chunks(iter_tasks(args.paths), args.chunk_size, hashed=cache is not None):
+                fresh = []
+                for task in chunk:
+                    if task.key in existing:
+                        skipped += 1
+                        continue
+                    fresh.append(task)
+                    if args.insert and task.key:
+                        existing.add(task.key)
+                if fresh:
+                    yield fresh
+
+        async for task, result in parse_files(new_chunks(), args.workers, cache):
+            row = bulk_row(task, result, settings, spool)
+            writer.write(row)
+            total += 1
+            if row.cost:
+                priced += 1
+                if args.insert:
+                    batch.append(row)
+            if len(batch) >= args.batch_rows:
+                inserted += await insert_prints(database, args.user, spool, printer_id, args.margin, batch)
+                batch = []
+        if batch:
+            inserted += await insert_prints(database, args.user, spool, printer_id, args.margin, batch)
+    finally:
+        if database is not None:
+            await database.close()
+
+    elapsed = time.perf_counter() - started
+    summary = f"Файлов: {total}, рассчитано: {priced}, без расчета: {total - priced}"
+    if args.insert:
+        summary += f", добавлено печатей: {inserted}, уже были: {skipped}"
+    if cache is not None:
+        summary += f", из кэша: {cache.hits}"
+    summary += f"; {elapsed:.1f} с ({total / elapsed if elapsed else 0:.0f} файлов/с)"
+    print(summary, file=sys.stderr)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Себестоимость печати для каталогов и архивов G-code/3MF")
+    parser.add_argument('paths', nargs='+', help="каталоги, ZIP-архивы и файлы .gcode/.gco/.3mf")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='csv', help="формат строк (csv)")
+    parser.add_argument('--output', default='-', help="файл для строк, - для stdout")
+    parser.add_argument('--workers', type=int, help="процессов разбора (все ядра)")
+    parser.add_argument('--chunk-size', type=int, default=BULK_CHUNK_FILES, help="файлов в задаче пула")
+    parser.add_argument('--db', default=DB_PATH, help="база бота")
+    parser.add_argument('--user', help="Telegram id: настройки принтера, катушка и принтер фермы из базы")
+    parser.add_argument('--spool', type=int, help="id катушки: цена за грамм, диаметр и плотность нити")
+    parser.add_argument('--printer', type=int, help="id принтера фермы для электричества и амортизации")
+    parser.add_argument('--insert', action='store_true', help="добавить рассчитанные файлы в печати пользователя")
+    parser.add_argument('--margin', type=float, help="доля прибыли в цене продажи, обязательна для --insert")
+    parser.add_argument('--batch-rows', type=int, default=BULK_BATCH_ROWS, help="печатей в транзакции")
+    args = parser.parse_args(argv)
+    if args.insert and not (args.user and args.spool):
+        parser.error("--insert требует --user и --spool")
+    if (args.spool or args.printer) and not args.user:
+        parser.error("--spool и --printer требуют --user")
+    # Без наценки печати легли бы в статистику с нулевой прибылью
+    if args.insert and args.margin is None:
+        parser.error("--insert требует --margin, например --margin 0.3")
+    if args.margin is not None and not 0 <= args.margin < 1:
+        parser.error("--margin должна быть в диапазоне [0, 1)")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.output == '-':
+        asyncio.run(run(args, sys.stdout))
+        return
+    with open(args.output, 'w', newline='', encoding='utf-8') as output:
+        asyncio.run(run(args, output))
+
+
+if __name__ == '__main__':
+    main()
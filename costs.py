@@ -0,0 +1,63 @@
+from collections import namedtuple
+
+import numpy as np
+
+# Цена пластика для примерного расчета, когда катушка не выбрана (PLA)
+DEFAULT_PRICE_PER_GRAM = 1.5
+HOURS_PER_MONTH = 30 * 24
+# Целевая маржа для подбора цены продажи: доля прибыли в цене
+DEFAULT_MARGINS = (0.2, 0.35, 0.5)
+
+CostBreakdown = namedtuple('CostBreakdown', ['material_cost', 'electricity_cost', 'amortization', 'total_cost'])
+QuoteMatrix = namedtuple('QuoteMatrix', [
+    'material_cost', 'electricity_cost', 'amortization', 'total_cost', 'sale_price', 'tariffs', 'margins'
+])
+
+
+# Формулы работают и с числами, и с массивами NumPy (поэлементно)
+def electricity_cost(hours, printer_power, tariff):
+    return hours * printer_power * tariff
+
+
+def amortization_cost(hours, printer_cost, amortization_months):
+    return hours * (printer_cost / amortization_months) / HOURS_PER_MONTH
+
+
+# Цена, при которой прибыль составляет margin от цены продажи
+def sale_price(total_cost, margin):
+    return total_cost / (1 - margin)
+
+
+# Себестоимость печати:
+#   материал = вес × цена_за_грамм
+#   электричество = часы × мощность_принтера × тариф
+#   амортизация = часы × (стоимость_принтера / срок_амортизации) / (30 × 24)
+# Для нескольких филаментов weight и price_per_gram - векторы по слотам,
+# материал - их скалярное произведение
+def calculate_cost(weight, hours, settings, price_per_gram=DEFAULT_PRICE_PER_GRAM):
+    material_cost = float(np.sum(np.multiply(weight, price_per_gram)))
+    electricity = electricity_cost(hours, settings.printer_power, settings.electricity_cost)
+    amortization = amortization_cost(hours, settings.printer_cost, settings.amortization_months)
+    return CostBreakdown(material_cost, electricity, amortization,
+                         material_cost + electricity + amortization)
+
+
+# Сметы для всех катушек × тарифов × целевых маржей одним проходом NumPy.
+# weight - граммы (число) или вектор по катушкам (если вес считается по длине
+# нити и зависит от плотности), prices_per_gram - вектор по катушкам (S),
+# tariffs - тарифы ₽/кВт·ч (T, по умолчанию из настроек), margins - (M).
+# Результат: material_cost (S), electricity_cost (T), total_cost (S, T),
+# sale_price (S, T, M)
+def quote_matrix(weight, hours, settings, prices_per_gram, margins=DEFAULT_MARGINS, tariffs=None):
+    prices = np.asarray(prices_per_gram, dtype=np.float64)
+    margins = np.asarray(margins, dtype=np.float64)
+    if np.any((margins < 0) | (margins >= 1)):
+        raise ValueError("Margin must be in [0, 1)")
+    tariffs = np.asarray([settings.electricity_cost] if tariffs is None else tariffs, dtype=np.float64)
+
+    material = np.broadcast_to(np.multiply(weight, prices), prices.shape)
+    electricity = electricity_cost(hours, settings.printer_power, tariffs)
+    amortization = amortization_cost(hours, settings.printer_cost, settings.amortization_months)
+    total = material[:, None] + electricity[None, :] + amortization
+    return QuoteMatrix(material, electricity, amortization, total,
+                       sale_price(total[:, :, None], margins), tariffs, margins)
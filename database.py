@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+from metrics import DB_QUERY_SECONDS, DB_WAIT_SECONDS, statement_name
+
+logger = logging.getLogger(__name__)
+
+# Настройки соединений: WAL позволяет читателям не ждать писателя,
+# synchronous=NORMAL безопасен в режиме WAL и не делает fsync на каждый commit
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA busy_timeout = 5000',
+    'PRAGMA foreign_keys = ON',
+)
+# Размер кэша подготовленных выражений sqlite3 на соединение
+CACHED_STATEMENTS = 256
+
+
+# Долгоживущие соединения с базой: один писатель и пул читателей.
+# Открываются один раз при запуске бота вместо connect() в каждом обработчике
+class Database:
+    def __init__(self, path, readers=2):
+        self.path = path
+        self.readers = readers
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._pool = None
+        self._connections = []
+        # Ожидание соединений (writer - блокировка записи, reader - пул читателей):
+        # число ожиданий, суммарное и наибольшее время (сек)
+        self.waits = Counter()
+        self.wait_seconds = Counter()
+        self.wait_max = Counter()
+
+    async def _connect(self):
+        conn = await aiosqlite.connect(self.path, cached_statements=CACHED_STATEMENTS)
+        for pragma in PRAGMAS:
+            await conn.execute(pragma)
+        self._connections.append(conn)
+        return conn
+
+    async def open(self):
+        if self._writer is not None:
+            return
+        self._writer = await self._connect()
+        self._pool = asyncio.Queue()
+        for _ in range(self.readers):
+            self._pool.put_nowait(await self._connect())
+        logger.info(f"Database opened with {self.readers} reader connections")
+
+    async def close(self):
+        if self._writer is None:
+            return
+        # Дожидаемся завершения текущей записи
+        async with self._write_lock:
+            for conn in self._connections:
+                await conn.close()
+        self._connections.clear()
+        self._writer = None
+        self._pool = None
+        logger.info("Database closed")
+
+    def _waited(self, connection, started):
+        seconds = time.perf_counter() - started
+        self.waits[connection] += 1
+        self.wait_seconds[connection] += seconds
+        self.wait_max[connection] = max(self.wait_max[connection], seconds)
+        DB_WAIT_SECONDS.observe(seconds, connection)
+
+    @asynccontextmanager
+    async def reader(self):
+        started = time.perf_counter()
+        conn = await self._pool.get()
+        self._waited('reader', started)
+        try:
+            yield conn
+        finally:
+            self._pool.put_nowait(conn)
+
+    # Транзакция на соединении-писателе: commit при успехе, rollback при ошибке
+    @asynccontextmanager
+    async def transaction(self):
+        started = time.perf_counter()
+        async with self._write_lock:
+            self._waited('writer', started)
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            else:
+                await self._writer.commit()
+
+    # Потоковое чтение большой выборки пачками по batch_size строк. Отдельное
+    # соединение: читатели пула не заняты на все время выгрузки, а курсор видит
+    # один снимок базы (WAL), даже если печати добавляются параллельно
+    async def stream(self, sql, params=(), batch_size=1000):
+        conn = await aiosqlite.connect(self.path)
+        try:
+            for pragma in PRAGMAS:
+                await conn.execute(pragma)
+            await conn.execute('PRAGMA query_only = ON')
+            async with conn.execute(sql, params) as cursor:
+                while rows := await cursor.fetchmany(batch_size):
+                    yield rows
+        finally:
+            await conn.close()
+
+    # Время запросов (вместе с ожиданием соединения) - в метрике по виду запроса
+    async def fetchone(self, sql, params=()):
+        with DB_QUERY_SECONDS.time(statement_name(sql)):
+            async with self.reader() as conn:
+                async with conn.execute(sql, params) as cursor:
+                    return await cursor.fetchone()
+
+    async def fetchall(self, sql, params=()):
+        with DB_QUERY_SECONDS.time(statement_name(sql)):
+            async with self.reader() as conn:
+                async with conn.execute(sql, params) as cursor:
+                    return await cursor.fetchall()
+
+    async def execute(self, sql, params=()):
+        with DB_QUERY_SECONDS.time(statement_name(sql)):
+            async with self.transaction() as conn:
+                cursor = await conn.execute(sql, params)
+                return cursor.lastrowid
@@ -0,0 +1,105 @@
+import io
+import os
+import tempfile
+
+from metrics import DOWNLOAD_BYTES, DOWNLOAD_SECONDS
+
+# Скачивание документов Telegram потоково, кусками. Небольшие файлы остаются
+# в памяти, большие сбрасываются во временный файл на диске, поэтому память
+# процесса бота не растет с размером загрузок. Скачивание обрывается, как
+# только файл превысил лимит
+DOWNLOAD_MAX_BYTES = int(os.getenv('DOWNLOAD_MAX_BYTES', 200 * 1024 * 1024))
+DOWNLOAD_MEMORY_BYTES = int(os.getenv('DOWNLOAD_MEMORY_BYTES', 1024 * 1024))
+DOWNLOAD_TIMEOUT = int(os.getenv('DOWNLOAD_TIMEOUT', 300))
+DOWNLOAD_CHUNK_BYTES = 256 * 1024
+
+
+def format_megabytes(size):
+    return f"{round(size / 1024 ** 2, 1):g} МБ"
+
+
+class FileTooLarge(Exception):
+    def __init__(self, limit):
+        super().__init__(f"файл больше {format_megabytes(limit)}")
+        self.limit = limit
+
+
+class SpooledDownload:
+    # Приемник для bot.download_file: пока скачано не больше memory_bytes,
+    # данные в памяти, дальше - во временном файле (у него есть путь для пула
+    # процессов, в отличие от tempfile.SpooledTemporaryFile)
+    def __init__(self, suffix='', memory_bytes=None, max_bytes=None, dir=None):
+        self.suffix = suffix
+        self.memory_bytes = DOWNLOAD_MEMORY_BYTES if memory_bytes is None else memory_bytes
+        self.max_bytes = DOWNLOAD_MAX_BYTES if max_bytes is None else max_bytes
+        self.dir = dir
+        self.size = 0
+        self.path = None
+        self._buffer = io.BytesIO()
+        self._file = self._buffer
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.max_bytes and self.size > self.max_bytes:
+            raise FileTooLarge(self.max_bytes)
+        if self.path is None and self.size > self.memory_bytes:
+            self.rollover()
+        return self._file.write(chunk)
+
+    def flush(self):
+        # bot.download_file вызывает flush после каждого куска - буфер
+        # файла сбрасывается только перед передачей пути в source()
+        pass
+
+    # Перенос уже скачанного из памяти во временный файл
+    def rollover(self):
+        if self.path is not None:
+            return
+        fd, self.path = tempfile.mkstemp(suffix=self.suffix, dir=self.dir)
+        self._file = os.fdopen(fd, 'wb')
+        self._file.write(self._buffer.getbuffer())
+        self._buffer = None
+
+    # Что передать в пул процессов: путь к файлу или содержимое из памяти
+    def source(self):
+        if self.path is None:
+            return self._buffer.getvalue()
+        self._file.flush()
+        return self.path
+
+    def close(self):
+        self._file.close()
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Скачивание документа. Размер из апдейта и из getFile проверяется до
+# скачивания, фактический - по мере прихода кусков
+async def download(bot, file_id, file_name, file_size=None, memory_bytes=None, max_bytes=None, dir=None):
+    target = SpooledDownload(os.path.splitext(file_name)[1], memory_bytes, max_bytes, dir)
+    if target.max_bytes and (file_size or 0) > target.max_bytes:
+        raise FileTooLarge(target.max_bytes)
+    try:
+        file = await bot.get_file(file_id)
+        if target.max_bytes and (file.file_size or 0) > target.max_bytes:
+            raise FileTooLarge(target.max_bytes)
+        with DOWNLOAD_SECONDS.time():
+            await bot.download_file(
+                file.file_path, destination=target, timeout=DOWNLOAD_TIMEOUT,
+                chunk_size=DOWNLOAD_CHUNK_BYTES, seek=False
+            )
+    except BaseException:
+        target.close()
+        raise
+    finally:
+        DOWNLOAD_BYTES.inc(amount=target.size)
+    return target
@@ -0,0 +1,154 @@
+import asyncio
+import csv
+import os
+import tempfile
+from contextlib import aclosing, suppress
+from datetime import date, datetime
+
+# Выгрузка истории печатей в CSV или XLSX. Строки читаются курсором пачками
+# по EXPORT_BATCH_ROWS и сразу пишутся во временный файл (в потоке, чтобы не
+# держать цикл событий), поэтому память не зависит от числа печатей
+EXPORT_BATCH_ROWS = int(os.getenv('EXPORT_BATCH_ROWS', 1000))
+EXPORT_FORMATS = ('csv', 'xlsx')
+DATE_FORMATS = ('%Y-%m-%d', '%d.%m.%Y')
+
+# (колонка prints, заголовок в файле)
+EXPORT_COLUMNS = (
+    ('date', 'date'),
+    ('name', 'name'),
+    ('spool_name', 'spool'),
+    ('weight', 'weight_g'),
+    ('hours', 'hours'),
+    ('sale_price', 'sale_price'),
+    ('material_cost', 'material_cost'),
+    ('electricity_cost_calc', 'electricity_cost'),
+    ('amortization', 'amortization'),
+    ('total_cost', 'total_cost'),
+    ('profit', 'profit'),
+)
+
+
+def parse_date(text):
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            pass
+    raise ValueError(f"Не удалось разобрать дату «{text}», нужен формат ГГГГ-ММ-ДД или ДД.ММ.ГГГГ")
+
+
+# Аргументы /export: [csv|xlsx] [с] [по] -> (формат, с, по)
+def parse_export_args(args):
+    fmt, dates = 'csv', []
+    for token in (args or '').split():
+        if token.lower() in EXPORT_FORMATS:
+            fmt = token.lower()
+        else:
+            dates.append(parse_date(token))
+    if len(dates) > 2:
+        raise ValueError("Укажите не больше двух дат: начало и конец периода")
+    date_from = dates[0] if dates else None
+    date_to = dates[1] if len(dates) > 1 else None
+    if date_from and date_to and date_from > date_to:
+        raise ValueError("Начало периода позже конца")
+    return fmt, date_from, date_to
+
+
+def export_file_name(fmt, date_from=None, date_to=None):
+    period = ''.join(f"_{day.isoformat()}" if day else '_' for day in (date_from, date_to)).rstrip('_')
+    return f"prints{period}.{fmt}"
+
+
+class _CsvWriter:
+    def __init__(self, path):
+        # BOM - чтобы Excel открыл кириллицу в UTF-8
+        self._file = open(path, 'w', newline='', encoding='utf-8-sig')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow([header for _, header in EXPORT_COLUMNS])
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+    # Прерванная выгрузка: файл закрывается, чтобы его можно было удалить
+    def discard(self):
+        self._file.close()
+
+
+class _XlsxWriter:
+    def __init__(self, path):
+        # Необязательная зависимость: pip install openpyxl
+        from openpyxl import Workbook
+        from openpyxl.cell import WriteOnlyCell
+
+        self.path = path
+        self._cell = WriteOnlyCell
+        # write_only: строки уходят во временный файл openpyxl, а не в память
+        self._workbook = Workbook(write_only=True)
+        self._sheet = self._workbook.create_sheet('prints')
+        self._sheet.append([header for _, header in EXPORT_COLUMNS])
+
+    def _date(self, value):
+        try:
+            day = date.fromisoformat(str(value)[:10])
+        except ValueError:
+            return value
+        cell = self._cell(self._sheet, value=day)
+        cell.number_format = 'YYYY-MM-DD'
+        return cell
+
+    def write(self, rows):
+        for row in rows:
+            self._sheet.append([self._date(row[0]), *row[1:]])
+
+    def close(self):
+        self._workbook.save(self.path)
+
+    # Прерванная выгрузка: закрываем и удаляем временный файл строк openpyxl
+    # (без save он остается открытым до конца процесса)
+    def discard(self):
+        writer = getattr(self._sheet, '_writer', None)
+        if writer is None:
+            return
+        with suppress(Exception):
+            self._sheet.close()
+        with suppress(OSError, ValueError):
+            writer.cleanup()
+
+
+WRITERS = {'csv': _CsvWriter, 'xlsx': _XlsxWriter}
+
+
+# Выгрузка печатей пользователя за период (границы включительно) во временный
+# файл. Возвращает (путь, число строк); файл удаляет вызывающий
+async def write_export(database, user_id, fmt, date_from=None, date_to=None, dir=None):
+    sql = f"SELECT {', '.join(column for column, _ in EXPORT_COLUMNS)} FROM prints WHERE user_id = ?"
+    params = [user_id]
+    if date_from:
+        sql += ' AND date >= ?'
+        params.append(date_from.isoformat())
+    if date_to:
+        sql += ' AND date <= ?'
+        params.append(date_to.isoformat())
+    sql += ' ORDER BY date, id'
+
+    fd, path = tempfile.mkstemp(suffix=f'.{fmt}', dir=dir)
+    os.close(fd)
+    count = 0
+    writer = None
+    try:
+        writer = await asyncio.to_thread(WRITERS[fmt], path)
+        async with aclosing(database.stream(sql, params, EXPORT_BATCH_ROWS)) as batches:
+            async for rows in batches:
+                await asyncio.to_thread(writer.write, rows)
+                count += len(rows)
+        await asyncio.to_thread(writer.close)
+    except BaseException:
+        # Сначала закрыть файлы писателя: открытый файл не удалить (Windows)
+        if writer is not None:
+            writer.discard()
+        os.remove(path)
+        raise
+    return path, count
@@ -0,0 +1,161 @@
+import time
+from dataclasses import dataclass, fields, replace
+
+from costs import amortization_cost, electricity_cost
+from layers import escape_markdown
+from scheduler import Job, Machine, schedule
+
+# Запас по сроку при оптимизации стоимости: план может закончиться на
+# столько позже самого быстрого
+FARM_DEADLINE_SLACK = 1.25
+# Сколько строк плана показывать на принтер
+FARM_ROWS_PER_PRINTER = 8
+
+
+# Принтер фермы пользователя: у каждого своя стоимость, срок амортизации,
+# мощность, время, до которого он занят, и заправленный пластик. Тариф на
+# электричество - общий, из настроек пользователя
+@dataclass(frozen=True, slots=True)
+class FarmPrinter:
+    id: int
+    name: str
+    printer_cost: float
+    amortization_months: int
+    printer_power: float
+    # Время (unix), до которого принтер занят; 0 - свободен
+    busy_until: float = 0
+    # Заправленный пластик (PLA, PETG, ...); None - неизвестен
+    material: str | None = None
+
+    # Настройки пользователя с параметрами этого принтера - для calculate_cost
+    def settings(self, settings):
+        return replace(
+            settings, printer_cost=self.printer_cost,
+            amortization_months=self.amortization_months, printer_power=self.printer_power
+        )
+
+    # Электричество и амортизация за час печати
+    def hourly_cost(self, tariff):
+        return (electricity_cost(1, self.printer_power, tariff)
+                + amortization_cost(1, self.printer_cost, self.amortization_months))
+
+    def available_in(self, now=None):
+        return max(0.0, (self.busy_until - (time.time() if now is None else now)) / 3600)
+
+
+PRINTER_FIELDS = tuple(f.name for f in fields(FarmPrinter))
+
+
+async def list_printers(database, user_id):
+    rows = await database.fetchall(
+        f"SELECT {', '.join(PRINTER_FIELDS)} FROM printers WHERE user_id = ? ORDER BY id", (user_id,)
+    )
+    return [FarmPrinter(*row) for row in rows]
+
+
+async def get_printer(database, user_id, printer_id):
+    row = await database.fetchone(
+        f"SELECT {', '.join(PRINTER_FIELDS)} FROM printers WHERE user_id = ? AND id = ?", (user_id, printer_id)
+    )
+    return FarmPrinter(*row) if row else None
+
+
+async def add_printer(database, user_id, name, printer_cost, amortization_months, printer_power):
+    printer_id = await database.execute('''
+        INSERT INTO printers (user_id, name, printer_cost, amortization_months, printer_power)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (user_id, name, printer_cost, amortization_months, printer_power))
+    return FarmPrinter(printer_id, name, printer_cost, amortization_months, printer_power)
+
+
+async def delete_printer(database, user_id, printer_id):
+    await database.execute('DELETE FROM printers WHERE user_id = ? AND id = ?', (user_id, printer_id))
+
+
+# Пластик приводится к верхнему регистру, как типы из файлов слайсеров
+async def set_material(database, user_id, printer_id, material):
+    material = (material or '').strip().upper() or None
+    await database.execute(
+        'UPDATE printers SET material = ? WHERE user_id = ? AND id = ?', (material, user_id, printer_id)
+    )
+
+
+# Принтер занят еще hours часов (0 - освободился)
+async def set_busy(database, user_id, printer_id, hours):
+    busy_until = time.time() + hours * 3600 if hours > 0 else 0
+    await database.execute(
+        'UPDATE printers SET busy_until = ? WHERE user_id = ? AND id = ?', (busy_until, user_id, printer_id)
+    )
+
+
+def farm_machines(printers, tariff, now=None):
+    now = time.time() if now is None else now
+    return [
+        Machine(printer.id, printer.name, printer.hourly_cost(tariff), printer.available_in(now), printer.material)
+        for printer in printers
+    ]
+
+
+# План для фермы: самый быстрый или самый дешевый, но не дольше самого
+# быстрого с запасом slack
+def plan_farm(jobs, machines, objective='makespan', slack=FARM_DEADLINE_SLACK):
+    fastest = schedule(jobs, machines)
+    if objective == 'makespan':
+        return fastest
+    return schedule(jobs, machines, objective, deadline=fastest.makespan * slack)
+
+
+# Задания из строк пакетной сметы: [название, часы, граммы, пластик или None]
+# (в сметах, сохраненных до учета пластика, его нет)
+def farm_jobs(rows):
+    return [Job(index, *row) for index, row in enumerate(rows)]
+
+
+# Обратная кавычка закрыла бы моноширинный блок
+def _name(name, width=24):
+    return name[:width].replace('`', "'")
+
+
+def _hours(value):
+    return f"{value:.1f} ч" if value < 48 else f"{value / 24:.1f} дн"
+
+
+# Перед заданием со сменой пластика - на какой пластик меняется
+def _slot_row(slot):
+    change = f"🔄 {_name(slot.job.material, 8)} " if slot.change else ""
+    return f"{_hours(slot.start):>8} {change}{_name(slot.job.name)}"
+
+
+# План фермы для сообщения (Markdown). Если не помещается в max_length,
+# строк на принтер показывается меньше
+def format_schedule(plan, rows_per_printer=FARM_ROWS_PER_PRINTER, max_length=4000):
+    title = "⏱ быстрее всего" if plan.objective == 'makespan' else "💰 дешевле всего"
+    header = [
+        f"🏭 *План печати ({title})*\n",
+        f"Заданий: {len(plan.slots)}",
+        f"Все готово через: {_hours(plan.makespan)}",
+        f"Электричество и амортизация: {plan.cost:.2f} ₽",
+    ]
+    if plan.changes:
+        header.append(f"Смен пластика: {plan.changes}")
+
+    by_machine = {}
+    for slot in plan.slots:
+        by_machine.setdefault(slot.machine, []).append(slot)
+    for rows_limit in dict.fromkeys((rows_per_printer, 2, 0)):
+        lines = list(header)
+        for machine, slots in by_machine.items():
+            # Имя и пластик вводит пользователь - экранируем разметку
+            name = escape_markdown(machine.name)
+            material = f" ({escape_markdown(machine.material)})" if machine.material else ""
+            lines.append(f"\n🖨 *{name}*{material} - {len(slots)} шт., до {_hours(slots[-1].end)}")
+            if not rows_limit:
+                continue
+            rows = [_slot_row(slot) for slot in slots[:rows_limit]]
+            if len(slots) > rows_limit:
+                rows.append(f"… еще {len(slots) - rows_limit}")
+            lines.append("```\n" + "\n".join(rows) + "\n```")
+        text = "\n".join(lines)
+        if len(text) <= max_length:
+            break
+    return text
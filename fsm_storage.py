@@ -0,0 +1,112 @@
+import json
+import os
+import time
+from collections import Counter
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from aiogram.fsm.storage.memory import MemoryStorage
+
+# Хранилище состояний FSM (заполняемые формы). По умолчанию - SQLite в общей
+# базе бота: формы переживают перезапуск, а несколько процессов-воркеров
+# видят одни и те же состояния. redis - для воркеров на разных машинах
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'sqlite')
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+# Незавершенная форма забывается через FSM_STATE_TTL секунд без изменений
+FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', 24 * 3600))
+# Как часто удалять просроченные строки (сек)
+PURGE_INTERVAL = 3600
+
+
+def _state_name(state):
+    return state.state if isinstance(state, State) else state
+
+
+# Строка на ключ (бот, чат, пользователь): состояние и данные формы в JSON
+class SQLiteStorage(BaseStorage):
+    def __init__(self, database, ttl=None):
+        self.database = database
+        self.ttl = FSM_STATE_TTL if ttl is None else ttl
+        self.key_builder = DefaultKeyBuilder()
+        self._purged_at = 0.0
+
+    async def _read(self, key, column):
+        row = await self.database.fetchone(
+            f'SELECT {column} FROM fsm_states WHERE key = ? AND updated_at > ?',
+            (self.key_builder.build(key), time.time() - self.ttl)
+        )
+        return row[0] if row else None
+
+    # Чтение-изменение-запись в транзакции писателя. BEGIN IMMEDIATE сразу
+    # берет блокировку записи, поэтому изменение атомарно и между процессами.
+    # change(state, data) -> (state, data); пустая форма удаляет строку
+    async def _write(self, key, change):
+        storage_key = self.key_builder.build(key)
+        now = time.time()
+        async with self.database.transaction() as db:
+            await db.execute('BEGIN IMMEDIATE')
+            async with db.execute(
+                'SELECT state, data FROM fsm_states WHERE key = ? AND updated_at > ?',
+                (storage_key, now - self.ttl)
+            ) as cursor:
+                row = await cursor.fetchone()
+            state, data = change(row[0] if row else None, json.loads(row[1]) if row else {})
+            if state is None and not data:
+                await db.execute('DELETE FROM fsm_states WHERE key = ?', (storage_key,))
+            else:
+                await db.execute(
+                    'INSERT OR REPLACE INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)',
+                    (storage_key, state, json.dumps(data, ensure_ascii=False), now)
+                )
+            if now - self._purged_at > PURGE_INTERVAL:
+                self._purged_at = now
+                await db.execute('DELETE FROM fsm_states WHERE updated_at <= ?', (now - self.ttl,))
+        return data
+
+    async def set_state(self, key, state=None):
+        await self._write(key, lambda _, data: (_state_name(state), data))
+
+    async def get_state(self, key):
+        return await self._read(key, 'state')
+
+    async def set_data(self, key, data):
+        await self._write(key, lambda state, _: (state, dict(data)))
+
+    async def get_data(self, key):
+        data = await self._read(key, 'data')
+        return json.loads(data) if data else {}
+
+    async def update_data(self, key, data):
+        return dict(await self._write(key, lambda state, current: (state, {**current, **data})))
+
+    # Незавершенные формы по состояниям: {состояние: количество}
+    async def count_states(self):
+        rows = await self.database.fetchall(
+            'SELECT state, COUNT(*) FROM fsm_states WHERE state IS NOT NULL AND updated_at > ? GROUP BY state',
+            (time.time() - self.ttl,)
+        )
+        return dict(rows)
+
+    async def close(self):
+        # Соединения принадлежат Database и закрываются вместе с ботом
+        pass
+
+
+# То же для любого хранилища; у redis подсчет не поддерживается (None)
+async def count_states(storage):
+    if isinstance(storage, SQLiteStorage):
+        return await storage.count_states()
+    if isinstance(storage, MemoryStorage):
+        states = Counter(record.state for record in storage.storage.values() if record.state is not None)
+        return dict(states)
+    return None
+
+
+def create_storage(database):
+    if FSM_STORAGE == 'redis':
+        # Необязательная зависимость: pip install redis
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(REDIS_URL, state_ttl=FSM_STATE_TTL, data_ttl=FSM_STATE_TTL)
+    if FSM_STORAGE == 'memory':
+        return MemoryStorage()
+    return SQLiteStorage(database)
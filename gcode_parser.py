@@ -0,0 +1,320 @@
+import io
+import mmap
+import os
+import re
+from collections import namedtuple
+from itertools import chain, islice
+
+# Размеры окон сканирования (байты). Метаданные слайсеров лежат либо в
+# заголовке (Bambu Studio, Cura), либо в подвале файла (PrusaSlicer, OrcaSlicer),
+# поэтому читаем только начало и конец файла и никогда не загружаем его целиком.
+GCODE_HEAD_BYTES = int(os.getenv('GCODE_HEAD_BYTES', 256 * 1024))
+GCODE_TAIL_BYTES = int(os.getenv('GCODE_TAIL_BYTES', 256 * 1024))
+CHUNK_SIZE = 64 * 1024
+
+
+def _open_source(source):
+    # Приводим str/bytes/файл к бинарному потоку
+    if isinstance(source, str):
+        return io.BytesIO(source.encode('utf-8', errors='ignore'))
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+    if isinstance(source, io.TextIOBase):
+        buffer = getattr(source, 'buffer', None)
+        if buffer is None:
+            return io.BytesIO(source.read().encode('utf-8', errors='ignore'))
+        return buffer
+    return source
+
+
+class SequentialReader:
+    # Обертка для сжатых потоков (члены ZIP): seek() по ним распаковывает
+    # данные заново, поэтому сканер должен читать их строго последовательно
+    def __init__(self, stream):
+        self._stream = stream
+
+    def read(self, size=-1):
+        return self._stream.read(size)
+
+    def seekable(self):
+        return False
+
+
+class MappedReader:
+    # Файл, отображенный в память: чтение окон и блоков идет из страничного
+    # кэша ОС, процесс разбора не держит собственных буферов под файл
+    def __init__(self, mapped):
+        self._map = mapped
+
+    def read(self, size=-1):
+        return self._map.read(size)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._map.seek(offset, whence)
+        return self._map.tell()
+
+    def tell(self):
+        return self._map.tell()
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Открытие файла на диске через mmap (пустой файл отобразить нельзя)
+def open_mapped(path):
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return io.BytesIO()
+        return MappedReader(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def _is_seekable(stream):
+    try:
+        return stream.seekable()
+    except (AttributeError, ValueError):
+        return False
+
+
+def _read_head(stream, limit):
+    head = bytearray()
+    while len(head) < limit:
+        chunk = stream.read(min(CHUNK_SIZE, limit - len(head)))
+        if not chunk:
+            return bytes(head), True
+        head += chunk
+    return bytes(head), False
+
+
+def _split_lines(data):
+    return data.decode('utf-8', errors='ignore').splitlines()
+
+
+# Построчный обход заголовка и подвала G-code
+def iter_metadata_lines(source, head_bytes=None, tail_bytes=None):
+    head_bytes = GCODE_HEAD_BYTES if head_bytes is None else head_bytes
+    tail_bytes = GCODE_TAIL_BYTES if tail_bytes is None else tail_bytes
+    stream = _open_source(source)
+
+    head, eof = _read_head(stream, head_bytes)
+    if eof:
+        # Файл целиком поместился в окно заголовка
+        yield from _split_lines(head)
+        return
+
+    # Последняя строка окна может быть обрезана
+    cut = head.rfind(b'\n')
+    yield from _split_lines(head[:cut + 1] if cut >= 0 else b'')
+    if tail_bytes <= 0:
+        return
+
+    if _is_seekable(stream):
+        head_end = stream.tell()
+        end = stream.seek(0, io.SEEK_END)
+        start = max(head_end, end - tail_bytes)
+        stream.seek(start)
+        tail = stream.read(end - start)
+        joined = start == head_end
+    else:
+        # Поток без seek: дочитываем, храня только последние tail_bytes
+        tail = bytearray()
+        consumed = 0
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            consumed += len(chunk)
+            tail += chunk
+            if len(tail) > tail_bytes:
+                del tail[:len(tail) - tail_bytes]
+        joined = consumed == len(tail)
+        tail = bytes(tail)
+
+    if joined:
+        # Подвал начинается сразу за заголовком - досчитываем обрезанную строку
+        tail = head[cut + 1:] + tail if cut >= 0 else head + tail
+    else:
+        # Первая строка подвала может быть обрезана
+        nl = tail.find(b'\n')
+        tail = tail[nl + 1:] if nl >= 0 else b''
+    yield from _split_lines(tail)
+
+
+# Вес метра нити PLA 1.75мм (для файлов, где указана только длина)
+GRAMS_PER_METER = 2.4
+# Сколько первых строк смотреть при определении слайсера
+DETECT_LINES = 30
+
+_NUMBER = re.compile(r'\d+(?:\.\d+)?')
+_DURATION = re.compile(r'(\d+(?:\.\d+)?)\s*([dhms])', re.IGNORECASE)
+_DURATION_SECONDS = {'d': 86400, 'h': 3600, 'm': 60, 's': 1}
+
+# filaments - вес по филаментам/слотам AMS (г), в порядке слайсера;
+# materials - типы пластика по тем же слотам (PLA, PETG, ...), если слайсер их пишет
+GcodeInfo = namedtuple('GcodeInfo', ['dialect', 'weight_grams', 'time_hours', 'filaments', 'materials'],
+                       defaults=[(), ()])
+
+
+def _numbers(value):
+    return [float(n) for n in _NUMBER.findall(value)]
+
+
+# Преобразователи значений. Вес - список граммов по филаментам
+# (значения через запятую у нескольких экструдеров и AMS)
+def _grams(value):
+    return _numbers(value)
+
+
+def _first_grams(value):
+    return _numbers(value)[:1]
+
+
+def _mm(value):
+    return [n / 1000 * GRAMS_PER_METER for n in _numbers(value)]
+
+
+def _first_mm(value):
+    return _mm(value)[:1]
+
+
+def _meters(value):
+    return [n * GRAMS_PER_METER for n in _numbers(value)]
+
+
+def _duration(value):
+    seconds = sum(float(n) * _DURATION_SECONDS[unit.lower()] for n, unit in _DURATION.findall(value))
+    return seconds / 3600
+
+
+def _seconds(value):
+    return int(value) / 3600
+
+
+# Таблица извлекателей: ключ -> (поле, приоритет, шаблон, преобразование).
+# При равном приоритете побеждает более поздняя строка (подвал важнее заголовка)
+_EXTRACTORS = {
+    'total_g': ('weight', 5, r'total filament (?:used|weight) \[g\]\s*[=:]\s*(?P<total_g>.+)', _grams),
+    'used_g': ('weight', 4, r'filament used \[g\]\s*=\s*(?P<used_g>.+)', _grams),
+    's3d_g': ('weight', 4, r'\s*plastic weight:\s*(?P<s3d_g>.+)', _first_grams),
+    'filament_weight': ('weight', 2, r'\s*filament_weight\s*[=:]\s*(?P<filament_weight>.+)', _grams),
+    'used_mm': ('weight', 1, r'(?:total )?filament (?:used|length) \[mm\]\s*[=:]\s*(?P<used_mm>.+)', _mm),
+    's3d_mm': ('weight', 1, r'\s*filament length:\s*(?P<s3d_mm>.+)', _first_mm),
+    'cura_m': ('weight', 1, r'filament used:\s*(?P<cura_m>.+)', _meters),
+    'time_normal': ('time', 4, r'(?:model printing time:[^;]*;\s*)?(?:total estimated time|estimated printing time \(normal mode\))\s*[=:]\s*(?P<time_normal>.+)', _duration),
+    'time_silent': ('time', 2, r'estimated printing time \(silent mode\)\s*=\s*(?P<time_silent>.+)', _duration),
+    'cura_time': ('time', 4, r'(?:print\.)?time:(?P<cura_time>\d+)\s*$', _seconds),
+    's3d_time': ('time', 4, r'\s*build time:\s*(?P<s3d_time>.+)', _duration),
+    'any_time': ('time', 1, r'.*?(?:print|total) time\s*[=:]\s*(?P<any_time>.+)', _duration),
+}
+
+# Слайсеры: (имя, признак в первых строках, ключи извлекателей)
+_BAMBU_KEYS = ('total_g', 'used_g', 'used_mm', 'time_normal', 'time_silent')
+_DIALECTS = (
+    ('bambu', re.compile(r'bambustudio', re.IGNORECASE), _BAMBU_KEYS),
+    ('orca', re.compile(r'orcaslicer', re.IGNORECASE), _BAMBU_KEYS),
+    ('prusa', re.compile(r'prusaslicer|superslicer', re.IGNORECASE), _BAMBU_KEYS),
+    # Только заголовок Cura: слово cura внутри других слов (accuracy) - не признак
+    ('cura', re.compile(r'^;\s*flavor:|generated with cura|\bcura\b', re.IGNORECASE), ('cura_time', 'cura_m')),
+    ('simplify3d', re.compile(r'simplify3d', re.IGNORECASE), ('s3d_g', 's3d_mm', 's3d_time')),
+)
+_GENERIC = 'generic'
+
+
+def _compile(keys):
+    # Один объединенный шаблон на слайсер; сработавший ключ - match.lastgroup
+    alternatives = '|'.join(_EXTRACTORS[key][2] for key in keys)
+    return re.compile(r';\s*(?:' + alternatives + ')', re.IGNORECASE)
+
+
+_PATTERNS = {name: _compile(keys) for name, _, keys in _DIALECTS}
+_PATTERNS[_GENERIC] = _compile(_EXTRACTORS)
+# Типы пластика (PrusaSlicer, OrcaSlicer, Bambu Studio): "; filament_type = PLA;PETG"
+_FILAMENT_TYPE = re.compile(r';\s*filament_type\s*[=:]\s*(.+)', re.IGNORECASE)
+
+
+def _materials(value):
+    return tuple(material.strip().upper() for material in value.split(';') if material.strip())
+
+
+def detect_dialect(lines):
+    for line in lines:
+        for name, signature, _ in _DIALECTS:
+            if signature.search(line):
+                return name
+    return _GENERIC
+
+
+# Разбор метаданных G-code: слайсер, вес (г) и время (ч)
+def parse_gcode_info(source, head_bytes=None, tail_bytes=None):
+    lines = iter_metadata_lines(source, head_bytes, tail_bytes)
+    first = list(islice(lines, DETECT_LINES))
+    dialect = detect_dialect(first)
+    match_line = _PATTERNS[dialect].match
+
+    found = _Found()
+    materials = ()
+    # Строки, которые не разобрал шаблон слайсера, - общим шаблоном: если
+    # слайсер определен ошибочно, метаданные не теряются
+    fallback, match_generic = (_Found(), _PATTERNS[_GENERIC].match) if dialect != _GENERIC else (None, None)
+    for line in chain(first, lines):
+        if not line.startswith(';'):
+            continue
+        match = match_line(line)
+        if match is not None:
+            found.add(match)
+        elif (match := _FILAMENT_TYPE.match(line)) is not None:
+            materials = _materials(match.group(1))
+        elif fallback is not None and (match := match_generic(line)) is not None:
+            fallback.add(match)
+
+    if fallback is not None and found.empty():
+        dialect, found = _GENERIC, fallback
+    weight = found.best['weight'][1]
+    return GcodeInfo(dialect, weight, found.best['time'][1], _scale(found.filaments[1], weight), materials)
+
+
+# Лучшие найденные вес и время (по приоритету извлекателя) и разбивка по филаментам
+class _Found:
+    __slots__ = ('best', 'filaments')
+
+    def __init__(self):
+        self.best = {'weight': (0, None), 'time': (0, None)}
+        self.filaments = ((False, 0), [])
+
+    def add(self, match):
+        key = match.lastgroup
+        field, priority, _, convert = _EXTRACTORS[key]
+        value = convert(match.group(key).strip())
+        if field == 'weight':
+            # Разбивка по филаментам - из самой точной строки со списком
+            rank = (len(value) > 1, priority)
+            if sum(value) and rank >= self.filaments[0]:
+                self.filaments = (rank, value)
+            value = sum(value)
+        if value and priority >= self.best[field][0]:
+            self.best[field] = (priority, value)
+
+    def empty(self):
+        return self.best['weight'][1] is None and self.best['time'][1] is None
+
+
+def _scale(filaments, weight):
+    # Разбивка приводится к итоговому весу (строки слайсера округлены по-разному)
+    total = sum(filaments)
+    if not weight or not total:
+        return ()
+    return tuple(grams * weight / total for grams in filaments)
+
+
+# Функция парсинга G-code
+def parse_gcode(source, head_bytes=None, tail_bytes=None):
+    info = parse_gcode_info(source, head_bytes, tail_bytes)
+    return info.weight_grams, info.time_hours
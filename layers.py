@@ -0,0 +1,136 @@
+import io
+import json
+import zipfile
+
+import numpy as np
+
+from gcode_parser import SequentialReader, open_mapped
+from motion import LayerBreakdown, simulate_gcode
+from threemf import PLATE_GCODE
+
+# Разбор по слоям хранится в layer_breakdowns упакованными массивами float32
+# (BLOB), ключ - тот же, что у кэша разбора (file_unique_id). Печать ссылается
+# на разбор через prints.file_key
+BREAKDOWN_VERSION = 1
+# Сколько самых долгих слоев показывать
+SLOWEST_LAYERS = 5
+
+
+# Разбор по слоям в процессе пула. Для .3mf - G-code первой пластины.
+# source - путь к файлу или содержимое небольшого файла из памяти
+def analyze_layers(file_name, source):
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    if not file_name.lower().endswith('.3mf'):
+        if isinstance(source, io.BytesIO):
+            return simulate_gcode(source, layers=True).layers
+        with open_mapped(source) as f:
+            return simulate_gcode(f, layers=True).layers
+    with zipfile.ZipFile(source) as archive:
+        plates = sorted(
+            (int(match.group(1)), name) for name in archive.namelist()
+            if (match := PLATE_GCODE.match(name))
+        )
+        if not plates:
+            return None
+        with archive.open(plates[0][1]) as member:
+            return simulate_gcode(SequentialReader(member), layers=True).layers
+
+
+def _pack(values):
+    return np.asarray(values, dtype='<f4').tobytes()
+
+
+def _unpack(blob):
+    return np.frombuffer(blob or b'', dtype='<f4')
+
+
+async def save_breakdown(database, key, breakdown):
+    await database.execute('''
+        INSERT OR REPLACE INTO layer_breakdowns (
+            cache_key, version, layer_count, z, seconds, extrusion_mm,
+            features, feature_seconds, feature_extrusion_mm
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        key, BREAKDOWN_VERSION, len(breakdown.z), _pack(breakdown.z), _pack(breakdown.seconds),
+        _pack(breakdown.extrusion_mm), json.dumps(breakdown.features, ensure_ascii=False),
+        _pack(breakdown.feature_seconds), _pack(breakdown.feature_extrusion_mm)
+    ))
+
+
+async def load_breakdown(database, key):
+    row = await database.fetchone('''
+        SELECT z, seconds, extrusion_mm, features, feature_seconds, feature_extrusion_mm
+        FROM layer_breakdowns WHERE cache_key = ? AND version = ?
+    ''', (key, BREAKDOWN_VERSION))
+    if row is None:
+        return None
+    return LayerBreakdown(
+        _unpack(row[0]), _unpack(row[1]), _unpack(row[2]),
+        json.loads(row[3]), _unpack(row[4]), _unpack(row[5])
+    )
+
+
+def _duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}ч {minutes}мин"
+    return f"{minutes}мин {seconds}с" if minutes else f"{seconds}с"
+
+
+def _percent(part, total):
+    return part / total * 100 if total else 0.0
+
+
+# Экранирование пользовательского текста для Markdown-сообщений Telegram
+def escape_markdown(text):
+    for char in ('_', '*', '`', '['):
+        text = text.replace(char, '\\' + char)
+    return text
+
+
+def is_support(feature):
+    return 'support' in feature.lower()
+
+
+# Сводка для сообщения: самые долгие слои и доли типов линий
+def format_breakdown(breakdown, title):
+    total_seconds = float(breakdown.seconds.sum())
+    total_mm = float(breakdown.extrusion_mm.sum())
+    text = (
+        f"📊 *Разбор по слоям: {escape_markdown(title)}*\n\n"
+        f"🧱 Слоев: {len(breakdown.z)}, высота: {float(breakdown.z.max(initial=0)):.2f} мм\n"
+        f"⏱️ Время: {_duration(total_seconds)}, нить: {total_mm / 1000:.2f} м\n\n"
+    )
+
+    slowest = np.argsort(breakdown.seconds)[::-1][:SLOWEST_LAYERS]
+    if len(slowest):
+        text += "🐢 *Самые долгие слои:*\n"
+        for index in slowest:
+            text += (
+                f"• Слой {index + 1} (Z {breakdown.z[index]:.2f} мм): "
+                f"{_duration(breakdown.seconds[index])}, {breakdown.extrusion_mm[index] / 1000:.2f} м\n"
+            )
+        text += "\n"
+
+    order = np.argsort(breakdown.feature_seconds)[::-1]
+    if len(order) and breakdown.features != ['']:
+        text += "🧩 *Типы линий (время / пластик):*\n"
+        for index in order:
+            time_share = _percent(breakdown.feature_seconds[index], total_seconds)
+            material_share = _percent(breakdown.feature_extrusion_mm[index], total_mm)
+            if time_share < 0.5 and material_share < 0.5:
+                continue
+            name = breakdown.features[index] or "Без типа"
+            text += f"• {escape_markdown(name)}: {time_share:.0f}% / {material_share:.0f}%\n"
+        support = [is_support(name) for name in breakdown.features]
+        support_seconds = float(breakdown.feature_seconds[support].sum())
+        support_mm = float(breakdown.feature_extrusion_mm[support].sum())
+        text += (
+            f"\n🏗 Поддержки: {_percent(support_seconds, total_seconds):.0f}% времени, "
+            f"{_percent(support_mm, total_mm):.0f}% пластика\n"
+            f"🧊 Модель: {_percent(total_seconds - support_seconds, total_seconds):.0f}% времени, "
+            f"{_percent(total_mm - support_mm, total_mm):.0f}% пластика"
+        )
+    return text
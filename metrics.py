@@ -0,0 +1,225 @@
+import bisect
+import inspect
+import logging
+import os
+import re
+import time
+from functools import lru_cache
+
+from aiogram import BaseMiddleware
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Метрики в формате Prometheus на локальном порту: GET /metrics.
+# METRICS_PORT=0 (по умолчанию) - метрики выключены, таймеры ничего не делают
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PATH = '/metrics'
+# Границы корзин гистограмм длительности (сек)
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Реестр метрик. Пока enabled=False, inc/observe сразу возвращаются
+class Registry:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    # Значения, которые считаются при опросе: collect() -> {значения меток: число},
+    # число (без меток) или None (нет данных); может быть async
+    def collector(self, name, help, type='gauge', labels=()):
+        def decorator(func):
+            self._collectors.append((name, help, type, tuple(labels), func))
+            return func
+        return decorator
+
+    async def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for name, help, type, labels, func in self._collectors:
+            try:
+                values = func()
+                if inspect.isawaitable(values):
+                    values = await values
+            except Exception as e:
+                logger.error(f"Metrics collector {name} failed: {e}")
+                continue
+            if values is None:
+                continue
+            if not isinstance(values, dict):
+                values = {(): values}
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {type}')
+            for key, value in values.items():
+                key = key if isinstance(key, tuple) else (key,)
+                lines.append(f'{name}{_labels(labels, key)} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry(enabled=METRICS_PORT > 0)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        registry.register(self)
+
+    def inc(self, *label_values, amount=1):
+        if registry.enabled:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        for key, value in self._values.items():
+            yield f'{self.name}{_labels(self.labels, key)} {_number(value)}'
+
+
+class _Timer:
+    __slots__ = ('histogram', 'label_values', 'started')
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # значения меток -> [счетчики корзин..., сумма, количество]
+        self._values = {}
+        registry.register(self)
+
+    def observe(self, value, *label_values):
+        if not registry.enabled:
+            return
+        state = self._values.get(label_values)
+        if state is None:
+            state = self._values[label_values] = [0] * len(self.buckets) + [0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            state[index] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    # with histogram.time('метка'): ... - длительность блока в секундах
+    def time(self, *label_values):
+        return _Timer(self, label_values) if registry.enabled else _NO_TIMER
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        for key, state in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = f'le="{_number(float(bound))}"'
+                yield f'{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}'
+            le = 'le="+Inf"'
+            yield f'{self.name}_bucket{_labels(self.labels, key, le)} {state[-1]}'
+            yield f'{self.name}_sum{_labels(self.labels, key)} {_number(state[-2])}'
+            yield f'{self.name}_count{_labels(self.labels, key)} {state[-1]}'
+
+
+HANDLER_SECONDS = Histogram('bot_handler_seconds', 'Время обработчика апдейта', ['handler'])
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Необработанные исключения в обработчиках', ['handler'])
+DOWNLOAD_SECONDS = Histogram('bot_download_seconds', 'Время скачивания файла из Telegram')
+DOWNLOAD_BYTES = Counter('bot_download_bytes_total', 'Скачано байт из Telegram')
+PARSE_SECONDS = Histogram('bot_parse_seconds', 'Время разбора файла в пуле процессов', ['dialect'])
+DB_QUERY_SECONDS = Histogram('bot_db_query_seconds', 'Время запроса к базе', ['statement'])
+DB_WAIT_SECONDS = Histogram('bot_db_wait_seconds', 'Ожидание соединения с базой', ['connection'])
+
+
+_STATEMENT_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+(\w+)', re.IGNORECASE)
+
+
+# Метка запроса для метрик: команда и первая таблица ("select prints")
+@lru_cache(maxsize=512)
+def statement_name(sql):
+    words = sql.split(None, 1)
+    verb = words[0].lower() if words else ''
+    table = _STATEMENT_TABLE.search(sql)
+    return f'{verb} {table.group(1)}' if table else verb
+
+
+# Внутренний middleware событий: длительность и ошибки по имени обработчика
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        if not registry.enabled:
+            return await handler(event, data)
+        name = data['handler'].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+
+
+async def metrics_view(request):
+    return web.Response(text=await registry.render(), content_type='text/plain', charset='utf-8')
+
+
+# Отдельный сервер метрик; возвращает runner для остановки (runner.cleanup())
+async def start_metrics_server(host=None, port=None):
+    app = web.Application()
+    app.router.add_get(METRICS_PATH, metrics_view)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    host, port = host or METRICS_HOST, port or METRICS_PORT
+    await web.TCPSite(runner, host, port).start()
+    registry.enabled = True
+    logger.info(f"Metrics server listening on {host}:{port}{METRICS_PATH}")
+    return runner
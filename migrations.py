@@ -0,0 +1,385 @@
+import logging
+
+from motion import guess_density
+from stats import rebuild_user_stats
+from supabase_sync import SYNC_TABLES
+
+logger = logging.getLogger(__name__)
+
+
+async def _column_exists(db, table, column):
+    async with db.execute(f'PRAGMA table_info({table})') as cursor:
+        return any(row[1] == column for row in await cursor.fetchall())
+
+
+def _add_column(table, column, definition):
+    async def step(db):
+        if not await _column_exists(db, table, column):
+            await db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return step
+
+
+# Плотность существующих катушек - по материалу в названии
+async def _guess_spool_density(db):
+    async with db.execute('SELECT id, name FROM spools') as cursor:
+        rows = await cursor.fetchall()
+    await db.executemany('UPDATE spools SET density = ? WHERE id = ?',
+                         [(guess_density(name), spool_id) for spool_id, name in rows])
+
+
+# Ссылка prints -> spools. spool_name остается подписью печати
+# (как в таблицах веб-приложения) и на случай удаления катушки
+async def _add_prints_spool_id(db):
+    if not await _column_exists(db, 'prints', 'spool_id'):
+        await db.execute('ALTER TABLE prints ADD COLUMN spool_id INTEGER REFERENCES spools(id) ON DELETE SET NULL')
+    await db.execute('''
+        UPDATE prints SET spool_id = (
+            SELECT s.id FROM spools s
+            WHERE s.user_id = prints.user_id AND s.name = prints.spool_name
+            ORDER BY s.id LIMIT 1
+        )
+        WHERE spool_id IS NULL
+    ''')
+
+
+# Сводка пользователя: счетчики в user_stats и помесячно в user_stats_monthly.
+# Поддерживаются триггерами на prints, поэтому обновляются в той же транзакции,
+# что и любая вставка, изменение или удаление печати
+_STATS_COLUMNS = ('prints_count', 'total_profit', 'total_revenue', 'total_cost', 'total_plastic')
+_STATS_VALUES = ('1', '{row}.profit', '{row}.sale_price', '{row}.total_cost', '{row}.weight')
+_STATS_TABLES = (
+    ('user_stats', ('user_id',), ('{row}.user_id',)),
+    ('user_stats_monthly', ('user_id', 'month'), ('{row}.user_id', 'substr({row}.date, 1, 7)')),
+)
+
+
+def _stats_add(row):
+    statements = []
+    for table, keys, key_values in _STATS_TABLES:
+        values = [v.format(row=row) for v in key_values + _STATS_VALUES]
+        updates = ', '.join(f'{c} = {c} + excluded.{c}' for c in _STATS_COLUMNS)
+        statements.append(
+            f"INSERT INTO {table} ({', '.join(keys + _STATS_COLUMNS)}) VALUES ({', '.join(values)}) "
+            f"ON CONFLICT({', '.join(keys)}) DO UPDATE SET {updates};"
+        )
+    return '\n'.join(statements)
+
+
+def _stats_subtract(row):
+    statements = []
+    for table, keys, key_values in _STATS_TABLES:
+        updates = ', '.join(f'{c} = {c} - {v.format(row=row)}' for c, v in zip(_STATS_COLUMNS, _STATS_VALUES))
+        where = ' AND '.join(f'{k} = {v.format(row=row)}' for k, v in zip(keys, key_values))
+        statements.append(f'UPDATE {table} SET {updates} WHERE {where};')
+    return '\n'.join(statements)
+
+
+# Журнал изменений для синхронизации: строка на (таблица, ключ строки) с
+# последней версией. Старая запись журнала удаляется, AUTOINCREMENT выдает
+# новой версию больше всех прежних. Не INSERT OR REPLACE: в триггере SQLite
+# подменяет его конфликт-политикой внешней команды, и после INSERT OR IGNORE
+# в журнале оставалась старая версия (например, метка удаления)
+def _sync_log(table, row, deleted):
+    return (
+        f"DELETE FROM sync_changes WHERE table_name = '{table.name}' AND row_key = {row}.{table.key};\n"
+        f"            INSERT INTO sync_changes (table_name, row_key, user_id, deleted) "
+        f"VALUES ('{table.name}', {row}.{table.key}, {row}.user_id, {deleted});"
+    )
+
+
+_SYNC_EVENTS = (('INSERT', 'NEW', 0), ('UPDATE', 'NEW', 0), ('DELETE', 'OLD', 1))
+
+
+# Пересоздание триггеров журнала с текущим телом (_sync_log)
+def _recreate_sync_triggers():
+    steps = []
+    for table in SYNC_TABLES:
+        for event, row, deleted in _SYNC_EVENTS:
+            steps.append(f'DROP TRIGGER IF EXISTS {table.name}_sync_{event.lower()}')
+            steps.append(f'''
+        CREATE TRIGGER {table.name}_sync_{event.lower()} AFTER {event} ON {table.name} BEGIN
+            {_sync_log(table, row, deleted)}
+        END
+        ''')
+    return steps
+
+
+def _sync_triggers():
+    steps = []
+    for table in SYNC_TABLES:
+        for event, row, deleted in _SYNC_EVENTS:
+            steps.append(f'''
+        CREATE TRIGGER IF NOT EXISTS {table.name}_sync_{event.lower()} AFTER {event} ON {table.name} BEGIN
+            {_sync_log(table, row, deleted)}
+        END
+        ''')
+        # Уже существующие строки - в журнал, чтобы первая синхронизация выгрузила все
+        steps.append(
+            f"INSERT OR IGNORE INTO sync_changes (table_name, row_key, user_id, deleted) "
+            f"SELECT '{table.name}', {table.key}, user_id, 0 FROM {table.name} ORDER BY {table.key}"
+        )
+    return steps
+
+
+_STATS_TABLE = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        user_id TEXT NOT NULL,{month}
+        prints_count INTEGER NOT NULL DEFAULT 0,
+        total_profit REAL NOT NULL DEFAULT 0,
+        total_revenue REAL NOT NULL DEFAULT 0,
+        total_cost REAL NOT NULL DEFAULT 0,
+        total_plastic REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY ({keys})
+    )
+"""
+
+# Миграции схемы: (версия, описание, шаги). Шаги - SQL или async-функции от
+# соединения, каждый шаг должен быть идемпотентным. Новые миграции - только в конец
+MIGRATIONS = [
+    (1, 'base schema', [
+        # Таблица настроек принтера
+        '''
+        CREATE TABLE IF NOT EXISTS printer_settings (
+            user_id TEXT PRIMARY KEY,
+            printer_cost REAL DEFAULT 50000,
+            amortization_months INTEGER DEFAULT 24,
+            electricity_cost REAL DEFAULT 6,
+            printer_power REAL DEFAULT 0.3,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Таблица катушек
+        '''
+        CREATE TABLE IF NOT EXISTS spools (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            cost REAL NOT NULL,
+            weight REAL NOT NULL,
+            price_per_gram REAL NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Таблица печатей
+        '''
+        CREATE TABLE IF NOT EXISTS prints (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            date DATE NOT NULL,
+            name TEXT NOT NULL,
+            spool_name TEXT NOT NULL,
+            weight REAL NOT NULL,
+            hours REAL NOT NULL,
+            sale_price REAL NOT NULL,
+            material_cost REAL NOT NULL,
+            electricity_cost_calc REAL NOT NULL,
+            amortization REAL NOT NULL,
+            total_cost REAL NOT NULL,
+            profit REAL NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Кэш результатов разбора файлов
+        '''
+        CREATE TABLE IF NOT EXISTS parse_cache (
+            cache_key TEXT PRIMARY KEY,
+            parser_version INTEGER NOT NULL,
+            weight REAL,
+            hours REAL,
+            dialect TEXT,
+            plates TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (2, 'user indexes', [
+        'CREATE INDEX IF NOT EXISTS idx_prints_user_date ON prints(user_id, date)',
+        'CREATE INDEX IF NOT EXISTS idx_spools_user_created ON spools(user_id, created_at)',
+    ]),
+    (3, 'prints.spool_id foreign key', [
+        _add_prints_spool_id,
+        'CREATE INDEX IF NOT EXISTS idx_prints_spool ON prints(spool_id)',
+    ]),
+    (4, 'user stats rollup', [
+        _STATS_TABLE.format(table='user_stats', month='', keys='user_id'),
+        _STATS_TABLE.format(table='user_stats_monthly', month='\n        month TEXT NOT NULL,', keys='user_id, month'),
+        f'''
+        CREATE TRIGGER IF NOT EXISTS prints_stats_insert AFTER INSERT ON prints BEGIN
+            {_stats_add('NEW')}
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS prints_stats_delete AFTER DELETE ON prints BEGIN
+            {_stats_subtract('OLD')}
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS prints_stats_update
+        AFTER UPDATE OF user_id, date, weight, sale_price, total_cost, profit ON prints BEGIN
+            {_stats_subtract('OLD')}
+            {_stats_add('NEW')}
+        END
+        ''',
+        rebuild_user_stats,
+    ]),
+    # Диаметр и плотность нити катушки - для перевода длины нити в граммы
+    (5, 'filament properties', [
+        _add_column('spools', 'diameter', 'REAL NOT NULL DEFAULT 1.75'),
+        _add_column('spools', 'density', 'REAL NOT NULL DEFAULT 1.24'),
+        _add_column('parse_cache', 'filament_mm', 'REAL'),
+        _guess_spool_density,
+    ]),
+    # Разбор по слоям (массивы float32 в BLOB) и ссылка печати на файл
+    (6, 'layer breakdowns', [
+        '''
+        CREATE TABLE IF NOT EXISTS layer_breakdowns (
+            cache_key TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            layer_count INTEGER NOT NULL,
+            z BLOB NOT NULL,
+            seconds BLOB NOT NULL,
+            extrusion_mm BLOB NOT NULL,
+            features TEXT NOT NULL,
+            feature_seconds BLOB NOT NULL,
+            feature_extrusion_mm BLOB NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        _add_column('prints', 'file_key', 'TEXT'),
+        'CREATE INDEX IF NOT EXISTS idx_prints_file_key ON prints(file_key)',
+    ]),
+    # Разбивка печати по филаментам (AMS, несколько экструдеров): строка на слот.
+    # Однокатушечные печати - одна строка, поэтому расход по катушкам
+    # считается одним запросом по индексу (user_id, spool_id)
+    (7, 'print filaments', [
+        '''
+        CREATE TABLE IF NOT EXISTS print_filaments (
+            print_id INTEGER NOT NULL REFERENCES prints(id) ON DELETE CASCADE,
+            slot INTEGER NOT NULL,
+            user_id TEXT NOT NULL,
+            spool_id INTEGER REFERENCES spools(id) ON DELETE SET NULL,
+            weight REAL NOT NULL,
+            material_cost REAL NOT NULL,
+            PRIMARY KEY (print_id, slot)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_print_filaments_user_spool ON print_filaments(user_id, spool_id)',
+        '''
+        INSERT OR IGNORE INTO print_filaments (print_id, slot, user_id, spool_id, weight, material_cost)
+        SELECT id, 1, user_id, spool_id, weight, material_cost FROM prints
+        ''',
+        _add_column('parse_cache', 'filaments', 'TEXT'),
+    ]),
+    # Состояния FSM (заполняемые формы): строка на ключ бот/чат/пользователь,
+    # updated_at - для истечения по TTL
+    (8, 'fsm states', [
+        '''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at REAL NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states(updated_at)',
+    ]),
+    # Журнал изменений и курсоры синхронизации с Supabase (supabase_sync.py).
+    # row_key без типа: хранит и числовые id, и user_id настроек как есть
+    (9, 'sync change log', [
+        '''
+        CREATE TABLE IF NOT EXISTS sync_changes (
+            version INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            row_key NOT NULL,
+            user_id TEXT NOT NULL,
+            deleted INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (table_name, row_key)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_sync_changes_table_version ON sync_changes(table_name, version)',
+        'CREATE INDEX IF NOT EXISTS idx_sync_changes_user_version ON sync_changes(user_id, version)',
+        '''
+        CREATE TABLE IF NOT EXISTS sync_cursors (
+            target TEXT NOT NULL,
+            table_name TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (target, table_name)
+        )
+        ''',
+        *_sync_triggers(),
+    ]),
+    # Принтеры фермы (farm.py) и ссылка печати на принтер, по которому
+    # посчитаны электричество и амортизация
+    (10, 'print farm', [
+        '''
+        CREATE TABLE IF NOT EXISTS printers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            printer_cost REAL NOT NULL,
+            amortization_months INTEGER NOT NULL,
+            printer_power REAL NOT NULL,
+            busy_until REAL NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_printers_user ON printers(user_id)',
+        _add_column('prints', 'printer_id', 'INTEGER REFERENCES printers(id) ON DELETE SET NULL'),
+    ]),
+    (11, 'filament materials', [
+        # Заправленный в принтер пластик и основной пластик файла - для смен
+        # пластика в плане фермы
+        _add_column('printers', 'material', 'TEXT'),
+        _add_column('parse_cache', 'material', 'TEXT'),
+    ]),
+    (12, 'unique content keys', [
+        # Печать из bulk.py (file_key - ключ содержимого) - одна на файл у
+        # пользователя. У дубликатов, добавленных раньше, ключ снимается
+        '''
+        UPDATE prints SET file_key = NULL
+        WHERE file_key LIKE 'sha256:%' AND id NOT IN (
+            SELECT MIN(id) FROM prints WHERE file_key LIKE 'sha256:%' GROUP BY user_id, file_key
+        )
+        ''',
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_prints_user_content_key
+        ON prints(user_id, file_key) WHERE file_key LIKE 'sha256:%'
+        ''',
+    ]),
+    (13, 'sync log without conflict clause', _recreate_sync_triggers()),
+]
+
+
+async def get_schema_version(db):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    async with db.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version') as cursor:
+        return (await cursor.fetchone())[0]
+
+
+# Применение недостающих миграций, каждая в своей транзакции
+async def apply_migrations(database):
+    async with database.transaction() as db:
+        current = await get_schema_version(db)
+
+    for version, name, steps in MIGRATIONS:
+        if version <= current:
+            continue
+        async with database.transaction() as db:
+            # DDL в sqlite3 не открывает транзакцию сам - открываем явно
+            await db.execute('BEGIN')
+            for step in steps:
+                if callable(step):
+                    await step(db)
+                else:
+                    await db.execute(step)
+            await db.execute('INSERT INTO schema_version (version, name) VALUES (?, ?)', (version, name))
+        logger.info(f"Applied migration {version}: {name}")
+        current = version
+    return current
@@ -0,0 +1,359 @@
+import os
+import re
+from collections import namedtuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from gcode_parser import _open_source
+
+# Запасной расчет для G-code без метаданных слайсера: интерпретируем сами
+# движения (G0-G3, G92, G90/G91, M82/M83, M204, G4) и считаем длину
+# выдавленной нити и время печати. Файл читается блоками по MOTION_CHUNK_BYTES,
+# каждый блок разбирается и считается векторно в NumPy - память ограничена
+# размером блока, а не файла.
+MOTION_CHUNK_BYTES = int(os.getenv('MOTION_CHUNK_BYTES', 4 * 1024 * 1024))
+# Ускорение, пока в файле не встретился M204 (мм/с²)
+DEFAULT_ACCELERATION = float(os.getenv('MOTION_ACCELERATION', 1000))
+# Скорость до первого F (мм/мин)
+DEFAULT_FEEDRATE = 3000
+# Скорость прохождения стыка между движениями (мм/с)
+JUNCTION_SPEED = 5
+
+# Нить по умолчанию - PLA 1.75 мм
+FILAMENT_DIAMETER = 1.75
+FILAMENT_DENSITY = 1.24
+# Плотность пластиков (г/см³) для определения по названию катушки
+MATERIAL_DENSITY = {
+    'PLA': 1.24, 'PETG': 1.27, 'ABS': 1.04, 'ASA': 1.07, 'TPU': 1.21,
+    'PC': 1.20, 'PA': 1.14, 'NYLON': 1.14, 'PVA': 1.23, 'HIPS': 1.04,
+}
+
+# Шаг уровней Z для разделения на слои (мм)
+LAYER_STEP = 0.05
+
+MotionInfo = namedtuple('MotionInfo', ['filament_mm', 'time_hours', 'moves', 'layers'], defaults=[None])
+# Разбор по слоям: массивы float32 по слоям (высота, время, нить) и по типам линий
+LayerBreakdown = namedtuple('LayerBreakdown', [
+    'z', 'seconds', 'extrusion_mm', 'features', 'feature_seconds', 'feature_extrusion_mm'
+])
+
+# Сколько символов после буквы занимает число параметра (X-123.45678)
+_NUMBER_WIDTH = 16
+_POW10 = 10.0 ** np.arange(_NUMBER_WIDTH + 1)
+_COMMENT = re.compile(rb';[^\n]*')
+_NEWLINE, _G, _M, _T = b'\n'[0], b'G'[0], b'M'[0], b'T'[0]
+_AXES = 'XYZEFIJRPS'
+# Тип линий: ;TYPE: (Cura, PrusaSlicer, OrcaSlicer), ; FEATURE: (Bambu Studio), ; feature (Simplify3D)
+_FEATURE = re.compile(rb'^[ \t]*;[ \t]*(?:TYPE:|FEATURE:?)[ \t]*([^\r\n]*)', re.MULTILINE | re.IGNORECASE)
+
+
+# Вес нити заданной длины (мм) по диаметру (мм) и плотности (г/см³)
+def filament_grams(length_mm, diameter=FILAMENT_DIAMETER, density=FILAMENT_DENSITY):
+    return length_mm * np.pi * (diameter / 2) ** 2 / 1000 * density
+
+
+# Плотность по названию катушки ('PETG Черный' -> 1.27)
+def guess_density(name):
+    for word in re.findall(r'[A-Z]+', (name or '').upper()):
+        if word in MATERIAL_DENSITY:
+            return MATERIAL_DENSITY[word]
+    return FILAMENT_DENSITY
+
+
+# Токены блока: буква параметра и ее число. Переводы строк тоже токены -
+# по ним параметры группируются в строки
+def _tokens(chunk):
+    text = _COMMENT.sub(b'', chunk).upper()
+    buf = np.frombuffer(text + bytes(_NUMBER_WIDTH + 1), np.uint8)
+    after = buf[1:]
+    numeric = ((after - 48) < 10) | (after == 46) | (after == 45) | (after == 43)
+    starts = np.flatnonzero((((buf[:-1] - 65) < 26) & numeric) | (buf[:-1] == _NEWLINE))
+    letters = buf[starts]
+    values = np.zeros(len(starts))
+    parameter = letters != _NEWLINE
+    values[parameter] = _numbers(buf, starts[parameter] + 1)
+    return letters, values
+
+
+# Числа по столбцам окна после буквы (схема Горнера), все токены разом
+def _numbers(buf, starts):
+    window = sliding_window_view(buf, _NUMBER_WIDTH)[starts].T.copy()
+    first = window[0]
+    negative = first == 45
+    first[negative | (first == 43)] = 48
+    count = len(starts)
+    mantissa = np.zeros(count)
+    decimals = np.zeros(count, np.intp)
+    alive = np.ones(count, bool)
+    fraction = np.zeros(count, bool)
+    digit = np.empty(count, bool)
+    dot = np.empty(count, bool)
+    for column in window:
+        value = column - 48
+        np.less(value, 10, out=digit)
+        digit &= alive
+        np.equal(column, 46, out=dot)
+        dot &= alive
+        dot &= ~fraction
+        np.logical_or(digit, dot, out=alive)
+        if not alive.any():
+            break
+        np.multiply(mantissa, 10, out=mantissa, where=digit)
+        np.add(mantissa, value, out=mantissa, where=digit)
+        np.add(decimals, 1, out=decimals, where=digit & fraction)
+        fraction |= dot
+
+    values = mantissa / _POW10[decimals]
+    values[negative] *= -1
+    return values
+
+
+def _fill(values, initial):
+    # Протягивание последнего известного значения вперед (NaN - "не задано")
+    index = np.where(np.isnan(values), -1, np.arange(len(values)))
+    np.maximum.accumulate(index, out=index)
+    return np.where(index >= 0, values[index], initial)
+
+
+def _positions(values, move, relative, reset, initial):
+    # Координата оси после каждой команды: абсолютные движения и G92
+    # задают значение, относительные прибавляют к последнему
+    given = ~np.isnan(values)
+    assigned = (move & ~relative & given) | reset
+    increment = np.where(move & relative & given, values, 0.0).cumsum()
+    last = np.where(assigned, np.arange(len(values)), -1)
+    np.maximum.accumulate(last, out=last)
+    base = np.where(assigned, np.nan_to_num(values), 0.0)
+    return np.where(last >= 0, base[last] - increment[last], initial) + increment
+
+
+def _move_times(distance, speed, acceleration):
+    # Трапеция скорости: разгон от скорости стыка до F, крейсерский участок,
+    # торможение. Короткие движения - треугольник без крейсерского участка
+    junction = np.minimum(speed, JUNCTION_SPEED)
+    ramp = (speed ** 2 - junction ** 2) / acceleration
+    cruise = (distance - ramp) / speed + 2 * (speed - junction) / acceleration
+    peak = np.sqrt(junction ** 2 + acceleration * distance)
+    triangle = 2 * (peak - junction) / acceleration
+    return np.where(distance >= ramp, cruise, triangle)
+
+
+def _arc_lengths(x0, y0, x1, y1, i, j, radius, clockwise):
+    # Длина дуги G2/G3: центр задан I/J или радиусом R
+    has_center = ~(np.isnan(i) & np.isnan(j))
+    i, j = np.nan_to_num(i), np.nan_to_num(j)
+    r = np.hypot(i, j)
+    start = np.arctan2(-j, -i)
+    end = np.arctan2(y1 - (y0 + j), x1 - (x0 + i))
+    sweep = np.where(clockwise, start - end, end - start)
+    sweep = np.where(sweep <= 0, sweep + 2 * np.pi, sweep)
+    chord = np.hypot(x1 - x0, y1 - y0)
+    radius = np.abs(np.nan_to_num(radius))
+    half = np.arcsin(np.clip(chord / np.maximum(2 * radius, 1e-9), 0, 1))
+    return np.where(has_center, r * sweep, 2 * radius * half)
+
+
+# Метки типов линий в блоке: номера строк и названия
+def _feature_markers(chunk):
+    matches = list(_FEATURE.finditer(chunk))
+    newlines = np.flatnonzero(np.frombuffer(chunk, np.uint8) == _NEWLINE)
+    lines = np.searchsorted(newlines, [m.start() for m in matches])
+    return lines, [m.group(1).decode('utf-8', errors='ignore').strip() for m in matches]
+
+
+def _grow(total, start, values):
+    end = start + len(values)
+    if end > len(total):
+        total = np.concatenate((total, np.zeros(end - len(total))))
+    total[start:end] += values
+    return total
+
+
+class _Layers:
+    # Накопители разбора по слоям. Новый слой начинается, когда экструзия
+    # впервые доходит до более высокого уровня Z - подъемы при перемещениях
+    # и линия очистки на старте не создают лишних слоев
+    def __init__(self):
+        self.level = -np.inf
+        self.layer = 0
+        self.z = np.zeros(0)
+        self.seconds = np.zeros(0)
+        self.extrusion = np.zeros(0)
+        self.feature = 0
+        self.features = {'': 0}
+        self.feature_seconds = np.zeros(0)
+        self.feature_extrusion = np.zeros(0)
+
+    def add(self, line, z, extrusion, seconds, markers):
+        extruding = extrusion > 0
+        level = np.where(extruding, np.floor(z / LAYER_STEP + 1e-6), -np.inf)
+        level = np.maximum.accumulate(np.concatenate(([self.level], level)))
+        raised = level[1:] > level[:-1]
+        if np.isfinite(self.level):
+            layer = self.layer + np.cumsum(raised)
+        else:
+            # Все до первой экструзии (нагрев, парковка) относится к первому слою
+            layer = np.maximum(np.cumsum(raised) - 1, 0)
+        start = layer[0]
+        self.seconds = _grow(self.seconds, start, np.bincount(layer - start, seconds))
+        self.extrusion = _grow(self.extrusion, start, np.bincount(layer - start, extrusion))
+        heights = np.full(layer[-1] - start + 1, np.nan)
+        heights[layer[raised] - start] = z[raised]
+        if len(self.z) > start and not np.isnan(self.z[start]):
+            heights[0] = self.z[start]
+        self.z = np.concatenate((self.z[:start], heights))
+        self.level, self.layer = level[-1], int(layer[-1])
+
+        marker_lines, names = markers
+        current = self.feature
+        ids = self.mark(names)
+        last = np.searchsorted(marker_lines, line, side='right') - 1
+        feature = np.where(last >= 0, ids[np.maximum(last, 0)], current)
+        self.feature_seconds = _grow(self.feature_seconds, 0, np.bincount(feature, seconds, len(self.features)))
+        self.feature_extrusion = _grow(self.feature_extrusion, 0, np.bincount(feature, extrusion, len(self.features)))
+
+    # Регистрация типов линий; текущим становится последний
+    def mark(self, names):
+        ids = np.array([self.features.setdefault(name, len(self.features)) for name in names] or [self.feature])
+        self.feature = int(ids[-1])
+        return ids
+
+    def result(self):
+        names = list(self.features)
+        used = [i for i in range(len(names)) if self.feature_seconds[i] or self.feature_extrusion[i]]
+        return LayerBreakdown(
+            np.nan_to_num(self.z).astype(np.float32),
+            self.seconds.astype(np.float32),
+            self.extrusion.astype(np.float32),
+            [names[i] for i in used],
+            self.feature_seconds[used].astype(np.float32),
+            self.feature_extrusion[used].astype(np.float32),
+        )
+
+
+class _Machine:
+    # Состояние принтера между блоками файла
+    def __init__(self, layers=False):
+        self.position = {'X': 0.0, 'Y': 0.0, 'Z': 0.0, 'E': 0.0}
+        self.absolute = 1.0
+        self.absolute_e = 1.0
+        self.feedrate = float(DEFAULT_FEEDRATE)
+        self.acceleration = DEFAULT_ACCELERATION
+        self.filament_mm = 0.0
+        self.seconds = 0.0
+        self.moves = 0
+        self.layers = _Layers() if layers else None
+
+    def feed(self, letters, values, markers=None):
+        if not len(letters):
+            return
+        line = np.cumsum(letters == _NEWLINE)
+        line_start = np.empty(len(letters), bool)
+        line_start[0] = True
+        line_start[1:] = letters[:-1] == _NEWLINE
+        # Команда - первый токен строки: G/M/T и номер
+        command = line_start & ((letters == _G) | (letters == _M) | (letters == _T))
+        commands = np.flatnonzero(command)
+        if not len(commands):
+            if self.layers is not None:
+                self.layers.mark(markers[1])
+            return
+        group_of_line = np.full(line[-1] + 1, -1)
+        group_of_line[line[commands]] = np.arange(len(commands))
+        group = group_of_line[line]
+        param = (group >= 0) & ~command
+
+        params = {}
+        for axis in _AXES:
+            selected = param & (letters == ord(axis))
+            column = np.full(len(commands), np.nan)
+            column[group[selected]] = values[selected]
+            params[axis] = column
+
+        code = letters[commands]
+        number = values[commands]
+        is_g, is_m = code == _G, code == _M
+        move = is_g & np.isin(number, (0, 1, 2, 3))
+        arc = is_g & ((number == 2) | (number == 3))
+        reset = is_g & (number == 92)
+        reset_all = reset & np.all([np.isnan(params[a]) for a in self.position], axis=0)
+
+        # Режимы: G90/G91 - все оси, M82/M83 - только экструдер
+        mode = np.full(len(commands), np.nan)
+        mode[is_g & (number == 90)] = 1
+        mode[is_g & (number == 91)] = 0
+        relative = _fill(mode, self.absolute) == 0
+        mode_e = mode.copy()
+        mode_e[is_m & (number == 82)] = 1
+        mode_e[is_m & (number == 83)] = 0
+        relative_e = _fill(mode_e, self.absolute_e) == 0
+
+        positions, deltas = {}, {}
+        for axis, initial in self.position.items():
+            axis_relative = relative_e if axis == 'E' else relative
+            axis_reset = reset & (reset_all | ~np.isnan(params[axis]))
+            positions[axis] = _positions(params[axis], move, axis_relative, axis_reset, initial)
+            previous = np.concatenate(([initial], positions[axis][:-1]))
+            deltas[axis] = np.where(move, positions[axis] - previous, 0.0)
+
+        feedrate = _fill(np.where(move, params['F'], np.nan), self.feedrate)
+        accel_value = np.where(np.isnan(params['P']), params['S'], params['P'])
+        acceleration = _fill(np.where(is_m & (number == 204), accel_value, np.nan), self.acceleration)
+
+        distance = np.sqrt(deltas['X'] ** 2 + deltas['Y'] ** 2 + deltas['Z'] ** 2)
+        if arc.any():
+            x0 = positions['X'] - deltas['X']
+            y0 = positions['Y'] - deltas['Y']
+            planar = _arc_lengths(x0[arc], y0[arc], positions['X'][arc], positions['Y'][arc],
+                                  params['I'][arc], params['J'][arc], params['R'][arc], number[arc] == 2)
+            distance[arc] = np.hypot(planar, deltas['Z'][arc])
+        # Ретракты и подачи без перемещения идут со скоростью F по оси E
+        distance = np.where(distance > 0, distance, np.abs(deltas['E']))
+
+        speed = np.maximum(feedrate / 60, 1e-3)
+        times = _move_times(distance[move], speed[move], np.maximum(acceleration[move], 1.0))
+        dwell = is_g & (number == 4)
+        dwell_seconds = np.nan_to_num(params['P'][dwell]) / 1000 + np.nan_to_num(params['S'][dwell])
+
+        self.seconds += float(times.sum() + dwell_seconds.sum())
+        if self.layers is not None:
+            seconds = np.zeros(len(commands))
+            seconds[move] = times
+            seconds[dwell] = dwell_seconds
+            self.layers.add(line[commands], positions['Z'], deltas['E'], seconds, markers)
+        self.filament_mm += float(deltas['E'].sum())
+        self.moves += int(move.sum())
+        for axis in self.position:
+            self.position[axis] = float(positions[axis][-1])
+        self.absolute = 0.0 if relative[-1] else 1.0
+        self.absolute_e = 0.0 if relative_e[-1] else 1.0
+        self.feedrate = float(feedrate[-1])
+        self.acceleration = float(acceleration[-1])
+
+
+def _feed(machine, block):
+    markers = _feature_markers(block) if machine.layers is not None else None
+    machine.feed(*_tokens(block), markers)
+
+
+# Симуляция печати по движениям: длина нити (мм) и время (ч).
+# layers=True - еще и разбор по слоям и типам линий за тот же проход
+def simulate_gcode(source, chunk_size=None, layers=False):
+    stream = _open_source(source)
+    machine = _Machine(layers)
+    rest = b''
+    while True:
+        chunk = stream.read(chunk_size or MOTION_CHUNK_BYTES)
+        if not chunk:
+            break
+        data = rest + chunk
+        # Блок обрезается по последнему переводу строки
+        cut = data.rfind(b'\n') + 1
+        rest = data[cut:]
+        if cut:
+            _feed(machine, data[:cut])
+    if rest:
+        _feed(machine, rest + b'\n')
+    breakdown = machine.layers.result() if machine.layers is not None else None
+    return MotionInfo(machine.filament_mm, machine.seconds / 3600, machine.moves, breakdown)
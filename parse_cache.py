@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import zipfile
+from collections import OrderedDict
+from contextlib import ExitStack
+
+from threemf import PlateInfo
+from workers import ParseResult
+
+# Версия парсера: при изменении логики разбора старые записи кэша игнорируются
+PARSER_VERSION = 6
+
+
+def _entry_size(result):
+    # Приблизительный размер записи в памяти (байты)
+    return 200 + 80 * len(result.plates) + 16 * len(result.filaments)
+
+
+# SHA-256 содержимого - ключ для файлов не из Telegram (члены архивов, CLI).
+# source - путь или открытый двоичный файл
+def content_key(source, chunk_size=1024 * 1024):
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            return content_key(f, chunk_size)
+    digest = hashlib.sha256()
+    while chunk := source.read(chunk_size):
+        digest.update(chunk)
+    return f"sha256:{digest.hexdigest()}"
+
+
+# Ключи для (путь, член архива или None). Каждый архив открывается один раз.
+# Долго на больших файлах - вызывать в потоке (hashlib и zlib отпускают GIL)
+def content_keys(files):
+    keys = []
+    with ExitStack() as stack:
+        archives = {}
+        for path, member in files:
+            if member is None:
+                keys.append(content_key(path))
+                continue
+            if path not in archives:
+                archives[path] = stack.enter_context(zipfile.ZipFile(path))
+            with archives[path].open(member) as f:
+                keys.append(content_key(f))
+    return keys
+
+
+# Двухуровневый кэш результатов разбора: LRU в памяти + таблица parse_cache.
+# Ключ - document.file_unique_id (одинаков для повторно отправленного файла)
+# или content_key для членов архивов и файлов с диска
+class ParseCache:
+    def __init__(self, database, max_bytes=8 * 1024 * 1024):
+        self.database = database
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, key, result):
+        if key in self._entries:
+            self._size -= _entry_size(self._entries.pop(key))
+        self._entries[key] = result
+        self._size += _entry_size(result)
+        # Вытесняем самые старые записи при превышении лимита
+        while self._size > self.max_bytes and self._entries:
+            _, old = self._entries.popitem(last=False)
+            self._size -= _entry_size(old)
+
+    async def get(self, key):
+        result = self._entries.get(key)
+        if result is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return result
+
+        row = await self.database.fetchone('''
+            SELECT weight, hours, dialect, plates, filament_mm, filaments, material
+            FROM parse_cache WHERE cache_key = ? AND parser_version = ?
+        ''', (key, PARSER_VERSION))
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        plates = [PlateInfo(*plate) for plate in json.loads(row[3] or '[]')]
+        result = ParseResult(row[0], row[1], row[2], plates, row[4], tuple(json.loads(row[5] or '[]')), row[6])
+        self._remember(key, result)
+        self.hits += 1
+        return result
+
+    async def put(self, key, result):
+        self._remember(key, result)
+        await self.database.execute('''
+            INSERT OR REPLACE INTO parse_cache (
+                cache_key, parser_version, weight, hours, dialect, plates, filament_mm, filaments, material
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            key, PARSER_VERSION, result.weight_grams, result.time_hours,
+            result.dialect, json.dumps([list(plate) for plate in result.plates]), result.filament_mm,
+            json.dumps(list(result.filaments)), result.material
+        ))
@@ -0,0 +1,76 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, fields, replace
+
+
+@dataclass(frozen=True, slots=True)
+class PrinterSettings:
+    printer_cost: float = 50000
+    amortization_months: int = 24
+    electricity_cost: float = 6
+    printer_power: float = 0.3
+
+
+SETTINGS_FIELDS = tuple(f.name for f in fields(PrinterSettings))
+
+
+# Настройки принтера пользователей: ленивая загрузка в LRU-кэш с TTL.
+# Изменения пишутся в базу и сразу обновляют кэш (write-through)
+class SettingsStore:
+    def __init__(self, database, ttl=300, max_size=1024):
+        self.database = database
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, user_id, settings):
+        self._entries[user_id] = (time.monotonic() + self.ttl, settings)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        if user_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(user_id, None)
+
+    async def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        row = await self.database.fetchone(
+            f"SELECT {', '.join(SETTINGS_FIELDS)} FROM printer_settings WHERE user_id = ?", (user_id,)
+        )
+        if row is None:
+            # Создаем настройки по умолчанию
+            settings = PrinterSettings()
+            await self.database.execute(
+                f"INSERT OR IGNORE INTO printer_settings (user_id, {', '.join(SETTINGS_FIELDS)}) "
+                f"VALUES (?, {', '.join('?' for _ in SETTINGS_FIELDS)})",
+                (user_id, *(getattr(settings, name) for name in SETTINGS_FIELDS))
+            )
+        else:
+            settings = PrinterSettings(*row)
+        self._remember(user_id, settings)
+        return settings
+
+    async def update(self, user_id, **changes):
+        unknown = set(changes) - set(SETTINGS_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown printer settings: {', '.join(sorted(unknown))}")
+
+        settings = replace(await self.get(user_id), **changes)
+        assignments = ', '.join(f'{name} = ?' for name in changes)
+        await self.database.execute(
+            f'UPDATE printer_settings SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE user_id = ?',
+            (*changes.values(), user_id)
+        )
+        self._remember(user_id, settings)
+        return settings
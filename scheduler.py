@@ -0,0 +1,253 @@
+import heapq
+import time
+from collections import Counter, namedtuple
+
+# Распределение заданий печати по принтерам фермы. Жадное списочное
+# планирование (самые длинные задания первыми, принтер - из кучи по времени
+# освобождения) и локальный поиск переносами и обменами заданий.
+# Смена пластика на принтере занимает FILAMENT_CHANGE_HOURS; порядок заданий
+# на принтере свободный, поэтому задания одного пластика идут подряд и смен
+# столько, сколько на принтере разных пластиков (кроме уже заправленного)
+FILAMENT_CHANGE_HOURS = 0.25
+# Ограничение локального поиска по времени (сек)
+LOCAL_SEARCH_SECONDS = 0.3
+OBJECTIVES = ('makespan', 'cost')
+
+# material=None - задание печатается любым пластиком
+Job = namedtuple('Job', ['id', 'name', 'hours', 'weight', 'material'], defaults=[0.0, None])
+# hourly_cost - электричество и амортизация за час, available_at - через
+# сколько часов принтер освободится, material - заправленный пластик
+Machine = namedtuple('Machine', ['id', 'name', 'hourly_cost', 'available_at', 'material'], defaults=[0.0, None])
+Slot = namedtuple('Slot', ['job', 'machine', 'start', 'end', 'change'])
+Schedule = namedtuple('Schedule', ['slots', 'makespan', 'cost', 'changes', 'objective'])
+
+
+class _Load:
+    __slots__ = ('machine', 'hours', 'materials', 'jobs')
+
+    def __init__(self, machine):
+        self.machine = machine
+        self.hours = 0.0
+        self.materials = Counter()
+        self.jobs = []
+
+    def _changes(self, materials):
+        return len(materials) - (self.machine.material in materials)
+
+    def finish(self, change_hours):
+        return self.machine.available_at + self.hours + change_hours * self._changes(self.materials)
+
+    # Время окончания, если добавить задание add и/или убрать remove
+    def finish_with(self, change_hours, add=None, remove=None):
+        hours = self.hours
+        changes = self._changes(self.materials)
+        if remove is not None:
+            hours -= remove.hours
+            material = remove.material
+            if material is not None and self.materials[material] == 1 and material != self.machine.material:
+                changes -= 1
+        if add is not None:
+            hours += add.hours
+            material = add.material
+            if material is not None and material != self.machine.material and (
+                not self.materials[material] or (remove is not None and remove.material == material
+                                                 and self.materials[material] == 1)
+            ):
+                changes += 1
+        return self.machine.available_at + hours + change_hours * changes
+
+    def add(self, job):
+        self.jobs.append(job)
+        self.hours += job.hours
+        if job.material is not None:
+            self.materials[job.material] += 1
+
+    def remove(self, job):
+        self.jobs.remove(job)
+        self.hours -= job.hours
+        if job.material is not None:
+            self.materials[job.material] -= 1
+            if not self.materials[job.material]:
+                del self.materials[job.material]
+
+
+# Кучи принтеров по времени окончания: общая и по каждому пластику, с
+# ленивым удалением устаревших записей (версия записи != текущей версии)
+class _Heaps:
+    def __init__(self, loads, change_hours):
+        self.loads = loads
+        self.change_hours = change_hours
+        self.versions = [0] * len(loads)
+        self.all = []
+        self.by_material = {}
+        for index in range(len(loads)):
+            self.push(index)
+
+    def push(self, index):
+        load = self.loads[index]
+        self.versions[index] += 1
+        entry = (load.finish(self.change_hours), index, self.versions[index])
+        heapq.heappush(self.all, entry)
+        for material in {load.machine.material, *load.materials} - {None}:
+            heapq.heappush(self.by_material.setdefault(material, []), entry)
+
+    def top(self, heap):
+        while heap and heap[0][2] != self.versions[heap[0][1]]:
+            heapq.heappop(heap)
+        return heap[0][1] if heap else None
+
+
+def _list_schedule_makespan(jobs, loads, change_hours):
+    heaps = _Heaps(loads, change_hours)
+    for job in jobs:
+        # Лучший принтер - либо освобождающийся раньше всех (со сменой пластика),
+        # либо раньше всех среди тех, где этот пластик уже есть
+        candidates = {heaps.top(heaps.all)}
+        if job.material is not None:
+            candidates.add(heaps.top(heaps.by_material.get(job.material, [])))
+        candidates.discard(None)
+        best = min(candidates, key=lambda index: (loads[index].finish_with(change_hours, add=job), index))
+        loads[best].add(job)
+        heaps.push(best)
+
+
+# Самый дешевый принтер, на котором задание успевает к сроку; если таких
+# нет - тот, где оно закончится раньше
+def _list_schedule_cost(jobs, loads, change_hours, deadline):
+    by_cost = sorted(range(len(loads)), key=lambda index: loads[index].machine.hourly_cost)
+    for job in jobs:
+        best = None
+        for index in by_cost:
+            if deadline is None or loads[index].finish_with(change_hours, add=job) <= deadline + 1e-9:
+                best = index
+                break
+        if best is None:
+            best = min(by_cost, key=lambda index: loads[index].finish_with(change_hours, add=job))
+        loads[best].add(job)
+
+
+# Локальный поиск для makespan: задание с самого загруженного принтера
+# переносится или меняется местами с заданием другого принтера, если оба
+# заканчивают раньше, чем он сейчас
+def _refine_makespan(loads, change_hours, deadline_at):
+    while time.perf_counter() < deadline_at:
+        critical = max(loads, key=lambda load: load.finish(change_hours))
+        limit = critical.finish(change_hours) - 1e-9
+        others = sorted((load for load in loads if load is not critical), key=lambda load: load.finish(change_hours))
+        move = None
+        for job in sorted(critical.jobs, key=lambda job: -job.hours):
+            for other in others:
+                if (critical.finish_with(change_hours, remove=job) < limit
+                        and other.finish_with(change_hours, add=job) < limit):
+                    move = (job, other, None)
+                    break
+            if move:
+                break
+        if move is None:
+            for job in critical.jobs:
+                for other in others:
+                    if time.perf_counter() >= deadline_at:
+                        return
+                    for swap in other.jobs:
+                        if swap.hours >= job.hours:
+                            continue
+                        if (_finish_swapped(critical, job, swap, change_hours) < limit
+                                and _finish_swapped(other, swap, job, change_hours) < limit):
+                            move = (job, other, swap)
+                            break
+                    if move:
+                        break
+                if move:
+                    break
+        if move is None:
+            return
+        job, other, swap = move
+        critical.remove(job)
+        other.add(job)
+        if swap is not None:
+            other.remove(swap)
+            critical.add(swap)
+
+
+def _finish_swapped(load, out, into, change_hours):
+    load.remove(out)
+    try:
+        return load.finish_with(change_hours, add=into)
+    finally:
+        load.add(out)
+
+
+# Локальный поиск для стоимости: перенос задания на более дешевый принтер,
+# если тот успевает к сроку
+def _refine_cost(loads, change_hours, deadline, deadline_at):
+    by_cost = sorted(loads, key=lambda load: load.machine.hourly_cost)
+    improved = True
+    while improved and time.perf_counter() < deadline_at:
+        improved = False
+        for position, load in reversed(list(enumerate(by_cost))):
+            for job in sorted(load.jobs, key=lambda job: -job.hours):
+                for cheaper in by_cost[:position]:
+                    if cheaper.machine.hourly_cost >= load.machine.hourly_cost:
+                        break
+                    if deadline is None or cheaper.finish_with(change_hours, add=job) <= deadline + 1e-9:
+                        load.remove(job)
+                        cheaper.add(job)
+                        improved = True
+                        break
+
+
+# Порядок на принтере: задания без пластика и заправленным пластиком, затем
+# остальные группами по пластику; внутри группы - короткие первыми
+def _sequence(load, change_hours):
+    groups = {}
+    for job in load.jobs:
+        key = load.machine.material if job.material is None else job.material
+        groups.setdefault(key, []).append(job)
+    current = load.machine.material
+    order = sorted(groups, key=lambda material: (material != current, -sum(job.hours for job in groups[material])))
+
+    slots, at, changes = [], load.machine.available_at, 0
+    for material in order:
+        change = material is not None and material != current
+        if change:
+            at += change_hours
+            changes += 1
+            current = material
+        for job in sorted(groups[material], key=lambda job: job.hours):
+            slots.append(Slot(job, load.machine, at, at + job.hours, change))
+            change = False
+            at += job.hours
+    return slots, changes
+
+
+# План для заданий jobs на принтерах machines.
+#   objective='makespan' - закончить все как можно раньше
+#   objective='cost' - как можно дешевле, но не позже deadline (ч от текущего момента)
+def schedule(jobs, machines, objective='makespan', deadline=None, change_hours=FILAMENT_CHANGE_HOURS,
+             refine=True, time_limit=LOCAL_SEARCH_SECONDS):
+    if objective not in OBJECTIVES:
+        raise ValueError(f"Unknown objective: {objective}")
+    if not machines:
+        raise ValueError("No machines to schedule on")
+    deadline_at = time.perf_counter() + time_limit
+
+    loads = [_Load(machine) for machine in machines]
+    # Самые длинные задания первыми (LPT) - меньше перекос в конце плана
+    ordered = sorted(jobs, key=lambda job: -job.hours)
+    if objective == 'makespan':
+        _list_schedule_makespan(ordered, loads, change_hours)
+        if refine:
+            _refine_makespan(loads, change_hours, deadline_at)
+    else:
+        _list_schedule_cost(ordered, loads, change_hours, deadline)
+        if refine:
+            _refine_cost(loads, change_hours, deadline, deadline_at)
+
+    slots, changes = [], 0
+    for load in loads:
+        machine_slots, machine_changes = _sequence(load, change_hours)
+        slots.extend(machine_slots)
+        changes += machine_changes
+    cost = sum(slot.job.hours * slot.machine.hourly_cost for slot in slots)
+    makespan = max((slot.end for slot in slots), default=0.0)
+    return Schedule(slots, makespan, cost, changes, objective)
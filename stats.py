@@ -0,0 +1,81 @@
+from collections import namedtuple
+
+# Сводка пользователя (таблицы user_stats / user_stats_monthly, см. migrations.py)
+UserStats = namedtuple('UserStats', ['prints_count', 'total_profit', 'total_revenue', 'total_cost', 'total_plastic'])
+
+_STATS_SELECT = 'COUNT(*), SUM(profit), SUM(sale_price), SUM(total_cost), SUM(weight)'
+# Допуск при сравнении накопленных сумм с пересчитанными
+_TOLERANCE = 1e-6
+
+
+async def get_user_stats(database, user_id):
+    row = await database.fetchone(
+        'SELECT prints_count, total_profit, total_revenue, total_cost, total_plastic '
+        'FROM user_stats WHERE user_id = ?', (user_id,)
+    )
+    return UserStats(*row) if row else None
+
+
+async def get_month_stats(database, user_id, month):
+    row = await database.fetchone(
+        'SELECT prints_count, total_profit, total_revenue, total_cost, total_plastic '
+        'FROM user_stats_monthly WHERE user_id = ? AND month = ?', (user_id, month)
+    )
+    return UserStats(*row) if row else None
+
+
+# Расход по катушкам (print_filaments: строка на слот филамента печати)
+SpoolUsage = namedtuple('SpoolUsage', ['spool_id', 'name', 'prints_count', 'weight', 'material_cost'])
+
+
+async def get_spool_usage(database, user_id):
+    rows = await database.fetchall('''
+        SELECT f.spool_id, s.name, COUNT(DISTINCT f.print_id), SUM(f.weight), SUM(f.material_cost)
+        FROM print_filaments f LEFT JOIN spools s ON s.id = f.spool_id
+        WHERE f.user_id = ?
+        GROUP BY f.spool_id
+        ORDER BY SUM(f.weight) DESC
+    ''', (user_id,))
+    return [SpoolUsage(*row) for row in rows]
+
+
+def _same(stored, computed):
+    if stored is None:
+        return computed.prints_count == 0
+    return all(abs((a or 0) - (b or 0)) <= _TOLERANCE for a, b in zip(stored, computed))
+
+
+async def _fetch(db, sql, params):
+    async with db.execute(sql, params) as cursor:
+        return await cursor.fetchall()
+
+
+# Пересчет сводки из prints (для всех пользователей или одного).
+# Вызывается на соединении внутри транзакции, возвращает пользователей с расхождениями
+async def rebuild_user_stats(db, user_id=None):
+    where = 'WHERE user_id = ?' if user_id else ''
+    params = (user_id,) if user_id else ()
+
+    stored = {row[0]: UserStats(*row[1:]) for row in await _fetch(
+        db, f'SELECT user_id, prints_count, total_profit, total_revenue, total_cost, total_plastic '
+            f'FROM user_stats {where}', params
+    )}
+    computed = {row[0]: UserStats(*row[1:]) for row in await _fetch(
+        db, f'SELECT user_id, {_STATS_SELECT} FROM prints {where} GROUP BY user_id', params
+    )}
+    mismatched = sorted(
+        uid for uid in stored.keys() | computed.keys()
+        if not _same(stored.get(uid), computed.get(uid, UserStats(0, 0, 0, 0, 0)))
+    )
+
+    await db.execute(f'DELETE FROM user_stats {where}', params)
+    await db.execute(f'DELETE FROM user_stats_monthly {where}', params)
+    await db.execute(f'''
+        INSERT INTO user_stats (user_id, prints_count, total_profit, total_revenue, total_cost, total_plastic)
+        SELECT user_id, {_STATS_SELECT} FROM prints {where} GROUP BY user_id
+    ''', params)
+    await db.execute(f'''
+        INSERT INTO user_stats_monthly (user_id, month, prints_count, total_profit, total_revenue, total_cost, total_plastic)
+        SELECT user_id, substr(date, 1, 7), {_STATS_SELECT} FROM prints {where} GROUP BY user_id, substr(date, 1, 7)
+    ''', params)
+    return mismatched
@@ -0,0 +1,230 @@
+import asyncio
+import logging
+import os
+import random
+import uuid
+from collections import namedtuple
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Синхронизация базы бота с таблицами веб-приложения в Supabase (PostgREST).
+# Триггеры пишут каждое изменение строки в журнал sync_changes с растущей
+# версией; фоновая задача отправляет журнал пачками upsert/delete и
+# запоминает курсор (последнюю отправленную версию) по каждой таблице
+SYNC_ENABLED = os.getenv('SYNC_ENABLED', '').lower() in ('1', 'true', 'yes')
+SUPABASE_URL = os.getenv('SUPABASE_URL')
+SUPABASE_KEY = os.getenv('SUPABASE_KEY')
+# Префикс имен таблиц на стороне Supabase (например, bot_ -> bot_prints)
+SYNC_TABLE_PREFIX = os.getenv('SYNC_TABLE_PREFIX', '')
+SYNC_INTERVAL = float(os.getenv('SYNC_INTERVAL', 5))
+SYNC_BATCH_ROWS = int(os.getenv('SYNC_BATCH_ROWS', 500))
+# Повторы запроса при сетевых ошибках, 429 и 5xx: пауза растет вдвое
+SYNC_RETRIES = int(os.getenv('SYNC_RETRIES', 5))
+SYNC_RETRY_DELAY = 0.5
+SYNC_RETRY_MAX_DELAY = 30
+SYNC_REQUEST_TIMEOUT = 30
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+# Ключей в одном DELETE: фильтр in.(...) идет в URL, а его длина ограничена (~8 КБ)
+SYNC_DELETE_KEYS = 100
+# Пространство имен UUID строк: локальные id -> id в Supabase
+ROW_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'printer-bot/sync')
+
+# name - таблица, key - ключ строки, columns - колонки таблицы веб-приложения
+# (SUPABASE_SETUP.md). id катушек и печатей в Supabase - UUID из локального id
+SyncTable = namedtuple('SyncTable', ['name', 'key', 'columns'])
+SYNC_TABLES = (
+    SyncTable('printer_settings', 'user_id', (
+        'user_id', 'printer_cost', 'amortization_months', 'electricity_cost', 'printer_power', 'updated_at',
+    )),
+    SyncTable('spools', 'id', ('id', 'user_id', 'name', 'cost', 'weight', 'price_per_gram', 'created_at')),
+    SyncTable('prints', 'id', (
+        'id', 'user_id', 'date', 'name', 'spool_name', 'weight', 'hours', 'sale_price', 'material_cost',
+        'electricity_cost_calc', 'amortization', 'total_cost', 'profit', 'created_at',
+    )),
+)
+
+
+class SyncError(Exception):
+    pass
+
+
+def remote_key(table, key):
+    return str(uuid.uuid5(ROW_NAMESPACE, f'{table.name}:{key}')) if table.key == 'id' else key
+
+
+# Изменения таблицы после версии since по возрастанию версии: журнал хранит
+# одну запись на строку (последнее изменение), данные берутся из самой строки.
+# row=None - строка удалена
+async def fetch_changes(database, table, since=0, limit=SYNC_BATCH_ROWS, user_id=None):
+    sql = (
+        f"SELECT c.version, c.row_key, c.user_id, c.deleted, t.{table.key} IS NOT NULL, "
+        f"{', '.join(f't.{column}' for column in table.columns)} "
+        f"FROM sync_changes c LEFT JOIN {table.name} t ON t.{table.key} = c.row_key "
+        f"WHERE c.table_name = ? AND c.version > ?"
+    )
+    params = [table.name, since]
+    if user_id is not None:
+        sql += ' AND c.user_id = ?'
+        params.append(user_id)
+    sql += ' ORDER BY c.version LIMIT ?'
+    params.append(limit)
+
+    changes = []
+    for version, key, owner, deleted, exists, *values in await database.fetchall(sql, params):
+        changes.append({
+            'version': version,
+            'table': table.name,
+            'key': key,
+            'user_id': owner,
+            'row': dict(zip(table.columns, values)) if exists and not deleted else None,
+        })
+    return changes
+
+
+# Лента изменений пользователя по всем таблицам после версии since - для
+# клиентов, которые держат копию данных и догружают только новое
+async def changes_since(database, user_id, since=0, limit=SYNC_BATCH_ROWS):
+    changes = []
+    for table in SYNC_TABLES:
+        changes.extend(await fetch_changes(database, table, since, limit, user_id))
+    changes.sort(key=lambda change: change['version'])
+    return changes[:limit]
+
+
+# Отправка журнала изменений в PostgREST. Курсоры хранятся по target (адрес
+# назначения), поэтому смена проекта Supabase начинает выгрузку с нуля
+class SupabaseSync:
+    def __init__(self, database, url, key, target=None, batch_size=None, retries=None, prefix=None):
+        self.database = database
+        self.url = url.rstrip('/')
+        self.key = key
+        self.target = target or self.url
+        self.batch_size = batch_size or SYNC_BATCH_ROWS
+        self.retries = SYNC_RETRIES if retries is None else retries
+        self.prefix = SYNC_TABLE_PREFIX if prefix is None else prefix
+        self._session = None
+        self.pushed = 0
+
+    async def cursor(self, table):
+        row = await self.database.fetchone(
+            'SELECT version FROM sync_cursors WHERE target = ? AND table_name = ?', (self.target, table.name)
+        )
+        return row[0] if row else 0
+
+    async def _set_cursor(self, table, version):
+        await self.database.execute('''
+            INSERT INTO sync_cursors (target, table_name, version, updated_at)
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(target, table_name) DO UPDATE SET version = excluded.version, updated_at = excluded.updated_at
+        ''', (self.target, table.name, version))
+
+    # Неотправленные изменения по таблицам
+    async def pending(self):
+        pending = {}
+        for table in SYNC_TABLES:
+            row = await self.database.fetchone(
+                'SELECT COUNT(*) FROM sync_changes WHERE table_name = ? AND version > ?',
+                (table.name, await self.cursor(table))
+            )
+            pending[table.name] = row[0]
+        return pending
+
+    def _headers(self, idempotency_key, prefer):
+        return {
+            'apikey': self.key,
+            'Authorization': f'Bearer {self.key}',
+            'Prefer': prefer,
+            # Повтор той же пачки (после обрыва связи) несет тот же ключ
+            'Idempotency-Key': idempotency_key,
+        }
+
+    async def _request(self, method, table, params, idempotency_key, prefer='return=minimal', body=None):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=SYNC_REQUEST_TIMEOUT))
+        url = f'{self.url}/rest/v1/{self.prefix}{table.name}'
+        headers = self._headers(idempotency_key, prefer)
+        delay = SYNC_RETRY_DELAY
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._session.request(method, url, params=params, json=body, headers=headers) as response:
+                    if response.status < 300:
+                        return
+                    text = await response.text()
+                    error = f"{method} {table.name}: HTTP {response.status} {text[:200]}"
+                    if response.status not in RETRY_STATUSES:
+                        raise SyncError(error)
+                    retry_after = response.headers.get('Retry-After', '')
+                    if retry_after.isdigit():
+                        delay = max(delay, int(retry_after))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = f"{method} {table.name}: {e!r}"
+            if attempt == self.retries:
+                raise SyncError(error)
+            logger.warning(f"Sync request failed, retrying in {delay:.1f}s: {error}")
+            await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+            delay = min(delay * 2, SYNC_RETRY_MAX_DELAY)
+
+    # Одна пачка изменений таблицы: upsert измененных строк, delete удаленных,
+    # затем курсор. Обе операции идемпотентны, поэтому повтор пачки после
+    # сбоя до сохранения курсора безопасен
+    async def push_table(self, table):
+        changes = await fetch_changes(self.database, table, await self.cursor(table), self.batch_size)
+        if not changes:
+            return 0
+        batch_key = f"{self.target}:{table.name}:{changes[0]['version']}-{changes[-1]['version']}"
+
+        upserts = []
+        for change in changes:
+            if change['row'] is not None:
+                row = dict(change['row'])
+                row[table.key] = remote_key(table, row[table.key])
+                row['sync_version'] = change['version']
+                upserts.append(row)
+        if upserts:
+            await self._request(
+                'POST', table, {'on_conflict': table.key}, f'{batch_key}:upsert',
+                prefer='resolution=merge-duplicates,return=minimal', body=upserts
+            )
+
+        deleted = [remote_key(table, change['key']) for change in changes if change['row'] is None]
+        for start in range(0, len(deleted), SYNC_DELETE_KEYS):
+            values = ','.join(f'"{key}"' for key in deleted[start:start + SYNC_DELETE_KEYS])
+            await self._request('DELETE', table, {table.key: f'in.({values})'}, f'{batch_key}:delete:{start}')
+
+        await self._set_cursor(table, changes[-1]['version'])
+        self.pushed += len(changes)
+        return len(changes)
+
+    # Отправка всего накопленного; настройки и катушки - раньше печатей
+    async def push(self):
+        total = 0
+        for table in SYNC_TABLES:
+            while True:
+                sent = await self.push_table(table)
+                total += sent
+                if sent < self.batch_size:
+                    break
+        return total
+
+    async def run(self, interval=None):
+        interval = SYNC_INTERVAL if interval is None else interval
+        logger.info(f"Supabase sync started: {self.url}")
+        try:
+            while True:
+                try:
+                    sent = await self.push()
+                    if sent:
+                        logger.info(f"Synced {sent} changes to Supabase")
+                except Exception as e:
+                    # Курсор не сдвинулся - пачка уйдет в следующий раз
+                    logger.error(f"Supabase sync failed: {e}")
+                await asyncio.sleep(interval)
+        finally:
+            await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
@@ -0,0 +1,116 @@
+import re
+import zipfile
+from collections import namedtuple
+from xml.etree import ElementTree
+
+from gcode_parser import SequentialReader, parse_gcode_info
+
+# Проект Bambu Studio / OrcaSlicer (.3mf) - это ZIP-архив. Нарезанные
+# данные лежат в Metadata/slice_info.config (вес и время по каждой пластине)
+# и в Metadata/plate_N.gcode. Распаковываем только нужные члены архива.
+SLICE_INFO = 'Metadata/slice_info.config'
+PLATE_GCODE = re.compile(r'^Metadata/plate_(\d+)\.gcode$')
+
+# filaments - вес по слотам филамента (г), индекс = id филамента - 1;
+# materials - типы пластика по тем же слотам ('' - неизвестен)
+PlateInfo = namedtuple('PlateInfo', ['index', 'weight_grams', 'time_hours', 'filaments', 'materials'],
+                       defaults=[(), ()])
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# Разбор slice_info.config: {номер пластины: (вес, часы, филаменты, пластики)}
+def _read_slice_info(archive):
+    plates = {}
+    with archive.open(SLICE_INFO) as member:
+        for _, elem in ElementTree.iterparse(member):
+            if elem.tag != 'plate':
+                continue
+            meta = {m.get('key'): m.get('value') for m in elem.findall('metadata')}
+            index = int(_float(meta.get('index')) or len(plates) + 1)
+
+            used, types = {}, {}
+            for filament in elem.findall('filament'):
+                slot = int(_float(filament.get('id')) or len(used) + 1)
+                used[slot] = _float(filament.get('used_g')) or 0.0
+                types[slot] = (filament.get('type') or '').strip().upper()
+            slots = range(1, max(used, default=0) + 1)
+            filaments = tuple(used.get(slot, 0.0) for slot in slots)
+            materials = tuple(types.get(slot, '') for slot in slots) if any(types.values()) else ()
+
+            weight = _float(meta.get('weight')) or sum(filaments) or None
+
+            seconds = _float(meta.get('prediction'))
+            time_hours = seconds / 3600 if seconds else None
+
+            plates[index] = (weight, time_hours, filaments, materials)
+            elem.clear()
+    return plates
+
+
+# Разбор G-code пластины прямо из архива
+def _read_plate_gcode(archive, name):
+    with archive.open(name) as member:
+        # Заголовок читается без распаковки остального файла
+        head = parse_gcode_info(member, tail_bytes=0)
+    if head.weight_grams and head.time_hours:
+        return head.weight_grams, head.time_hours, head.filaments, head.materials
+
+    # Нет данных в заголовке - потоково дочитываем до подвала
+    with archive.open(name) as member:
+        tail = parse_gcode_info(SequentialReader(member))
+    return (head.weight_grams or tail.weight_grams, head.time_hours or tail.time_hours,
+            head.filaments or tail.filaments, head.materials or tail.materials)
+
+
+# Парсинг .3mf: список пластин с весом и временем
+def parse_3mf(source):
+    with zipfile.ZipFile(source) as archive:
+        names = set(archive.namelist())
+        plates = _read_slice_info(archive) if SLICE_INFO in names else {}
+
+        gcodes = {}
+        for name in names:
+            match = PLATE_GCODE.match(name)
+            if match:
+                gcodes[int(match.group(1))] = name
+
+        for index, name in gcodes.items():
+            weight, time_hours, filaments, materials = plates.get(index, (None, None, (), ()))
+            if weight and time_hours:
+                continue
+            gcode_weight, gcode_time, gcode_filaments, gcode_materials = _read_plate_gcode(archive, name)
+            plates[index] = (weight or gcode_weight, time_hours or gcode_time,
+                             filaments or gcode_filaments, materials or gcode_materials)
+
+    return [PlateInfo(index, *plate) for index, plate in sorted(plates.items()) if plate[0] or plate[1]]
+
+
+# Вес по слотам филамента, сложенный по всем пластинам
+def sum_filaments(vectors):
+    total = [0.0] * max((len(v) for v in vectors), default=0)
+    for vector in vectors:
+        for slot, grams in enumerate(vector):
+            total[slot] += grams
+    return tuple(total) if any(total) else ()
+
+
+# Тип пластика по слотам для всех пластин: первый известный в каждом слоте
+def merge_materials(vectors):
+    merged = [''] * max((len(v) for v in vectors), default=0)
+    for vector in vectors:
+        for slot, material in enumerate(vector):
+            merged[slot] = merged[slot] or material
+    return tuple(merged) if any(merged) else ()
+
+
+# Суммарные вес и время по всем пластинам
+def summarize_plates(plates):
+    weights = [p.weight_grams for p in plates if p.weight_grams]
+    times = [p.time_hours for p in plates if p.time_hours]
+    return (sum(weights) if weights else None), (sum(times) if times else None)
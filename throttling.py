@@ -0,0 +1,81 @@
+import logging
+import time
+
+from aiogram import BaseMiddleware
+
+logger = logging.getLogger(__name__)
+
+# Как часто напоминать пользователю об ограничении (сек)
+WARN_INTERVAL = 5
+# Как часто чистить корзины неактивных пользователей (сек)
+CLEANUP_INTERVAL = 60
+
+
+# Ограничение частоты апдейтов на пользователя (token bucket): rate апдейтов
+# в секунду с запасом burst. Для файлов - отдельная, более строгая корзина
+# (files_per_minute), чтобы один пользователь не занял очередь разбора
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(self, rate, burst, files_per_minute, files_burst):
+        self.limits = {
+            'updates': (rate, burst),
+            'files': (files_per_minute / 60, files_burst),
+        }
+        # (вид, пользователь) -> [токены, время обновления]
+        self._buckets = {}
+        self._warned = {}
+        self._cleaned_at = time.monotonic()
+        self.throttled = 0
+
+    def _take(self, kind, user_id, now):
+        rate, burst = self.limits[kind]
+        bucket = self._buckets.setdefault((kind, user_id), [burst, now])
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def _cleanup(self, now):
+        # Корзина, которая успела наполниться, ничем не отличается от новой
+        self._cleaned_at = now
+        self._buckets = {
+            key: bucket for key, bucket in self._buckets.items()
+            if (now - bucket[1]) * self.limits[key[0]][0] < self.limits[key[0]][1]
+        }
+        self._warned = {user_id: at for user_id, at in self._warned.items() if now - at < WARN_INTERVAL}
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        if user is None:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        if now - self._cleaned_at > CLEANUP_INTERVAL:
+            self._cleanup(now)
+
+        kind = None
+        if not self._take('updates', user.id, now):
+            kind = 'updates'
+        elif event.message and event.message.document and not self._take('files', user.id, now):
+            kind = 'files'
+        if kind is None:
+            return await handler(event, data)
+
+        self.throttled += 1
+        logger.debug(f"Throttled {kind} for user {user.id}")
+        await self._warn(event, user.id, kind, now)
+
+    async def _warn(self, event, user_id, kind, now):
+        text = (
+            "⏳ Слишком много файлов подряд. Подождите минуту и отправьте снова."
+            if kind == 'files' else
+            "⏳ Слишком много запросов. Подождите немного."
+        )
+        if event.callback_query:
+            # На нажатие кнопки нужно ответить в любом случае
+            await event.callback_query.answer(text)
+            return
+        if event.message and now - self._warned.get(user_id, -WARN_INTERVAL) >= WARN_INTERVAL:
+            self._warned[user_id] = now
+            await event.message.answer(text)
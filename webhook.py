@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import os
+import signal
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+logger = logging.getLogger(__name__)
+
+# Режим webhook: Telegram сам присылает апдейты POST-запросами на наш
+# aiohttp-сервер (BOT_MODE=webhook). Ответ отдается сразу, апдейт
+# обрабатывается в фоне, не больше WEBHOOK_CONCURRENCY одновременно
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or None
+# Параллельных соединений со стороны Telegram (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))
+# Одновременно выполняемых обработчиков и апдейтов в работе всего
+# (сверх лимита - 503, Telegram повторит доставку позже)
+WEBHOOK_CONCURRENCY = int(os.getenv('WEBHOOK_CONCURRENCY', 32))
+WEBHOOK_MAX_PENDING = int(os.getenv('WEBHOOK_MAX_PENDING', 1000))
+# Сколько ждать завершения начатых обработчиков при остановке (сек)
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', 30))
+HEALTH_PATH = '/health'
+
+
+class LimitedRequestHandler(SimpleRequestHandler):
+    # Фоновая обработка апдейтов с ограничением параллельности и очереди
+    def __init__(self, dispatcher, bot, concurrency=None, max_pending=None, status=None, **kwargs):
+        super().__init__(dispatcher, bot, handle_in_background=True, **kwargs)
+        self.status = status
+        self.max_pending = WEBHOOK_MAX_PENDING if max_pending is None else max_pending
+        self._semaphore = asyncio.Semaphore(WEBHOOK_CONCURRENCY if concurrency is None else concurrency)
+        self.draining = False
+
+    @property
+    def in_flight(self):
+        return len(self._background_feed_update_tasks)
+
+    async def _background_feed_update(self, bot, update):
+        async with self._semaphore:
+            await super()._background_feed_update(bot, update)
+
+    async def _handle_request_background(self, bot, request):
+        if self.draining or self.in_flight >= self.max_pending:
+            return web.Response(status=503, text="Busy")
+        return await super()._handle_request_background(bot, request)
+
+    # Остановка: новые апдейты не принимаются, начатые дорабатывают
+    async def drain(self, timeout=None):
+        self.draining = True
+        tasks = set(self._background_feed_update_tasks)
+        if not tasks:
+            return
+        logger.info(f"Draining {len(tasks)} webhook updates")
+        _, pending = await asyncio.wait(tasks, timeout=WEBHOOK_DRAIN_TIMEOUT if timeout is None else timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"Cancelled {len(pending)} webhook updates after drain timeout")
+
+    async def health(self, request):
+        status = 503 if self.draining else 200
+        return web.json_response({
+            'status': 'draining' if self.draining else 'ok',
+            'in_flight': self.in_flight,
+            'max_pending': self.max_pending,
+            **(self.status() if self.status else {}),
+        }, status=status)
+
+
+# Приложение aiohttp: маршрут webhook, проверка здоровья, запуск/остановка dp.
+# status() - дополнительные поля ответа /health (очередь задач и т.п.)
+def create_app(bot, dispatcher, concurrency=None, max_pending=None, status=None):
+    app = web.Application()
+    handler = LimitedRequestHandler(
+        dispatcher, bot, concurrency, max_pending, status, secret_token=WEBHOOK_SECRET
+    )
+
+    async def drain(app):
+        await handler.drain()
+
+    # Дренаж до закрытия сессии бота: обработчикам еще нужно отвечать
+    app.on_shutdown.append(drain)
+    handler.register(app, path=WEBHOOK_PATH)
+    app.router.add_get(HEALTH_PATH, handler.health)
+    setup_application(app, dispatcher, bot=bot)
+    app['webhook_handler'] = handler
+    return app
+
+
+# Запуск сервера до SIGINT/SIGTERM. Webhook регистрируется в Telegram, если
+# задан WEBHOOK_URL (без него - локальный сервер для записанных апдейтов)
+async def run_webhook(bot, dispatcher, status=None):
+    app = create_app(bot, dispatcher, status=status)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logger.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=dispatcher.resolve_used_update_types(),
+        )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(signum)
+        logger.info("Stopping webhook server...")
+        # Webhook в Telegram не снимаем: апдейты подождут следующего запуска
+        await runner.cleanup()
@@ -0,0 +1,178 @@
+import asyncio
+import itertools
+import math
+import time
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from workers import ParseCancelled
+
+# Приоритеты тяжелых задач (меньше - раньше): файл, который пользователь
+# ждет в диалоге, идет впереди пакетных смет и выгрузок
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_BATCH: 'batch'}
+# Сколько последних ожиданий хранить для статистики
+WAIT_SAMPLES = 1000
+
+
+class QueueFull(Exception):
+    def __init__(self, limit):
+        super().__init__(f"не больше {limit} задач одновременно")
+        self.limit = limit
+
+
+class _Job:
+    __slots__ = ('user_id', 'priority', 'granted', 'changed', 'enqueued_at', 'position', 'notified')
+
+    def __init__(self, user_id, priority):
+        self.user_id = user_id
+        self.priority = priority
+        self.granted = asyncio.get_running_loop().create_future()
+        self.changed = asyncio.Event()
+        self.enqueued_at = time.monotonic()
+        self.position = 0
+        self.notified = 0
+
+
+# Очередь тяжелых задач (скачивание, разбор, выгрузки): не больше slots
+# одновременно. Внутри приоритета слоты выдаются по кругу между
+# пользователями, поэтому десять файлов одного не задерживают файл другого
+class WorkQueue:
+    def __init__(self, slots, user_limit):
+        self.slots = slots
+        self.user_limit = user_limit
+        self.running = 0
+        # приоритет -> {пользователь: его задачи}; порядок ключей - очередь по кругу
+        self._waiting = {}
+        self._user_jobs = Counter()
+        self._waits = {priority: deque(maxlen=WAIT_SAMPLES) for priority in PRIORITY_NAMES}
+        self.completed = Counter()
+
+    # Ожидание слота; on_position(позиция) - async, вызывается при изменении места в очереди
+    @asynccontextmanager
+    async def slot(self, user_id, priority=PRIORITY_INTERACTIVE, on_position=None):
+        if self._user_jobs[user_id] >= self.user_limit:
+            raise QueueFull(self.user_limit)
+        job = _Job(user_id, priority)
+        self._user_jobs[user_id] += 1
+        self._waiting.setdefault(priority, OrderedDict()).setdefault(user_id, deque()).append(job)
+        try:
+            self._dispatch()
+            await self._wait(job, on_position)
+            try:
+                yield
+            finally:
+                self.running -= 1
+                self.completed[priority] += 1
+                self._dispatch()
+        finally:
+            self._user_jobs[user_id] -= 1
+            if not self._user_jobs[user_id]:
+                del self._user_jobs[user_id]
+
+    async def _wait(self, job, on_position):
+        try:
+            while not job.granted.done():
+                if on_position is not None and job.position != job.notified:
+                    job.notified = job.position
+                    await on_position(job.position)
+                    continue
+                job.changed.clear()
+                changed = asyncio.ensure_future(job.changed.wait())
+                try:
+                    await asyncio.wait({job.granted, changed}, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    changed.cancel()
+            job.granted.result()
+        except BaseException:
+            if job.granted.done() and not job.granted.cancelled() and job.granted.exception() is None:
+                # Слот выдан одновременно с отменой - возвращаем его
+                self.running -= 1
+            else:
+                self._remove(job)
+            self._dispatch()
+            raise
+
+    def _remove(self, job):
+        users = self._waiting.get(job.priority, {})
+        jobs = users.get(job.user_id)
+        if jobs and job in jobs:
+            jobs.remove(job)
+            if not jobs:
+                del users[job.user_id]
+            if not users:
+                del self._waiting[job.priority]
+
+    def _next(self):
+        for priority in sorted(self._waiting):
+            users = self._waiting[priority]
+            user_id, jobs = next(iter(users.items()))
+            job = jobs.popleft()
+            if jobs:
+                users.move_to_end(user_id)
+            else:
+                del users[user_id]
+            if not users:
+                del self._waiting[priority]
+            return job
+        return None
+
+    # Порядок выдачи слотов ожидающим: как его пройдет _next
+    def _order(self):
+        for priority in sorted(self._waiting):
+            rounds = itertools.zip_longest(*self._waiting[priority].values())
+            for round_jobs in rounds:
+                yield from (job for job in round_jobs if job is not None)
+
+    def _dispatch(self):
+        while self.running < self.slots:
+            job = self._next()
+            if job is None:
+                break
+            self.running += 1
+            self._waits[job.priority].append(time.monotonic() - job.enqueued_at)
+            job.granted.set_result(None)
+        for position, job in enumerate(self._order(), 1):
+            if job.position != position:
+                job.position = position
+                job.changed.set()
+
+    # Пользователь ушел из диалога - его ожидающие задачи не нужны
+    def cancel(self, user_id):
+        cancelled = False
+        for priority in list(self._waiting):
+            jobs = self._waiting[priority].get(user_id)
+            while jobs:
+                job = jobs[0]
+                self._remove(job)
+                job.granted.set_exception(ParseCancelled())
+                cancelled = True
+        if cancelled:
+            self._dispatch()
+        return cancelled
+
+    @property
+    def depth(self):
+        return sum(len(jobs) for users in self._waiting.values() for jobs in users.values())
+
+    # Состояние для мониторинга: глубина очереди и ожидание слота (сек)
+    def snapshot(self):
+        waiting = Counter()
+        for priority, users in self._waiting.items():
+            waiting[priority] = sum(len(jobs) for jobs in users.values())
+        waits = {}
+        for priority, samples in self._waits.items():
+            ordered = sorted(samples)
+            waits[PRIORITY_NAMES[priority]] = {
+                'avg': sum(ordered) / len(ordered) if ordered else 0.0,
+                'p95': ordered[math.ceil(len(ordered) * 0.95) - 1] if ordered else 0.0,
+                'max': ordered[-1] if ordered else 0.0,
+            }
+        return {
+            'slots': self.slots,
+            'running': self.running,
+            'waiting': {PRIORITY_NAMES[priority]: waiting[priority] for priority in PRIORITY_NAMES},
+            'completed': {PRIORITY_NAMES[priority]: self.completed[priority] for priority in PRIORITY_NAMES},
+            'wait_seconds': waits,
+        }
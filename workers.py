@@ -0,0 +1,200 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from gcode_parser import _is_seekable, open_mapped, parse_gcode_info
+from motion import filament_grams, simulate_gcode
+from threemf import merge_materials, parse_3mf, sum_filaments, summarize_plates
+
+logger = logging.getLogger(__name__)
+
+# filament_mm - длина нити, если вес посчитан симуляцией движений (для пересчета
+# по диаметру и плотности выбранной катушки); filaments - вес по слотам филамента;
+# material - основной пластик (для смен пластика при распределении по ферме)
+ParseResult = namedtuple(
+    'ParseResult', ['weight_grams', 'time_hours', 'dialect', 'plates', 'filament_mm', 'filaments', 'material'],
+    defaults=[None, (), None]
+)
+
+
+# Основной пластик - тот, которого по весу больше всего; без разбивки - первый
+def main_material(materials, filaments=()):
+    if not any(materials):
+        return None
+    if len(filaments) == len(materials):
+        return max(zip(filaments, materials), key=lambda slot: (bool(slot[1]), slot[0]))[1]
+    return next(material for material in materials if material)
+
+
+# Недостающие вес/время - по симуляции движений из начала потока
+def with_motion(result, stream):
+    if result.weight_grams and result.time_hours:
+        return result
+    motion = simulate_gcode(stream)
+    if not motion.moves:
+        return result
+    filament_mm = None if result.weight_grams else max(motion.filament_mm, 0.0)
+    return result._replace(
+        weight_grams=result.weight_grams or filament_grams(filament_mm),
+        time_hours=result.time_hours or motion.time_hours,
+        filament_mm=filament_mm
+    )
+
+
+# Разбор загруженного файла: вес, время, слайсер и пластины (для .3mf)
+def parse_print_file(file_name, source):
+    # В пул процессов передается путь к файлу на диске или содержимое
+    # небольшого файла, скачанного в память
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    if isinstance(source, (str, os.PathLike)):
+        if file_name.lower().endswith('.3mf'):
+            with open(source, 'rb') as f:
+                return parse_print_file(file_name, f)
+        with open_mapped(source) as f:
+            return parse_print_file(file_name, f)
+    if file_name.lower().endswith('.3mf'):
+        plates = parse_3mf(source)
+        weight_grams, time_hours = summarize_plates(plates)
+        filaments = sum_filaments([plate.filaments for plate in plates])
+        materials = merge_materials([plate.materials for plate in plates])
+        return ParseResult(weight_grams, time_hours, '3mf', plates, filaments=filaments,
+                           material=main_material(materials, filaments))
+    info = parse_gcode_info(source)
+    result = ParseResult(info.weight_grams, info.time_hours, info.dialect, [], filaments=info.filaments,
+                         material=main_material(info.materials, info.filaments))
+    if _is_seekable(source):
+        source.seek(0)
+        result = with_motion(result, source)
+    return result
+
+
+class ParseCancelled(Exception):
+    pass
+
+
+# Пул процессов для тяжелого разбора файлов. Обработчики бота только ждут
+# результат, поэтому цикл опроса Telegram не блокируется на больших файлах.
+# Разбор дольше timeout нельзя прервать внутри процесса, поэтому пул сразу
+# заменяется новым, а процессы старого завершаются, как только доработают
+# остальные его задачи (но не дольше еще одного timeout)
+# on_parsed(секунды, ParseResult) - после каждого успешного разбора файла (метрики;
+# модуль импортируется и в дочерних процессах, поэтому метрики подключает бот)
+class ParsePool:
+    def __init__(self, workers=None, timeout=None, on_parsed=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.on_parsed = on_parsed
+        self._executor = None
+        # Задачи в процессах: future -> пул, где она выполняется
+        self._futures = {}
+        # Пулы, замененные после таймаута и ждущие завершения
+        self._retiring = set()
+        # Текущая задача каждого пользователя (одна на пользователя)
+        self._jobs = {}
+
+    def start(self):
+        if self._executor is None:
+            # spawn: дочерние процессы не наследуют потоки aiosqlite и цикл событий
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            logger.info(f"Parse pool started with {self._executor._max_workers} workers")
+
+    def shutdown(self):
+        for job in self._jobs.values():
+            job.cancel()
+        self._jobs.clear()
+        for executor in list(self._retiring):
+            self._kill(executor)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    async def _submit(self, func, *args):
+        self.start()
+        executor = self._executor
+        started = time.perf_counter()
+        future = executor.submit(func, *args)
+        self._futures[future] = executor
+        future.add_done_callback(lambda done: self._futures.pop(done, None))
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            self._recycle(executor, future)
+            raise
+        if self.on_parsed is not None and func is parse_print_file:
+            self.on_parsed(time.perf_counter() - started, result)
+        return result
+
+    def _recycle(self, executor, stuck):
+        if executor not in self._retiring and not stuck.done():
+            logger.warning(f"Parse took longer than {self.timeout}s, replacing the pool")
+            if self._executor is executor:
+                self._executor = None
+                self.start()
+            self._retiring.add(executor)
+            others = [future for future, owner in self._futures.items() if owner is executor and future is not stuck]
+            threading.Thread(target=self._retire, args=(executor, others), daemon=True).start()
+
+    def _retire(self, executor, others):
+        wait(others, timeout=self.timeout)
+        self._kill(executor)
+
+    def _kill(self, executor):
+        self._retiring.discard(executor)
+        for process in list((executor._processes or {}).values()):
+            process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _track(self, user_id, awaitable):
+        # Новая задача пользователя отменяет предыдущую
+        self.cancel(user_id)
+        job = asyncio.ensure_future(awaitable)
+        self._jobs[user_id] = job
+        try:
+            return await job
+        except asyncio.CancelledError:
+            # Задачу отменили через cancel(), а не сам обработчик
+            if job.cancelled() and not asyncio.current_task().cancelling():
+                raise ParseCancelled()
+            raise
+        finally:
+            if self._jobs.get(user_id) is job:
+                del self._jobs[user_id]
+
+    async def run(self, user_id, func, *args):
+        return await self._track(user_id, self._submit(func, *args))
+
+    # Пакетный запуск вызовов (func, *args): не больше limit одновременно, результаты -
+    # в порядке вызовов. Ошибка (в т.ч. таймаут) одного вызова возвращается вместо результата
+    async def map(self, user_id, calls, limit=None):
+        semaphore = asyncio.Semaphore(limit or self.workers or 1)
+
+        async def run_one(func, *args):
+            async with semaphore:
+                try:
+                    return await self._submit(func, *args)
+                except Exception as e:
+                    return e
+
+        return await self._track(user_id, asyncio.gather(*(run_one(*call) for call in calls)))
+
+    async def parse(self, user_id, file_name, path):
+        return await self.run(user_id, parse_print_file, file_name, path)
+
+    # Отмена задачи, если пользователь ушел из ожидания файла. Уже
+    # запущенный процесс доработает, но его результат будет отброшен
+    def cancel(self, user_id):
+        job = self._jobs.pop(user_id, None)
+        if job is not None and not job.done():
+            job.cancel()
+            return True
+        return False